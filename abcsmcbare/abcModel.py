@@ -1,3 +1,7 @@
+import numpy as np
+from .compiled_prior import CompiledPrior
+
+
 class AbcModel:
 
     """ABCModel class.
@@ -25,12 +29,44 @@ class AbcModel:
                  parameterNames=None,
                  simulateArgs=None,
                  pool=None,
+                 batchDistanceFn=None,
+                 prepareDataFn=None,
+                 abortingSimulationFn=None,
                  ):
+        """Init.
+
+        Input:
+            name: name of the model
+            simulationFn: called as simulationFn(params, *simulateArgs, pool) with a list of parameter lists, and
+                returns the simulated data of each
+            distanceFn: called as distanceFn(simulatedData, targetData, params, model) for a single particle, and
+                returns its distance to the data
+            prior: the prior of each parameter
+            nparameters: number of parameters, including initial conditions, etc
+            parameterNames: names of the parameters, for plotting
+            simulateArgs: extra arguments passed to simulationFn
+            pool: passed to simulationFn
+            batchDistanceFn: optional, called as batchDistanceFn(simulatedData, targetData, params, model) with the
+                simulated data of a whole batch (as returned by simulationFn) and the list of their parameters, and
+                returns a vector of their distances. When given it is used instead of distanceFn, which may be None.
+            prepareDataFn: optional, called once per run as prepareDataFn(targetData, model); what it returns (e.g.
+                summary statistics of the data) is passed to the distance functions as targetData instead of the data
+            abortingSimulationFn: optional, called as abortingSimulationFn(params, targetData, epsilon, model) to
+                simulate a batch and compute the distances together, giving up on a simulation as soon as its distance
+                is known to be at least epsilon. Returns (simulatedData, distances, aborted), where aborted is a
+                boolean vector; for an aborted particle the distance is the partial distance (>= epsilon) and its
+                simulated data may be incomplete. When given it is used instead of simulationFn and the distance
+                functions.
+        """
         self.name = name
         self.simulationFn = simulationFn
         self.distanceFn   = distanceFn
+        self.batchDistanceFn = batchDistanceFn
+        self.prepareDataFn = prepareDataFn
+        self.abortingSimulationFn = abortingSimulationFn
         self.nparameters  = nparameters
         self.prior        = prior  # this is stupid, should be an array, so really should be called priors!
+        self.compiled_prior = CompiledPrior(prior)  # for sampling/evaluating whole batches at once
         if parameterNames is None:
             parameterNames = ['P%d' % x for x in range(self.nparameters)]
         self.parameterNames = parameterNames
@@ -41,13 +77,46 @@ class AbcModel:
 
         self.pool = pool
 
-
+    def __getstate__(self):
+        # the pool belongs to the process that created it, so dont send it to worker processes
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
 
     def simulate(self, params):
         #simulatedData = apply(self.simulationFn, (params,)+self.simulateArgs,{'pool':self.pool})
         simulatedData = self.simulationFn(*((params,)+self.simulateArgs+(self.pool,)))
         return simulatedData
 
+    def simulate_with_tolerance(self, params, targetData, epsilon):
+        """Simulate and compare a batch with abortingSimulationFn, stopping rejected simulations early.
+
+        Returns
+        -------
+        simulatedData, distances, aborted
+        """
+        simulatedData, d, aborted = self.abortingSimulationFn(params, targetData, epsilon, self)
+        d = np.asarray(d)
+        aborted = np.asarray(aborted, dtype=bool)
+        if len(d) != len(params) or len(aborted) != len(params):
+            raise ValueError('%s: abortingSimulationFn returned %d distances and %d aborted flags for %d simulations'
+                             % (self.name, len(d), len(aborted), len(params)))
+        return simulatedData, d, aborted
+
+    def prepare_data(self, targetData):
+        """Return what the distance functions compare simulations to: targetData, or its prepareDataFn summary."""
+        if self.prepareDataFn is None:
+            return targetData
+        return self.prepareDataFn(targetData, self)
+
     def distance(self, simulatedData, targetData, params, _unusedModel):
         d = self.distanceFn(*(simulatedData, targetData, params, self))
         return d
+
+    def batch_distance(self, simulatedData, targetData, params):
+        """Return the distances of a whole batch of simulations to the data, using batchDistanceFn."""
+        d = np.asarray(self.batchDistanceFn(simulatedData, targetData, params, self))
+        if len(d) != len(params):
+            raise ValueError('%s: batchDistanceFn returned %d distances for %d simulations' % (self.name, len(d),
+                                                                                               len(params)))
+        return d
@@ -1,12 +1,20 @@
 from __future__ import print_function
 import numpy as np
-from numpy import random as rnd
+from scipy.special import logsumexp
 
+import collections
+import concurrent.futures
 import copy
 import time
 import sys
 from abcsmcbare import kernels
 from abcsmcbare import statistics
+from abcsmcbare import executors
+from abcsmcbare import instrumentation
+from abcsmcbare import proposals
+from abcsmcbare import retention as retention_policies
+from .population import ParticlePopulation
+from .executors import check_below_threshold
 from .KernelType import KernelType
 from .PriorType import PriorType
 
@@ -39,7 +47,16 @@ fit:
 # distances are stored as [nparticle][nbeta][d1, d2, d3 .... ]
 # trajectories are stored as [nparticle][nbeta][ species ][ times ]
 
-class AbcsmcResults:
+class BudgetExhausted(Exception):
+
+    """Raised inside a population when one of the stopping rules of Abcsmc is met; reason names the rule."""
+
+    def __init__(self, reason, message):
+        super(BudgetExhausted, self).__init__(message)
+        self.reason = reason
+
+
+class AbcsmcResults(object):
 
     """ABCSmcResults class.
 
@@ -62,12 +79,47 @@ class AbcsmcResults:
         self.sampled = sampled
         self.rate = rate
         self.trajectories = trajectories  # cant convert to array as they could be different sizes for different models
+        # the particles the trajectories belong to, if only some of them were kept (see retention.py)
+        self.trajectory_indexes = None
         self.distances = np.array(distances)
         self.margins = np.array(margins)
         self.models = np.array(models)
         self.weights = np.array(weights)
-        self.parameters = np.array(parameters)
+        # an array already built, e.g. by ParticlePopulation.parameters_array, is not copied again; lists are laid out
+        # the same way, as a 2D array, or a 1D object array when the models have different numbers of parameters
+        if isinstance(parameters, np.ndarray):
+            self.parameters = parameters
+        elif len(set(len(p) for p in parameters)) <= 1:
+            self.parameters = np.array(parameters)
+        else:
+            self.parameters = np.empty(len(parameters), dtype=object)
+            for slot, params in enumerate(parameters):
+                self.parameters[slot] = np.array(params)
         self.epsilon = epsilon
+        # where the time of the population went, an instrumentation.PopulationTimings; set by Abcsmc
+        self.timings = None
+        # (folder, index) of the population in a checkpoint store; set by InputOutput.write_checkpoint
+        self.checkpoint_location = None
+
+    @classmethod
+    def from_population(cls, naccepted, sampled, rate, trajectories, distances, population, epsilon):
+        """Return the results of a population from its ParticlePopulation.
+
+        The arrays are copied out of the population, as Abcsmc reuses them for the next population.
+        """
+        return cls(naccepted, sampled, rate, trajectories, distances, population.margins, population.models,
+                   population.weights, population.parameters_array(), epsilon)
+
+    @property
+    def trajectories(self):
+        """The trajectories of the accepted particles, or None if they were not kept; this may load them from disk."""
+        if callable(self._trajectories):
+            return self._trajectories()
+        return self._trajectories
+
+    @trajectories.setter
+    def trajectories(self, value):
+        self._trajectories = value
 
 
 class Abcsmc:
@@ -92,7 +144,48 @@ class Abcsmc:
                  kernel_type=KernelType.component_wise_uniform,
                  kernelfn=kernels.get_kernel,
                  kernelpdffn=kernels.get_parameter_kernel_pdf,
-                 perturbfn=kernels.perturb_particle):
+                 perturbfn=kernels.perturb_particle,
+                 kernellogpdffn=None,
+                 batchperturbfn=None,
+                 backend=None,
+                 scheduler='batch',
+                 ninflight=None,
+                 mvnormcdf_options=None,
+                 retention=None,
+                 max_time=None,
+                 max_simulations=None,
+                 max_simulations_per_population=None,
+                 min_acceptance_rate=None):
+        """Init.
+
+        Input:
+            kernel_type: the KernelType of the parameter perturbation kernels
+            kernelfn: builds the kernel of a model from the previous population, called as
+                kernelfn(kernel_type, kernel, population, weights); see kernels.get_kernel
+            kernelpdffn: the density of the kernel for a pair of particles, called as
+                kernelpdffn(params, params0, priors, kernel, auxilliary, kernel_type). If it takes index0, as the
+                built-in kernels.get_parameter_kernel_pdf does, it is also passed the position of params0 in the
+                kernel, without which the kernels of multivariate_normal_nn and multivariate_normal_ocm cannot be used
+            perturbfn: perturbs one particle in place and returns its prior probability, called as
+                perturbfn(params, priors, kernel, kernel_type, special_cases). If it takes index, as the built-in
+                kernels.perturb_particle does, it is also passed the position of the particle in the kernel, which
+                the same kernel types need
+            kernellogpdffn: optional batched, log-space version of kernelpdffn, called as
+                kernellogpdffn(params, params0, priors, kernel, auxilliary, kernel_type) with every new and previous
+                particle of a model; see kernels.get_parameter_kernel_log_pdf_matrix. By default the built-in one is
+                used with the built-in kernelpdffn, and kernelpdffn is evaluated pairwise otherwise
+            batchperturbfn: optional batched version of perturbfn, called as
+                batchperturbfn(params, priors, kernel, kernel_type, special_cases, index=index) with an array of
+                particles and their positions in the kernel, and returning the perturbed array; see
+                kernels.perturb_particles. By default the built-in one is used with the built-in perturbfn, and
+                perturbfn is called for every particle otherwise
+            backend: the executors backend running the simulations; by default executors.SerialBackend
+            scheduler, ninflight: 'batch' or 'async', and the number of simulations in flight with 'async'
+            mvnormcdf_options: options of the integration of the multivariate normal kernels, see statistics.mvnormcdf
+            retention: the policy deciding which trajectories are kept, see retention.py; by default KeepAll
+            max_time, max_simulations, max_simulations_per_population, min_acceptance_rate: stopping rules, see
+                below
+        """
         self.io = io
 
         self.nmodel = len(models)
@@ -100,25 +193,64 @@ class Abcsmc:
 
         self.nparticles = nparticles
 
-        self.model_prev = [0] * nparticles
-        self.weights_prev = [0] * nparticles
-        self.parameters_prev = [[] for _ in range(self.nparticles)]
-        self.margins_prev = [0] * self.nmodel
-
-        self.model_curr = [0] * nparticles
-        self.weights_curr = [0] * nparticles
-        self.parameters_curr = [[] for _ in range(self.nparticles)]
-        self.margins_curr = [0] * self.nmodel
+        # the previous (accepted) population, and the one currently being filled; these are swapped, not copied, at the
+        # end of every population
+        nparameters = [model.nparameters for model in self.models]
+        self.population_prev = ParticlePopulation(nparticles, nparameters)
+        self.population_curr = ParticlePopulation(nparticles, nparameters)
 
-        self.b = [0] * nparticles
         self.distances = []
         self.trajectories = []
 
+        # which trajectories are kept in memory once a population is finished; see retention.py
+        if retention is None:
+            retention = retention_policies.KeepAll()
+        self.retention = retention
+
+        # stopping rules, all off by default. If one is met during a population, that population is abandoned and the
+        # run ends with the last complete population; stop_reason then names the rule and stop_message says more.
+        #  max_time: seconds since the start of the run (the call to run_schedule or iterate_schedule)
+        #  max_simulations: simulations over the lifetime of this object
+        #  max_simulations_per_population: simulations in a single population
+        #  min_acceptance_rate: the acceptance rate of a population, once it has made at least nparticles simulations
+        # The rules are checked between batches (or, with the async scheduler, between submissions), so the limits on
+        # simulations may be exceeded by up to one batch.
+        self.max_time = max_time
+        self.max_simulations = max_simulations
+        self.max_simulations_per_population = max_simulations_per_population
+        self.min_acceptance_rate = min_acceptance_rate
+        self.run_start_time = None
+        self.stop_reason = None
+        self.stop_message = None
+
+        # the timings of the population being sampled; handed over to its AbcsmcResults when it is finished
+        self.timings = instrumentation.PopulationTimings()
+
         # self.distancefn = distancefn
         self.kernel_type = kernel_type
         self.kernelfn = kernelfn
         self.kernelpdffn = kernelpdffn
         self.perturbfn = perturbfn
+        # batched log-space kernel density; it must agree with kernelpdffn, so the built-in one is only used with the
+        # built-in kernelpdffn. If None, fall back to calling kernelpdffn for every pair of particles
+        if kernellogpdffn is None:
+            if kernelpdffn is kernels.get_parameter_kernel_pdf:
+                kernellogpdffn = kernels.get_parameter_kernel_log_pdf_matrix
+        elif kernellogpdffn is kernels.get_parameter_kernel_log_pdf_matrix \
+                and kernelpdffn is not kernels.get_parameter_kernel_pdf:
+            raise ValueError('kernellogpdffn is the built-in kernel density but kernelpdffn is not; pass the '
+                             'kernellogpdffn matching kernelpdffn, or None to evaluate kernelpdffn pairwise')
+        self.kernellogpdffn = kernellogpdffn
+        # batched perturbation; as for kernellogpdffn, the built-in one is only used with the built-in perturbfn. If
+        # None, fall back to calling perturbfn for every particle
+        if batchperturbfn is None:
+            if perturbfn is kernels.perturb_particle:
+                batchperturbfn = kernels.perturb_particles
+        elif batchperturbfn is kernels.perturb_particles and perturbfn is not kernels.perturb_particle:
+            raise ValueError('batchperturbfn is the built-in perturbation but perturbfn is not; pass the '
+                             'batchperturbfn matching perturbfn, or None to call perturbfn for every particle')
+        self.batchperturbfn = batchperturbfn
+        self.check_kernel_hooks(kernel_type)
 
         # self.beta = 1
         self.dead_models = []
@@ -127,24 +259,61 @@ class Abcsmc:
         self.timing = timing
 
         self.data = data
+        # what the distance functions compare to: the data as prepared by each model (e.g. its summary statistics),
+        # computed once here rather than in every distance call
+        self.model_data = [model.prepare_data(data) for model in self.models]
+
+        # the execution backend runs simulations and distance calculations; see executors.py
+        if backend is None:
+            backend = executors.SerialBackend()
+        self.backend = backend
+
+        # 'batch' simulates self.nbatch proposals in lock-step; 'async' keeps ninflight (default nbatch) simulations
+        # running and accepts particles as they complete
+        if scheduler not in ['batch', 'async']:
+            raise ValueError('scheduler should be one of batch or async, not %s' % scheduler)
+        self.scheduler = scheduler
+        self.ninflight = ninflight
 
         self.modelprior = modelprior[:]
         self.modelKernel = model_kernel
         self.kernel_aux = [0] * nparticles
+        # truncation masses of the multivariate normal kernels are integrated with the options in mvnormcdf_options
+        # (e.g. maxpts, abseps, releps; see statistics.mvnormcdf)
+        self.mvnormcdf_options = mvnormcdf_options or {}
+
+        self.init_kernels()
+
+        self.hits = []
+        self.sampled = []
+        self.rate = []
+        self.dead_models = []
+        self.sample_from_prior = True
 
+    def init_kernels(self, kernel_option=None):
+        """Set up empty kernels of type self.kernel_type for every model; they are built by update_kernels.
+
+        Parameters
+        ----------
+        kernel_option : the option of the kernel of every model (e.g. the number of neighbours for the nearest
+            neighbour kernel); by default nparticles / 4 for multivariate_normal_nn and 0 otherwise
+        """
         self.kernels = list()
         # self.kernels is a list of length the number of models
-        # self.kernels[i] is a list of length 2 such that :
+        # self.kernels[i] is a list of length 4 such that :
         # self.kernels[i][0] contains the index of the non constant parameters for the model i
         # self.kernels[i][1] contains the information required to build the kernel and given by the input_file
         # self.kernels[i][2] is filled in during the kernelfn step and contains values/matrix etc depending on kernel
-        kernel_option = list()
-        for i in range(self.nmodel):
-            if self.kernel_type == KernelType.multivariate_normal_nn:
-                # Option for K nearest neigbours - user should be able to specify
-                kernel_option.append(int(nparticles / 4))
-            else:
-                kernel_option.append(0)
+        # self.kernels[i][3] is filled in during the kernelfn step with the factorized covariance(s) of the
+        #  multivariate normal kernels
+        if kernel_option is None:
+            kernel_option = list()
+            for i in range(self.nmodel):
+                if self.kernel_type == KernelType.multivariate_normal_nn:
+                    # Option for K nearest neigbours - user should be able to specify
+                    kernel_option.append(int(self.nparticles / 4))
+                else:
+                    kernel_option.append(0)
 
         # get the list of parameters with non constant prior
         for i in range(self.nmodel):
@@ -153,7 +322,7 @@ class Abcsmc:
                 if not (self.models[i].prior[j].type == PriorType.constant):
                     ind.append(j)
             # kernel info will get set after first population
-            self.kernels.append([ind, kernel_option[i], 0])
+            self.kernels.append([ind, kernel_option[i], 0, None])
 
             # get
         self.special_cases = [0] * self.nmodel
@@ -168,53 +337,157 @@ class Abcsmc:
                     self.special_cases[m] = 1
                     print("### Found special kernel case 1 for model ", m, "###")
 
-        self.hits = []
-        self.sampled = []
-        self.rate = []
-        self.dead_models = []
-        self.sample_from_prior = True
-
-    def run_schedule(self, epsilonSchedule, adaptiveEpsilon=False, adaptiveEpsilonQuantile=None):
-        all_start_time = time.time()
-        allResults = []
-        results = None
-        for pop, thisEpsilon in enumerate(epsilonSchedule):
-            if pop > 0 and adaptiveEpsilon:
-                adaptiveEpsilon, quantile = self.nextAdaptiveEpsilon(results.distances, epsilonSchedule[-1], adaptiveEpsilonQuantile)
-                if self.debug >= 1:
-                    print('### Adapting epsilon to %f (Quantile=%f) instead of %f' % (adaptiveEpsilon, quantile, thisEpsilon))
-                    epsilonToUse = adaptiveEpsilon
-            else:
-                epsilonToUse = thisEpsilon
+    def check_kernel_hooks(self, kernel_type):
+        """Raise ValueError if a custom kernelpdffn or perturbfn cannot be used with the kernels of kernel_type.
 
-            start_time = time.time()
-            if pop == 0 and self.sample_from_prior:
-                results = self.iterate_one_population(epsilonToUse, prior=True)
-            else:
-                results = self.iterate_one_population(epsilonToUse, prior=False)
-            end_time = time.time()
+        The kernels with one covariance per particle need the position of the particle, so the hooks called for a
+        single particle must take it (see __init__). The batched hooks always do.
+        """
+        if kernel_type not in kernels.PER_PARTICLE_KERNEL_TYPES:
+            return
+        if self.kernellogpdffn is None and not kernels.accepts_keyword(self.kernelpdffn, 'index0'):
+            raise ValueError('kernelpdffn does not take index0, the position of the previous particle in the kernel, '
+                             'which the kernels of %s need' % kernel_type)
+        if self.batchperturbfn is None and not kernels.accepts_keyword(self.perturbfn, 'index'):
+            raise ValueError('perturbfn does not take index, the position of the particle in the kernel, which the '
+                             'kernels of %s need' % kernel_type)
 
-            allResults.append(results)
+    def set_kernel_type(self, kernel_type, kernel_option=None):
+        """Switch to another kind of parameter perturbation kernel, e.g. between populations of iterate_schedule.
 
-            self.io.write_pickled(self.nmodel, self.model_prev, self.weights_prev, self.parameters_prev, self.margins_prev, self.kernels, allResults)
+        If there is a previous population the new kernels are built from it straight away.
 
-            if self.debug >= 1:
-                print("### iter:%d, eps=%0.2f, sampled=%d, accepted=%.2f" % (pop + 1, epsilonToUse, self.sampled[pop], self.rate[pop]))
-                #   print "\t sampling steps / acceptance rate (%d/%):", self.sampled[pop], "/", self.rate[pop]
-                print("model marginals:", self.margins_prev)
+        Parameters
+        ----------
+        kernel_type : the new KernelType
+        kernel_option : see init_kernels
+        """
+        self.check_kernel_hooks(kernel_type)
+        self.kernel_type = kernel_type
+        self.init_kernels(kernel_option)
+        if not self.sample_from_prior:
+            self.update_kernels(rebuild=True)
 
-                if len(self.dead_models) > 0:
-                    print("\t dead models                      :", self.dead_models)
-                if self.timing:
-                    print("\t timing:                          :", end_time - start_time)
+    def run_schedule(self, epsilonSchedule, adaptiveEpsilon=False, adaptiveEpsilonQuantile=None, callback=None):
+        """Run a population for each epsilon in epsilonSchedule, and return the list of their AbcsmcResults.
 
-                sys.stdout.flush()
+        Parameters
+        ----------
+        epsilonSchedule : the tolerance of each population
+        adaptiveEpsilon : if True, the tolerance of each population after the first is a quantile of the distances of
+            the previous one (see nextAdaptiveEpsilon), but not less than the last entry of epsilonSchedule
+        adaptiveEpsilonQuantile : the quantile, see nextAdaptiveEpsilon
+        callback : optional function called as callback(self, results) after every population; if it returns True
+            the run stops there. It may also change the kernel with set_kernel_type.
+
+        See iterate_schedule for a version that does not keep every population.
+        """
+        all_start_time = time.time()
+        allResults = []
+        populations = self.iterate_schedule(epsilonSchedule, adaptiveEpsilon, adaptiveEpsilonQuantile)
+        try:
+            for results in populations:
+                allResults.append(results)
+                if callback is not None and callback(self, results):
+                    break
+        finally:
+            populations.close()
 
         if self.timing:
             print("#### final time:", time.time() - all_start_time)
+            checkpoint_timing = getattr(self.io, 'checkpoint_timing', None)
+            if checkpoint_timing is not None:
+                print("#### checkpoint time:", checkpoint_timing())
 
         return allResults
 
+    def iterate_schedule(self, epsilonSchedule, adaptiveEpsilon=False, adaptiveEpsilonQuantile=None):
+        """Run a population for each epsilon in epsilonSchedule, yielding each AbcsmcResults as soon as it is finished.
+
+        This is the streaming form of run_schedule: nothing is kept of the populations that have been yielded, beyond
+        what the caller holds on to. While the generator is suspended between populations, the caller may:
+
+        * stop, by no longer iterating; closing the generator (or letting it be garbage collected) shuts the backend
+          down and flushes the checkpoints.
+        * set the tolerance of the next population, by calling send(epsilon) instead of next(); this takes the place
+          of the next entry of the schedule.
+        * swap the parameter perturbation kernel, with set_kernel_type.
+
+        epsilonSchedule is consumed lazily, so it may be a generator that decides each tolerance from the results so
+        far; adaptiveEpsilon needs a sequence, as it uses the last entry as the smallest tolerance.
+
+        Parameters
+        ----------
+        see run_schedule
+        """
+        results = None
+        sent_epsilon = None
+        self.run_start_time = time.time()
+        self.stop_reason = None
+        self.stop_message = None
+        try:
+            for pop, thisEpsilon in enumerate(epsilonSchedule):
+                if sent_epsilon is not None:
+                    epsilonToUse = sent_epsilon
+                elif pop > 0 and adaptiveEpsilon:
+                    epsilonToUse, quantile = self.nextAdaptiveEpsilon(results.distances, epsilonSchedule[-1], adaptiveEpsilonQuantile)
+                    if self.debug >= 1:
+                        print('### Adapting epsilon to %f (Quantile=%f) instead of %f' % (epsilonToUse, quantile, thisEpsilon))
+                else:
+                    epsilonToUse = thisEpsilon
+
+                start_time = time.time()
+                try:
+                    results = self.iterate_one_population(epsilonToUse, prior=self.sample_from_prior)
+                except BudgetExhausted as e:
+                    # abandon this population: the previous one, and its kernels, are the state to carry on from
+                    self.stop_reason = e.reason
+                    self.stop_message = 'population %d: %s' % (pop + 1, e)
+                    self.population_curr.reset()
+                    self.trajectories = []
+                    self.distances = []
+                    self.timings = instrumentation.PopulationTimings()
+                    print("### Stopping early in", self.stop_message)
+                    sys.stdout.flush()
+                    return
+                self.sample_from_prior = False
+                end_time = time.time()
+
+                with results.timings.stage('checkpoint'):
+                    self.io.write_checkpoint(results, self.population_prev, self.kernels)
+                with results.timings.stage('retention'):
+                    self.retention.retain(results)
+
+                if self.debug >= 1:
+                    print("### iter:%d, eps=%0.2f, sampled=%d, accepted=%.2f" % (pop + 1, epsilonToUse, self.sampled[-1], self.rate[-1]))
+                    #   print "\t sampling steps / acceptance rate (%d/%):", self.sampled[pop], "/", self.rate[pop]
+                    print("model marginals:", self.population_prev.margins)
+
+                    if len(self.dead_models) > 0:
+                        print("\t dead models                      :", self.dead_models)
+                    if self.timing:
+                        print("\t timing:                          :", end_time - start_time)
+                        print(results.timings.summary())
+
+                    sys.stdout.flush()
+
+                sent_epsilon = yield results
+
+        finally:
+            self.backend.shutdown()
+            # make sure every checkpoint is on disk, whether or not the run succeeded; if it failed, an error writing
+            # the checkpoints is reported but must not replace the error the run failed with. The caller closing the
+            # generator is not a failure.
+            flush = getattr(self.io, 'flush', None)
+            if flush is not None:
+                if sys.exc_info()[0] in (None, GeneratorExit):
+                    flush()
+                else:
+                    try:
+                        flush()
+                    except Exception as e:
+                        print('### Error writing the checkpoints:', repr(e))
+
     def nextAdaptiveEpsilon(self, lastArrayOfDistances, lastEpsilon, adaptiveEpsilonQuantile=None):
         """Drovandi & Pettitt 2011.
 
@@ -233,55 +506,29 @@ class Abcsmc:
     def iterate_one_population(self, next_epsilon, prior):
         if self.debug == 2:
             print("\n\n****iterate_one_population: next_epsilon, prior", next_epsilon, prior)
+        start = instrumentation.clock()
 
-        naccepted = 0
-        sampled = 0
-
-        while naccepted < self.nparticles:
-            if self.debug == 2:
-                print("\t****batch")
-            if not prior:
-                sampled_models_indexes = self.sample_model()
-                sampled_params = self.sample_parameters(sampled_models_indexes)
-            else:
-                sampled_models_indexes = self.sample_model_from_prior()
-                sampled_params = self.sample_parameters_from_prior(sampled_models_indexes)
-
-            accepted_index, distances, traj = self.simulate_and_compare_to_data(sampled_models_indexes, sampled_params,
-                                                                                next_epsilon)
-            for i in range(self.nbatch):
-                if naccepted < self.nparticles:
-                    sampled += 1
-
-                if naccepted < self.nparticles and accepted_index[i] > 0:
-
-                    self.model_curr[naccepted] = sampled_models_indexes[i]
-                    if self.debug == 2:
-                        print("\t****accepted", i, accepted_index[i], sampled_models_indexes[i])
+        if self.backend.proposes:
+            # backends drawing their own proposals need what they are drawn from, once per population
+            if not self.backend.started:
+                self.backend.start(self.models, self.model_data, self.debug)
+            with self.timings.stage('publish'):
+                self.backend.publish(self.proposal_sampler(), prior)
 
-                    for p in range(self.models[sampled_models_indexes[i]].nparameters):
-                        self.parameters_curr[naccepted].append(sampled_params[i][p])
-
-                    self.b[naccepted] = accepted_index[i]
-                    self.trajectories.append(traj[i])
-                    self.distances.append(distances[i])
-
-                    naccepted += 1
-            if self.debug == 2:
-                print("#### current naccepted:", naccepted)
-
-            if self.debug > 1:
-                print("\t****end  batch naccepted/sampled:", naccepted, sampled)
+        if self.scheduler == 'async':
+            naccepted, sampled = self.sample_population_async(next_epsilon, prior)
+        else:
+            naccepted, sampled = self.sample_population_batch(next_epsilon, prior)
 
         # Finished loop over particles
         if self.debug == 2:
             print("**** end of population naccepted/sampled:", naccepted, sampled)
 
-        if not prior:
-            self.compute_particle_weights()
-        else:
-            for i in range(self.nparticles):
-                self.weights_curr[i] = self.b[i]
+        with self.timings.stage('compute_particle_weights'):
+            if not prior:
+                self.compute_particle_weights()
+            else:
+                self.population_curr.weights[:] = self.population_curr.b
 
         self.normalize_weights()
         self.update_model_marginals()
@@ -289,85 +536,244 @@ class Abcsmc:
         if self.debug == 2:
             print("**** end of population: particles")
             for i in range(self.nparticles):
-                print(i, self.weights_curr[i], self.model_curr[i], self.parameters_curr[i])
-            print(self.margins_curr)
+                print(i, self.population_curr.weights[i], self.population_curr.models[i],
+                      self.population_curr.get_parameters(i))
+            print(self.population_curr.margins)
 
         # Prepare for next population
-        self.margins_prev = self.margins_curr[:]
-        self.weights_prev = self.weights_curr[:]
-        self.model_prev = self.model_curr[:]
-        self.parameters_prev = []
-        for i in range(self.nparticles):
-            self.parameters_prev.append(self.parameters_curr[i][:])
-
-        self.model_curr = [0] * self.nparticles
-        self.weights_curr = [0] * self.nparticles
-        self.parameters_curr = [[] for _ in range(self.nparticles)]
-        self.margins_curr = [0] * self.nmodel
-
-        self.b = [0] * self.nparticles
+        self.population_prev, self.population_curr = self.population_curr, self.population_prev
+        self.population_curr.reset()
+        self.population_prev.build_sampling_index()
 
         # Check for dead models
         self.dead_models = []
         for j in range(self.nmodel):
-            if self.margins_prev[j] < 1e-6:
+            if self.population_prev.margins[j] < 1e-6:
                 self.dead_models.append(j)
 
+        # if we have just sampled from the prior we shall initialise the kernels using all available particles
+        if prior:
+            # quick sanity check - on step 1 we should really have all the models
+            if len(set(self.population_prev.models)) is not self.nmodel:
+                raise RuntimeError('Something is very wrong - in my first population I failed to sample all models - are you sure your distance function is working?')
+
+        self.update_kernels(rebuild=prior)
+
+        self.hits.append(naccepted)
+        self.sampled.append(sampled)
+        self.rate.append(naccepted / float(sampled))
+
+        # with a retention policy that does not collect trajectories there are none, rather than an empty list
+        results = AbcsmcResults.from_population(naccepted,
+                                                sampled,
+                                                naccepted / float(sampled),
+                                                self.trajectories if self.retention.collect else None,
+                                                self.distances,
+                                                self.population_prev,
+                                                next_epsilon)
+
+        self.timings.count('simulations', sampled)
+        self.timings.count('accepted', naccepted)
+        self.timings.add('population', instrumentation.clock() - start)
+        results.timings = self.timings
+        self.timings = instrumentation.PopulationTimings()
+
+        self.trajectories = []
+        self.distances = []
+
+        return results
+
+    def update_kernels(self, rebuild=False):
+        """Build the kernels of every model, and their auxilliary information, from the previous population.
+
+        Parameters
+        ----------
+        rebuild : if True build the kernel of every model that has particles; otherwise only those of models with more
+            than 5 particles, and the per-particle kernels, are updated
+        """
         # Compute kernels
         for model_index in range(self.nmodel):
-            this_model_particles = np.arange(self.nparticles)[np.array(self.model_prev) == model_index]
+            this_model_particles = self.population_prev.model_indexes(model_index)
+            if len(this_model_particles) == 0:
+                continue
 
-            this_population = np.zeros([len(this_model_particles), self.models[model_index].nparameters])
-            this_weights = np.zeros(len(this_model_particles))
-            # if we have just sampled from the prior we shall initialise the kernels using all available particles
-            if prior:
-                # quick sanity check - on step 1 we should really have all the models
-                if len(set(self.model_prev)) is not self.nmodel:
-                    raise RuntimeError('Something is very wrong - in my first population I failed to sample all models - are you sure your distance function is working?')
+            # only update the kernels if there are > 5 particles; kernels with one covariance per particle are indexed
+            # by the particles of the previous population, so must always be rebuilt
+            per_particle = self.kernel_type in (KernelType.multivariate_normal_nn, KernelType.multivariate_normal_ocm)
+            if rebuild or len(this_model_particles) > 5 or per_particle:
+                this_population = self.population_prev.parameters[model_index][this_model_particles]
+                this_weights = self.population_prev.weights[this_model_particles]
+                with self.timings.stage('get_kernel'):
+                    tmp_kernel = self.kernelfn(self.kernel_type, self.kernels[model_index], this_population,
+                                               this_weights)
+                self.kernels[model_index] = tmp_kernel[:]
 
-                for it in range(len(this_model_particles)):
-                    if len(this_population[it, :]) != len(self.parameters_prev[this_model_particles[it]][:]):
-                        print('>>>', this_population[it, :])
-                        print('>>>', self.parameters_prev[this_model_particles[it]][:])
+        # Kernel auxilliary information
+        with self.timings.stage('get_auxilliary_info'):
+            self.kernel_aux = kernels.get_auxilliary_info(self.kernel_type, self.population_prev, self.models,
+                                                          self.kernels, **self.mvnormcdf_options)[:]
 
-                    this_population[it, :] = self.parameters_prev[this_model_particles[it]][:]
-                    this_weights[it] = self.weights_prev[this_model_particles[it]]
+    def sample_proposals(self, prior):
+        """Draw a batch of self.nbatch models and parameters, from the prior or by perturbing the previous population.
 
-                tmp_kernel = self.kernelfn(self.kernel_type, self.kernels[model_index], this_population, this_weights)
-                self.kernels[model_index] = tmp_kernel[:]
+        Returns
+        -------
+        sampled_models_indexes, sampled_params
+        """
+        with self.timings.stage('sample_proposals'):
+            sampled_models_indexes, sampled_params = self.proposal_sampler().propose(self.nbatch, prior)
+        return sampled_models_indexes, sampled_params
+
+    def accept_particle(self, naccepted, model_index, params, b, traj, distance):
+        """Store an accepted particle in slot naccepted of the current population."""
+        self.population_curr.set(naccepted, model_index, params, b)
+        if self.retention.collect:
+            self.trajectories.append(traj)
+        self.distances.append(distance)
+
+    def check_budget(self, naccepted, sampled):
+        """Raise BudgetExhausted if one of the stopping rules is met by a population with naccepted particles accepted
+        out of sampled simulations so far."""
+        if self.max_time is not None and self.run_start_time is not None:
+            elapsed = time.time() - self.run_start_time
+            if elapsed > self.max_time:
+                raise BudgetExhausted('max_time', 'ran for %.1f s, over max_time=%s s; %d of %d particles accepted'
+                                      % (elapsed, self.max_time, naccepted, self.nparticles))
+
+        if self.max_simulations is not None and sum(self.sampled) + sampled >= self.max_simulations:
+            raise BudgetExhausted('max_simulations', '%d simulations in total, max_simulations=%d; %d of %d particles '
+                                  'accepted' % (sum(self.sampled) + sampled, self.max_simulations, naccepted,
+                                                self.nparticles))
+
+        if self.max_simulations_per_population is not None and sampled >= self.max_simulations_per_population:
+            raise BudgetExhausted('max_simulations_per_population', '%d simulations, max_simulations_per_population=%d; '
+                                  '%d of %d particles accepted' % (sampled, self.max_simulations_per_population,
+                                                                   naccepted, self.nparticles))
+
+        if self.min_acceptance_rate is not None and sampled >= self.nparticles and \
+                naccepted < self.min_acceptance_rate * sampled:
+            raise BudgetExhausted('min_acceptance_rate', 'acceptance rate %g after %d simulations, under '
+                                  'min_acceptance_rate=%g' % (naccepted / float(sampled), sampled,
+                                                              self.min_acceptance_rate))
+
+    def sample_population_batch(self, next_epsilon, prior):
+        """Fill the current population by simulating whole batches of self.nbatch proposals in lock-step.
+
+        Raises BudgetExhausted if a stopping rule is met before the population is full.
 
+        Returns
+        -------
+        naccepted, sampled
+        """
+        naccepted = 0
+        sampled = 0
+
+        while naccepted < self.nparticles:
+            self.check_budget(naccepted, sampled)
+            if self.debug == 2:
+                print("\t****batch")
+            if self.backend.proposes:
+                sampled_models_indexes, sampled_params, accepted_index, distances, traj = \
+                    self.propose_and_simulate(next_epsilon, prior)
             else:
-                # only update the kernels if there are > 5 particles
-                if len(this_model_particles) > 5:
-                    for it in range(len(this_model_particles)):
-                        this_population[it, :] = self.parameters_prev[this_model_particles[it]][:]
-                        this_weights[it] = self.weights_prev[this_model_particles[it]]
-                    tmp_kernel = self.kernelfn(self.kernel_type, self.kernels[model_index], this_population, this_weights)
-                    self.kernels[model_index] = tmp_kernel[:]
+                sampled_models_indexes, sampled_params = self.sample_proposals(prior)
+                accepted_index, distances, traj = self.simulate_and_compare_to_data(sampled_models_indexes,
+                                                                                    sampled_params, next_epsilon)
+            for i in range(self.nbatch):
+                if naccepted < self.nparticles:
+                    sampled += 1
 
-        # Kernel auxilliary information
-        self.kernel_aux = kernels.get_auxilliary_info(self.kernel_type, self.model_prev, self.parameters_prev,
-                                                      self.models, self.kernels)[:]
+                if naccepted < self.nparticles and accepted_index[i] > 0:
+                    if self.debug == 2:
+                        print("\t****accepted", i, accepted_index[i], sampled_models_indexes[i])
 
-        self.hits.append(naccepted)
-        self.sampled.append(sampled)
-        self.rate.append(naccepted / float(sampled))
+                    self.accept_particle(naccepted, sampled_models_indexes[i], sampled_params[i], accepted_index[i],
+                                         traj[i], distances[i])
+                    naccepted += 1
+            if self.debug == 2:
+                print("#### current naccepted:", naccepted)
 
-        results = AbcsmcResults(naccepted,
-                                sampled,
-                                naccepted / float(sampled),
-                                self.trajectories,
-                                self.distances,
-                                self.margins_prev,
-                                self.model_prev,
-                                self.weights_prev,
-                                self.parameters_prev,
-                                next_epsilon)
+            if self.debug > 1:
+                print("\t****end  batch naccepted/sampled:", naccepted, sampled)
 
-        self.trajectories = []
-        self.distances = []
+        return naccepted, sampled
 
-        return results
+    def sample_population_async(self, next_epsilon, prior):
+        """Fill the current population by keeping self.ninflight simulations running and accepting them as they finish.
+
+        Proposals are still drawn self.nbatch at a time, but each is submitted to the backend on its own, and a new one
+        is submitted whenever one completes, so a single slow simulation does not hold up the others. Once
+        self.nparticles particles are accepted the outstanding simulations are cancelled (or, if already running,
+        their results are ignored).
+
+        sampled counts the simulations whose results were examined, so the acceptance rate is that of the completed
+        simulations. Note that when simulation time depends on the parameters, accepting in completion order favours
+        fast simulations.
+
+        Raises BudgetExhausted if a stopping rule is met before the population is full.
+
+        Returns
+        -------
+        naccepted, sampled
+        """
+        naccepted = 0
+        sampled = 0
+
+        if not self.backend.started:
+            self.backend.start(self.models, self.model_data, self.debug)
+
+        ninflight = self.ninflight or self.nbatch
+        proposals = collections.deque()
+        in_flight = {}
+
+        try:
+            while naccepted < self.nparticles:
+                self.check_budget(naccepted, sampled)
+                while len(in_flight) < ninflight:
+                    if self.backend.proposes:
+                        # the proposal is drawn by the backend, and comes back with the results
+                        with self.timings.stage('backend'):
+                            in_flight[self.backend.submit_proposals(1, next_epsilon, prior)] = None
+                        continue
+                    if len(proposals) == 0:
+                        proposals.extend(zip(*self.sample_proposals(prior)))
+                    model_index, params = proposals.popleft()
+                    with self.timings.stage('backend'):
+                        in_flight[self.backend.submit(model_index, [params], next_epsilon)] = (model_index, params)
+
+                with self.timings.stage('backend'):
+                    done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    proposal = in_flight.pop(future)
+                    if naccepted >= self.nparticles:
+                        continue
+
+                    if proposal is None:
+                        model_indexes, parameters, accepted_index, distances, traj, stats = future.result()
+                        model_index, params = model_indexes[0], parameters[0]
+                    else:
+                        model_index, params = proposal
+                        accepted_index, distances, traj, stats = future.result()
+                    simulate_time, distance_time, naborted = stats
+                    self.timings.add('simulate', simulate_time)
+                    self.timings.add('distance', distance_time)
+                    self.timings.count('aborted', naborted)
+                    sampled += 1
+                    if accepted_index[0] > 0:
+                        if self.debug == 2:
+                            print("\t****accepted", accepted_index[0], model_index)
+
+                        self.accept_particle(naccepted, model_index, params, accepted_index[0], traj[0], distances[0])
+                        naccepted += 1
+
+                if self.debug > 1:
+                    print("\t****naccepted/sampled/in flight:", naccepted, sampled, len(in_flight))
+        finally:
+            # stragglers: cancel what has not started; anything already running is simply never looked at
+            for future in in_flight:
+                future.cancel()
+
+        return naccepted, sampled
 
     def fill_values(self, particle_data):
         """Save particle data from pickled array into the corresponding attributes of this abc_smc object.
@@ -377,16 +783,11 @@ class Abcsmc:
         particle_data : particle data, in form:
          [model_pickled, weights_pickled, parameters_pickled, margins_pickled, kernel]
 
+        Kernels written before they held their factorized covariances (three entries rather than four, with a
+        dictionary keyed by particle for the nearest neighbour and OCM kernels) cannot be used as they are; only their
+        settings are kept, and they are rebuilt from the population.
         """
-        self.model_prev = particle_data[0][:]
-
-        self.weights_prev = particle_data[1][:]
-
-        self.parameters_prev = []
-        for it in range(len(particle_data[2])):
-            self.parameters_prev.append(particle_data[2][it][:])
-
-        self.margins_prev = particle_data[3][:]
+        self.population_prev.fill(particle_data[0], particle_data[1], particle_data[2], particle_data[3])
 
         self.kernels = []
         for i in range(self.nmodel):
@@ -394,19 +795,53 @@ class Abcsmc:
             for j in range(len(particle_data[4][i])):
                 self.kernels[i].append(particle_data[4][i][j])
 
+        old_format = any(len(kernel) < 4 for kernel in self.kernels)
+        if old_format:
+            self.kernels = [[kernel[0], kernel[1], 0, None] for kernel in self.kernels]
+        self.restore_derived_state(rebuild_kernels=old_format)
+
+    def restart_from_checkpoint(self, reader, index=-1):
+        """Restore the state needed to carry on from a population of a checkpoint store.
+
+        Only that population is read, straight into the population arrays; earlier populations are not loaded.
+
+        Parameters
+        ----------
+        reader : a checkpoint.ResultsReader, e.g. from InputOutput.read_results
+        index : the population to restart from; by default the last one
+        """
+        models, weights, parameters, margins, kernel = reader.store.restart_arrays(index)
+        self.population_prev.fill_arrays(models, weights, parameters, margins)
+        self.kernels = [list(k) for k in kernel]
+        self.restore_derived_state()
+
+    def restore_derived_state(self, rebuild_kernels=False):
+        """Recompute what is derived from the previous population and kernels after they are restored.
+
+        Parameters
+        ----------
+        rebuild_kernels : if True the kernels are also built again from the population, see update_kernels
+        """
         self.sample_from_prior = False
 
         # you gotta fill the dead models too
         self.dead_models = []
-        nonDeadModelNumbers = list(set(self.model_prev))
+        nonDeadModelNumbers = list(set(self.population_prev.models))
         assert len(self.dead_models) == 0, ValueError('Oh no, I had some existing dead models! %s' % self.dead_models)
         for j in range(self.nmodel):
             isDead = False
-            if self.margins_prev[j] < 1e-6:
+            if self.population_prev.margins[j] < 1e-6:
                 self.dead_models.append(j)
                 isDead = True
             assert (isDead or j in nonDeadModelNumbers), RuntimeError('Model %d is neither dead nor alive' % j)
 
+        if rebuild_kernels:
+            self.update_kernels(rebuild=True)
+            return
+        # the kernel auxilliary information is not stored, as it follows from the particles and kernels
+        self.kernel_aux = kernels.get_auxilliary_info(self.kernel_type, self.population_prev, self.models,
+                                                      self.kernels, **self.mvnormcdf_options)[:]
+
     def simulate_and_compare_to_data(self, sampled_models_indexes, sampled_params, epsilon, do_comp=True):
         """
         Perform simulations:
@@ -433,8 +868,14 @@ class Abcsmc:
         traj = [[] for _ in range(self.nbatch)]
         distances = [0 for _ in range(self.nbatch)]
 
+        if not self.backend.started:
+            self.backend.start(self.models, self.model_data, self.debug)
+
         model_indexes = np.array(sampled_models_indexes)
 
+        # submit the simulations for every model before waiting on any of them, so that backends can run them all
+        # concurrently
+        pending = []
         for model_index in range(self.nmodel):
 
             # create a list of indexes for the simulations corresponding to this model
@@ -451,46 +892,43 @@ class Abcsmc:
             this_model_parameters = []
             for i in range(num_simulations):
                 this_model_parameters.append(sampled_params[mapping[i]])
-            try:
-                sims = self.models[model_index].simulate(this_model_parameters)
-                doh_fail = False
-                if self.debug == 2:
-                    print('\t\t\tsimulation dimensions:', sims.shape)
 
-            except:
-                print('SIMULATION FAILEDD!')
-                sims = None
-                doh_fail = True
-
-            for i in range(num_simulations):
-                # store the trajectories and distances in a list of length beta
-                simulation_number = mapping[i]
+            with self.timings.stage('backend'):
+                pending.append((mapping, self.backend.map(model_index, this_model_parameters, epsilon, do_comp)))
 
-                if doh_fail:
-                    dist = False
-                    distance = np.inf
-                else:
-                    sample_points = sims[i]#ABC not sure I need to explicity define the second dimension of this guy
-                    if do_comp:
-                        model = self.models[model_index]
+        for mapping, futures in pending:
+            with self.timings.stage('backend'):
+                this_accepted, this_distances, this_traj, stats = executors.collect(futures)
+            self.timings.add('simulate', stats[0], len(futures))
+            self.timings.add('distance', stats[1], len(futures))
+            self.timings.count('aborted', stats[2])
+            for i, simulation_number in enumerate(mapping):
+                accepted[simulation_number] = this_accepted[i]
+                distances[simulation_number] = this_distances[i]
+                traj[simulation_number] = this_traj[i]
 
-                        distance = model.distance(sample_points, self.data, this_model_parameters[i], None)
-                        dist = check_below_threshold(distance, epsilon)
-                    else:
-                        distance = 0
-                        dist = True
+        return accepted, distances, traj
 
-                if dist:
-                    accepted[simulation_number] += 1
+    def proposal_sampler(self):
+        """Return a proposals.ProposalSampler drawing proposals from the current previous population and kernels."""
+        return proposals.ProposalSampler(self.models, self.modelprior, self.modelKernel, self.kernel_type,
+                                         self.special_cases, self.population_prev, self.kernels, self.dead_models,
+                                         self.perturbfn, self.batchperturbfn, self.debug)
 
-                if self.debug == 2:
-                    print('\t\t\tdistance/this_epsilon/mapping/b:', distance, epsilon, \
-                        simulation_number, accepted[simulation_number])
+    def propose_and_simulate(self, epsilon, prior):
+        """Have a backend that draws its own proposals draw, simulate and compare a batch of self.nbatch.
 
-                traj[simulation_number] = sample_points
-                distances[simulation_number] = distance
-
-        return accepted, distances, traj
+        Returns
+        -------
+        sampled_models_indexes, sampled_params, accepted, distances, traj
+        """
+        with self.timings.stage('backend'):
+            models, params, accepted, distances, traj, stats = executors.collect_proposals(
+                self.backend.map_proposals(self.nbatch, epsilon, prior))
+        self.timings.add('simulate', stats[0])
+        self.timings.add('distance', stats[1])
+        self.timings.count('aborted', stats[2])
+        return models, params, accepted, distances, traj
 
     def sample_model_from_prior(self):
         """
@@ -498,133 +936,37 @@ class Abcsmc:
          self.modelprior
 
         """
-        models = [0] * self.nbatch
-        if self.nmodel > 1:
-            for i in range(self.nbatch):
-                models[i] = statistics.w_choice(self.modelprior)
-
-        return models
+        return self.proposal_sampler().sample_models_from_prior(self.nbatch)
 
     def sample_model(self):
         """
         Returns a list of model numbers, of length self.nbatch, obtained by sampling from a categorical distribution
         with probabilities self.modelprior, and then perturbing with a uniform model perturbation kernel.
         """
-
-        models = [0] * self.nbatch
-
-        if self.nmodel > 1:
-            # Sample models from prior distribution
-            for i in range(self.nbatch):
-                models[i] = statistics.w_choice(self.margins_prev)
-
-            # perturb models
-            if len(self.dead_models) < self.nmodel - 1:
-
-                for i in range(self.nbatch):
-                    u = rnd.uniform(low=0, high=1)
-
-                    if u > self.modelKernel:
-                        # sample randomly from other (non dead) models
-                        not_available = set(self.dead_models[:])
-                        not_available.add(models[i])
-
-                        available_indexes = np.array(list(set(range(self.nmodel)) - not_available))
-                        rnd.shuffle(available_indexes)
-                        perturbed_model = available_indexes[0]
-
-                        models[i] = perturbed_model
-
-        return models[:]
+        return self.proposal_sampler().sample_models(self.nbatch)
 
     def sample_parameters_from_prior(self, sampled_models_indexes):
         """
-        For each model whose index is in sampled_models, draw a sample of the corresponding parameters.
-
-        Parameters
-        ----------
-        sampled_models : a list of model indexes, of length self.nbatch
-
-        Returns
-        -------
-        a list of length self.nbatch, each entry of which is a list of parameter samples (whose length is
-                model.nparameters for the corresponding model)
-
+        For each model whose index is in sampled_models, draw a sample of the corresponding parameters; see
+        proposals.ProposalSampler.sample_parameters_from_prior.
         """
-        samples = []
-
-        for i in range(self.nbatch):
-            model = self.models[sampled_models_indexes[i]]
-            sample = [0] * model.nparameters
-
-            for param in range(model.nparameters):
-                if model.prior[param].type == PriorType.constant:
-                    sample[param] = model.prior[param].value
-
-                if model.prior[param].type == PriorType.normal:
-                    sample[param] = rnd.normal(loc=model.prior[param].mean, scale=np.sqrt(model.prior[param].variance))
-
-                if model.prior[param].type == PriorType.uniform:
-                    sample[param] = rnd.uniform(low=model.prior[param].lower_bound, high=model.prior[param].upper_bound)
-
-                if model.prior[param].type == PriorType.lognormal:
-                    sample[param] = rnd.lognormal(mean=model.prior[param].mu, sigma=np.sqrt(model.prior[param].sigma))
-
-            samples.append(sample[:])
-
-        return samples
+        return self.proposal_sampler().sample_parameters_from_prior(sampled_models_indexes)
 
     def sample_parameters(self, sampled_models_indexes):
         """
-        For each model index in sampled_models_indexes, sample a set of parameters by sampling a particle from
-        the corresponding model (with probability biased by the particle weights), and then perturbing using the
-        parameter perturbation kernel; if this gives parameters with probability <=0 the process is repeated.
-
-        Parameters
-        ----------
-        sampled_models_indexes : a list of model indexes, of length self.nbatch
-
-
-        Returns
-        -------
-        a list of length self.nbatch, each entry of which is a list of parameter samples (whose length is
-            model.nparameters for the corresponding model)
-
+        For each model index in sampled_models_indexes, sample a set of parameters by perturbing a particle of the
+        previous population; see proposals.ProposalSampler.sample_parameters.
         """
-        if self.debug == 2:
-            print("\t\t\t***sampleTheParameter")
-        samples = []
+        return self.proposal_sampler().sample_parameters(sampled_models_indexes)
 
-        for i in range(self.nbatch):
-            model = self.models[sampled_models_indexes[i]]
-            model_num = sampled_models_indexes[i]
+    def sample_particle_from_model(self, model_num):
+        """Select a particle of the previous population whose model is model_num, weighted by its weight, and return
+        its slot; see ParticlePopulation.sample_particles."""
+        return self.population_prev.sample_particles(model_num, 1)[0]
 
-            num_params = model.nparameters
-            sample = [0] * num_params
-
-            prior_prob = -1
-            while prior_prob <= 0:
-
-                # sample putative particle from previous population
-                particle = sample_particle_from_model(self.nparticles, model_num, self.margins_prev, self.model_prev,
-                                                      self.weights_prev)
-
-                # Copy this particle's params into a new array, then perturb this in place using the parameter
-                #  perturbation kernel ALI
-                for param in range(num_params):
-                    sample[param] = self.parameters_prev[particle][param]
-
-                prior_prob = self.perturbfn(sample, model.prior, self.kernels[model_num],
-                                            self.kernel_type, self.special_cases[model_num])
-
-                if self.debug == 2:
-                    print("\t\t\tsampled p prob:", prior_prob)
-                    print("\t\t\tnew:", sample)
-                    print("\t\t\told:", self.parameters_prev[particle])
-
-            samples.append(sample)
-
-        return samples
+    def perturb_one_particle(self, model_num, particle):
+        """Perturb a single particle with self.perturbfn, resampling it until the prior probability is positive."""
+        return self.proposal_sampler().perturb_one_particle(model_num, particle)
 
     def compute_particle_weights(self):
         r"""Calculate the weight of each particle.
@@ -639,16 +981,73 @@ class Abcsmc:
         if self.debug == 2:
             print("\t***computeParticleWeights")
 
+        if self.kernellogpdffn is None:
+            self.compute_particle_weights_pairwise()
+            return
+
+        # Work in log space throughout: with many particles and parameters the products of densities underflow.
+        curr = self.population_curr
+        prev = self.population_prev
+        log_weights = np.full(self.nparticles, -np.inf)
+
+        with np.errstate(divide='ignore'):
+            log_b = np.log(curr.b)
+            log_weights_prev = np.log(prev.weights)
+            log_margins_prev = np.log(prev.margins)
+            log_modelprior = np.log(np.array(self.modelprior, dtype=float))
+
+        for model_num in range(self.nmodel):
+            curr_index = curr.model_indexes(model_num)
+            prev_index = prev.model_indexes(model_num)
+            if len(curr_index) == 0 or len(prev_index) == 0:
+                continue
+            model = self.models[model_num]
+
+            this_params = curr.parameters[model_num][curr_index]
+            prev_params = prev.parameters[model_num][prev_index]
+            prev_aux = [self.kernel_aux[j] for j in prev_index]
+
+            s1 = 0
+            for i in range(self.nmodel):
+                s1 += prev.margins[i] * get_model_kernel_pdf(model_num, i, self.modelKernel, self.nmodel,
+                                                             self.dead_models)
+
+            log_kernel = self.kernellogpdffn(this_params, prev_params, model.prior, self.kernels[model_num],
+                                             prev_aux, self.kernel_type)
+            log_s2 = logsumexp(log_kernel + log_weights_prev[prev_index][np.newaxis, :], axis=1)
+
+            log_numerator = log_b[curr_index] + log_modelprior[model_num] + model.compiled_prior.log_pdf(this_params)
+            if self.debug == 2:
+                print("\tmodel/log numer/s1/log s2 : ", model_num, log_numerator, s1, log_s2)
+
+            log_weights[curr_index] = log_margins_prev[model_num] + log_numerator - np.log(s1) - log_s2
+
+        # shift by the largest log weight before leaving log space; normalize_weights removes the shift
+        finite = np.isfinite(log_weights)
+        if np.any(finite):
+            log_weights -= np.max(log_weights[finite])
+        curr.weights[:] = np.exp(log_weights)
+
+    def compute_particle_weights_pairwise(self):
+        """Calculate the weight of each particle by evaluating self.kernelpdffn for every pair of particles.
+
+        This is the reference implementation of compute_particle_weights, used when no batched kernel log pdf is set.
+        """
+        curr = self.population_curr
+        prev = self.population_prev
+        # the position of the previous particle in the kernel is passed to kernelpdffn only if it takes it; custom ones
+        # written before it did keep working with the kernels that do not need it
+        takes_index = kernels.accepts_keyword(self.kernelpdffn, 'index0')
         for k in range(self.nparticles):
-            model_num = self.model_curr[k]
+            model_num = curr.models[k]
             model = self.models[model_num]
 
-            this_param = self.parameters_curr[k]
+            this_param = list(curr.get_parameters(k))
 
             model_prior = self.modelprior[model_num]
 
             particle_prior = 1
-            for n in range(len(self.parameters_curr[k])):
+            for n in range(len(this_param)):
                 x = 1.0
                 this_prior = model.prior[n]
 
@@ -665,49 +1064,48 @@ class Abcsmc:
                     x = statistics.get_pdf_lognormal(this_prior.mu, np.sqrt(this_prior.sigma), this_param[n])
                 particle_prior = particle_prior * x
 
-            # self.b[k] is a variable indicating whether the simulation corresponding to particle k was accepted
-            numerator = self.b[k] * model_prior * particle_prior
+            # curr.b[k] is a variable indicating whether the simulation corresponding to particle k was accepted
+            numerator = curr.b[k] * model_prior * particle_prior
 
             s1 = 0
             for i in range(self.nmodel):
-                s1 += self.margins_prev[i] * get_model_kernel_pdf(model_num, i, self.modelKernel, self.nmodel,
-                                                                  self.dead_models)
+                s1 += prev.margins[i] * get_model_kernel_pdf(model_num, i, self.modelKernel, self.nmodel,
+                                                             self.dead_models)
             s2 = 0
             for j in range(self.nparticles):
-                if int(model_num) == int(self.model_prev[j]):
+                if int(model_num) == int(prev.models[j]):
+                    prev_param = list(prev.get_parameters(j))
+                    kwds = {'index0': prev.model_position[j]} if takes_index else {}
 
                     if self.debug == 2:
-                        print("\tj, weights_prev, kernelpdf", j, self.weights_prev[j],)
-                        self.kernelpdffn(this_param, self.parameters_prev[j], model.prior,
-                                         self.kernels[model_num], self.kernel_aux[j], self.kernel_type)
+                        print("\tj, weights_prev, kernelpdf", j, prev.weights[j],)
+                        self.kernelpdffn(this_param, prev_param, model.prior,
+                                         self.kernels[model_num], self.kernel_aux[j], self.kernel_type, **kwds)
 
-                    kernel_pdf = self.kernelpdffn(this_param, self.parameters_prev[j], model.prior,
-                                                  self.kernels[model_num], self.kernel_aux[j], self.kernel_type)
-                    s2 += self.weights_prev[j] * kernel_pdf
+                    kernel_pdf = self.kernelpdffn(this_param, prev_param, model.prior,
+                                                  self.kernels[model_num], self.kernel_aux[j], self.kernel_type, **kwds)
+                    s2 += prev.weights[j] * kernel_pdf
 
                 if self.debug == 2:
-                    print("\tnumer/s1/s2/m(t-1) : ", numerator, s1, s2, self.margins_prev[model_num])
+                    print("\tnumer/s1/s2/m(t-1) : ", numerator, s1, s2, prev.margins[model_num])
 
-            self.weights_curr[k] = self.margins_prev[model_num] * numerator / (s1 * s2)
+            curr.weights[k] = prev.margins[model_num] * numerator / (s1 * s2)
 
     def normalize_weights(self):
         """Normalize weights by dividing each by the total."""
-        n = sum(self.weights_curr)
-        for i in range(self.nparticles):
-            self.weights_curr[i] /= float(n)
+        self.population_curr.normalize_weights()
 
     def update_model_marginals(self):
         """Re-calculate the marginal probability of each model as the sum of the weights of the corresponding particles."""
-        for model in range(self.nmodel):
-            self.margins_curr[model] = 0
-            for particle in range(self.nparticles):
-                if int(self.model_curr[particle]) == int(model):
-                    self.margins_curr[model] += self.weights_curr[particle]
+        self.population_curr.update_margins()
 
 
 def sample_particle_from_model(nparticle, selected_model, margins_prev, model_prev, weights_prev):
     """Select a particle from those in the previous generation whose model was the currently selected model, weighted by their previous weight.
 
+    Abcsmc samples whole batches with ParticlePopulation.sample_particles; this draws a single particle from a
+    population held as lists.
+
     Parameters
     ----------
     nparticle : number of particles
@@ -721,16 +1119,13 @@ def sample_particle_from_model(nparticle, selected_model, margins_prev, model_pr
     -------
     the index of the selected particle
     """
-
-    u = rnd.uniform(low=0, high=margins_prev[selected_model])
-    f = 0
-
-    for i in range(nparticle):
-        if int(model_prev[i]) == int(selected_model):
-            f = f + weights_prev[i]
-            if f > u:
-                return i
-    return nparticle - 1
+    index = np.flatnonzero(np.asarray(model_prev[:nparticle], dtype=int) == int(selected_model))
+    cdf = np.cumsum(np.asarray(weights_prev, dtype=float)[index])
+    u = np.random.uniform(low=0, high=margins_prev[selected_model])
+    position = np.searchsorted(cdf, u, side='right')
+    if position >= len(index):
+        return nparticle - 1
+    return int(index[position])
 
 
 def get_model_kernel_pdf(new_model, old_model, model_k, num_models, dead_models):
@@ -757,14 +1152,3 @@ def get_model_kernel_pdf(new_model, old_model, model_k, num_models, dead_models)
             return model_k
         else:
             return (1 - model_k) / (num_models - num_dead_models)
-
-
-def check_below_threshold(distance, epsilon):
-    """Return true if each element of distance is less than the corresponding entry of epsilon (and non-negative).
-
-    Parameters
-    ----------
-    distance : list of distances
-    epsilon : list of maximum acceptable distances
-    """
-    return distance < epsilon
@@ -0,0 +1,446 @@
+from __future__ import print_function
+import atexit
+import json
+import os
+import pickle
+import queue
+import shutil
+import sys
+import threading
+import time
+import numpy as np
+from .statistics import FactorizedGaussian
+
+
+# A checkpoint store is a folder holding one segment per population plus a manifest:
+#
+#   manifest.json
+#   population_0000/models.npy, weights.npy, margins.npy, distances.npy, parameters_<model>.npy,
+#                   kernels.pkl, kernel_<model>.npy, trajectories.npy (or trajectories.pkl if they are not a regular
+#                   array)
+#   population_0001/...
+#
+# Each population is written once, to a temporary folder which is renamed into place, and only then added to the
+# manifest, which is itself replaced by rename. A crash at any point therefore leaves the manifest describing the
+# populations that were completely written, and checkpointing costs the size of one population, not of the whole run.
+
+MANIFEST = 'manifest.json'
+VERSION = 1
+
+
+def _fsync_write(path, write):
+    """Write a file with write(file_object), and make sure it is on disk before returning."""
+    with open(path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def save_trajectories(folder, trajectories, name='trajectories'):
+    """Save trajectories as a .npy array if they have a regular numeric shape, otherwise pickle them.
+
+    Returns
+    -------
+    the name of the file written, or None if trajectories is None
+    """
+    if trajectories is None:
+        return None
+    try:
+        array = np.asarray(trajectories, dtype=float)
+    except (ValueError, TypeError):
+        array = None
+    if array is not None and array.ndim > 0 and array.shape[0] == len(trajectories):
+        _fsync_write(os.path.join(folder, name + '.npy'), lambda f: np.save(f, array))
+        return name + '.npy'
+    _fsync_write(os.path.join(folder, name + '.pkl'),
+                 lambda f: pickle.dump(list(trajectories), f, pickle.HIGHEST_PROTOCOL))
+    return name + '.pkl'
+
+
+def load_trajectories(path, mmap_mode=None):
+    """Load trajectories saved by save_trajectories; see numpy.load for mmap_mode."""
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode=mmap_mode)
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+class CheckpointStore(object):
+
+    """Append-only store of the populations of a run, one segment folder per population.
+
+    Arrays are stored as .npy files, so that they can be read back memory-mapped. The covariances of the multivariate
+    normal kernels are stored that way too, without their factors, which are computed again when they are loaded; the
+    rest of the kernels, and trajectories that are not a regular array, are pickled.
+
+    """
+
+    def __init__(self, folder):
+        """Init.
+
+        Input:
+            folder: the folder of the store; it is created if it does not exist, and if it already holds a store
+                the new populations are appended to it
+        """
+        self.folder = folder
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.manifest = self.read_manifest()
+
+    def read_manifest(self):
+        """Return the manifest on disk, or an empty one if there is none."""
+        path = os.path.join(self.folder, MANIFEST)
+        if not os.path.exists(path):
+            return {'version': VERSION, 'populations': []}
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _write_manifest(self):
+        path = os.path.join(self.folder, MANIFEST)
+        data = json.dumps(self.manifest, indent=1, sort_keys=True).encode('utf-8')
+        _fsync_write(path + '.tmp', lambda f: f.write(data))
+        os.replace(path + '.tmp', path)
+
+    def __len__(self):
+        return len(self.manifest['populations'])
+
+    def append(self, results, population, kernels):
+        """Write one population as a new segment, and add it to the manifest.
+
+        Parameters
+        ----------
+        results : the AbcsmcResults of the population
+        population : the ParticlePopulation of the accepted particles
+        kernels : the kernels built from the population, one list per model
+
+        Returns
+        -------
+        the index of the population in the store
+        """
+        index = len(self)
+        name = 'population_%04d' % index
+        final = os.path.join(self.folder, name)
+        tmp = final + '.tmp'
+        # a segment left over from a crash was never added to the manifest, so it can go
+        for path in [tmp, final]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        os.mkdir(tmp)
+
+        arrays = {
+            'models': population.models,
+            'weights': population.weights,
+            'margins': population.margins,
+            'distances': np.asarray(results.distances, dtype=float),
+        }
+        for model_index in range(population.nmodel):
+            arrays['parameters_%d' % model_index] = population.model_parameters(model_index)
+        for key, array in arrays.items():
+            _fsync_write(os.path.join(tmp, key + '.npy'), lambda f, array=array: np.save(f, array))
+
+        # the covariances of the multivariate normal kernels can be an (nparticles, d, d) stack, so they are saved as
+        # arrays rather than pickled with their factors
+        pickled = []
+        kernel_arrays = []
+        for model_index, kernel in enumerate(kernels):
+            if kernel[3] is None:
+                pickled.append(list(kernel))
+                continue
+            covariance = np.asarray(kernel[2], dtype=float)
+            _fsync_write(os.path.join(tmp, 'kernel_%d.npy' % model_index),
+                         lambda f, covariance=covariance: np.save(f, covariance))
+            pickled.append([kernel[0], kernel[1], None, None])
+            kernel_arrays.append(model_index)
+        _fsync_write(os.path.join(tmp, 'kernels.pkl'), lambda f: pickle.dump(pickled, f, pickle.HIGHEST_PROTOCOL))
+        trajectories = save_trajectories(tmp, results.trajectories)
+
+        os.replace(tmp, final)
+
+        self.manifest['populations'].append({
+            'index': index,
+            'folder': name,
+            'epsilon': float(results.epsilon),
+            'naccepted': int(results.naccepted),
+            'sampled': int(results.sampled),
+            'rate': float(results.rate),
+            'nparticles': int(population.nparticles),
+            'nparameters': [int(n) for n in population.nparameters],
+            'trajectories': trajectories,
+            'kernel_arrays': kernel_arrays,
+            'trajectory_indexes': None if results.trajectory_indexes is None else
+            [int(i) for i in results.trajectory_indexes],
+        })
+        self._write_manifest()
+        return index
+
+    def entry(self, index):
+        """Return the manifest entry of a population; negative indexes count from the last population."""
+        return self.manifest['populations'][index]
+
+    def population_path(self, index, name):
+        """Return the path of a file of the segment of a population."""
+        return os.path.join(self.folder, self.entry(index)['folder'], name)
+
+    def load_array(self, index, name, mmap_mode=None):
+        """Load one array of a population, e.g. 'weights' or 'parameters_0'; see numpy.load for mmap_mode."""
+        return np.load(self.population_path(index, name + '.npy'), mmap_mode=mmap_mode)
+
+    def load_kernels(self, index):
+        """Load the kernels built from a population, factorizing the covariances of the multivariate normal kernels."""
+        with open(self.population_path(index, 'kernels.pkl'), 'rb') as f:
+            kernels = pickle.load(f)
+        for model_index in self.entry(index).get('kernel_arrays', []):
+            covariance = np.load(self.population_path(index, 'kernel_%d.npy' % model_index))
+            kernels[model_index][2] = covariance
+            kernels[model_index][3] = FactorizedGaussian(covariance)
+        return kernels
+
+    def load_trajectories(self, index, mmap_mode=None):
+        """Load the trajectories of the accepted particles of a population, or None if they were not kept."""
+        name = self.entry(index)['trajectories']
+        if name is None:
+            return None
+        return load_trajectories(self.population_path(index, name), mmap_mode)
+
+    def restart_arrays(self, index=-1, mmap_mode=None):
+        """Return the state needed to restart from a population as arrays, without converting them to lists.
+
+        Returns
+        -------
+        models, weights, parameters, margins, kernels; parameters being a list with the parameter array of each model
+        """
+        entry = self.entry(index)
+        parameters = [self.load_array(index, 'parameters_%d' % model_index, mmap_mode=mmap_mode)
+                      for model_index in range(len(entry['nparameters']))]
+        return (self.load_array(index, 'models', mmap_mode=mmap_mode), self.load_array(index, 'weights', mmap_mode),
+                parameters, self.load_array(index, 'margins', mmap_mode), self.load_kernels(index))
+
+    def restart_data(self, index=-1):
+        """Return the state needed to restart from a population, in the form expected by Abcsmc.fill_values.
+
+        Returns
+        -------
+        [models, weights, parameters, margins, kernels], parameters being a list with one list per particle
+        """
+        entry = self.entry(index)
+        models = self.load_array(index, 'models')
+        parameters = [None] * len(models)
+        for model_index in range(len(entry['nparameters'])):
+            model_parameters = self.load_array(index, 'parameters_%d' % model_index).tolist()
+            for slot, params in zip(np.flatnonzero(models == model_index), model_parameters):
+                parameters[slot] = params
+        return [models.tolist(), self.load_array(index, 'weights').tolist(), parameters,
+                self.load_array(index, 'margins').tolist(), self.load_kernels(index)]
+
+
+class CheckpointResults(object):
+
+    """The results of one population of a checkpoint store, loaded lazily.
+
+    This has the attributes of AbcsmcResults. The scalars come from the manifest; the arrays are memory-mapped from
+    the segment the first time they are used, and trajectories are read from disk every time they are accessed, so
+    that holding many of these costs next to no memory.
+
+    """
+
+    def __init__(self, store, index, mmap_mode='r'):
+        """Init.
+
+        Input:
+            store: the CheckpointStore
+            index: the index of the population in the store
+            mmap_mode: passed to numpy.load for the arrays; None reads them into memory
+        """
+        entry = store.entry(index)
+        self.store = store
+        self.index = entry['index']
+        self.mmap_mode = mmap_mode
+        self.naccepted = entry['naccepted']
+        self.sampled = entry['sampled']
+        self.rate = entry['rate']
+        self.epsilon = entry['epsilon']
+        self.nparameters = entry['nparameters']
+        self.trajectory_indexes = entry.get('trajectory_indexes')
+        self._arrays = {}
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = self.store.load_array(self.index, name, mmap_mode=self.mmap_mode)
+        return self._arrays[name]
+
+    @property
+    def margins(self):
+        return self._array('margins')
+
+    @property
+    def models(self):
+        return self._array('models')
+
+    @property
+    def weights(self):
+        return self._array('weights')
+
+    @property
+    def distances(self):
+        return self._array('distances')
+
+    @property
+    def trajectories(self):
+        return self.store.load_trajectories(self.index, mmap_mode=self.mmap_mode)
+
+    def model_parameters(self, model_index):
+        """Return the parameters of the particles of one model, shape (n, nparameters of the model)."""
+        return self._array('parameters_%d' % model_index)
+
+    @property
+    def parameters(self):
+        """The parameters of every particle, in the same form as AbcsmcResults.parameters; this is read into memory."""
+        models = np.asarray(self.models)
+        if len(set(self.nparameters)) == 1:
+            ret = np.empty((len(models), self.nparameters[0]))
+        else:
+            ret = np.empty(len(models), dtype=object)
+        for model_index in range(len(self.nparameters)):
+            slots = np.flatnonzero(models == model_index)
+            model_parameters = self.model_parameters(model_index)
+            if ret.dtype == object:
+                for slot, params in zip(slots, model_parameters):
+                    ret[slot] = np.array(params)
+            else:
+                ret[slots] = model_parameters
+        return ret
+
+
+class ResultsReader(object):
+
+    """Read-only access to the populations of a checkpoint store, as a sequence of CheckpointResults.
+
+    This can be used in place of the list returned by Abcsmc.run_schedule, e.g. with the functions in plotter, and
+    with Abcsmc.restart_from_checkpoint.
+
+    """
+
+    def __init__(self, folder, mmap_mode='r'):
+        """Init.
+
+        Input:
+            folder: the folder of the checkpoint store
+            mmap_mode: passed to numpy.load for the arrays; None reads them into memory
+        """
+        if not os.path.exists(os.path.join(folder, MANIFEST)):
+            raise IOError('No checkpoint manifest in %s' % folder)
+        self.store = CheckpointStore(folder)
+        self.mmap_mode = mmap_mode
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return CheckpointResults(self.store, index, self.mmap_mode)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def kernels(self, index=-1):
+        """Return the kernels built from a population."""
+        return self.store.load_kernels(index)
+
+
+class CheckpointWriteError(IOError):
+
+    """Raised when a population could not be written to a checkpoint store."""
+
+
+class BackgroundWriter(object):
+
+    """Run write jobs in order on a background thread, so that the caller can carry on while they are written.
+
+    At most max_pending jobs are queued: submit blocks while the queue is full, which bounds the memory held by
+    snapshots waiting to be written. The writer is also flushed when the interpreter exits.
+
+    Once a job raises an exception the writer fails: the jobs still queued are not run, as they would be written out
+    of order, and every later call to submit, flush or close raises that exception.
+
+    """
+
+    def __init__(self, max_pending=1):
+        """Init.
+
+        Input:
+            max_pending: maximum number of jobs waiting to be written
+        """
+        self.max_pending = max_pending
+        self.queue = queue.Queue(maxsize=max_pending)
+        # the exception of the job that failed, with its traceback, and whether it has been raised to the caller yet
+        self.error = None
+        self.error_traceback = None
+        self.error_raised = False
+        self.nwrites = 0
+        self.write_time = 0.0
+        self.blocked_time = 0.0
+        self.thread = threading.Thread(target=self._run, name='checkpoint-writer')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self._close_at_exit)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self.error is None:
+                    start = time.time()
+                    job[0](*job[1])
+                    self.write_time += time.time() - start
+                    self.nwrites += 1
+            except Exception as e:
+                self.error = e
+                self.error_traceback = sys.exc_info()[2]
+            finally:
+                self.queue.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            self.error_raised = True
+            # raised from where the job failed each time, rather than piling up the tracebacks of every call
+            raise self.error.with_traceback(self.error_traceback)
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) to be run on the writer thread, blocking while max_pending jobs are already queued."""
+        self._raise()
+        if not self.thread.is_alive():
+            raise RuntimeError('the checkpoint writer has been closed')
+        start = time.time()
+        self.queue.put((fn, args))
+        self.blocked_time += time.time() - start
+        # the job that was running while this one waited may have failed, in which case this one will never run
+        self._raise()
+
+    def flush(self):
+        """Wait until every queued job has been written."""
+        start = time.time()
+        self.queue.join()
+        self.blocked_time += time.time() - start
+        self._raise()
+
+    def close(self):
+        """Flush, then stop the writer thread."""
+        # the exit hook would otherwise keep the writer, and what it references, alive until the interpreter exits
+        atexit.unregister(self._close_at_exit)
+        if self.thread.is_alive():
+            self.queue.join()
+            self.queue.put(None)
+            self.thread.join()
+        self._raise()
+
+    def _close_at_exit(self):
+        try:
+            self.close()
+        except Exception:
+            # an error the caller has already been given is not reported again as the interpreter exits
+            if not self.error_raised:
+                raise
@@ -0,0 +1,105 @@
+import numpy as np
+from numpy import random as rnd
+from abcsmcbare import statistics
+from .PriorType import PriorType
+
+
+class CompiledPrior(object):
+
+    """The priors of one model, grouped by PriorType so that they can be sampled and evaluated a batch at a time.
+
+    Rather than branching on the type of every parameter for every particle, the parameters are split into one
+    group per PriorType up front, and each group is drawn or evaluated with a single NumPy call over the whole batch.
+
+    """
+
+    def __init__(self, priors):
+        """Init.
+
+        Input:
+            priors: list of Prior namedtuples, one per parameter
+        """
+        self.nparameters = len(priors)
+
+        def indexes(prior_type):
+            return np.array([i for i, p in enumerate(priors) if p.type == prior_type], dtype=int)
+
+        self.constant_index = indexes(PriorType.constant)
+        self.constant_value = np.array([priors[i].value for i in self.constant_index], dtype=float)
+
+        self.normal_index = indexes(PriorType.normal)
+        self.normal_mean = np.array([priors[i].mean for i in self.normal_index], dtype=float)
+        self.normal_scale = np.sqrt(np.array([priors[i].variance for i in self.normal_index], dtype=float))
+
+        self.uniform_index = indexes(PriorType.uniform)
+        self.uniform_lower = np.array([priors[i].lower_bound for i in self.uniform_index], dtype=float)
+        self.uniform_upper = np.array([priors[i].upper_bound for i in self.uniform_index], dtype=float)
+
+        # the sigma of a lognormal prior is the variance of the associated normal
+        self.lognormal_index = indexes(PriorType.lognormal)
+        self.lognormal_mu = np.array([priors[i].mu for i in self.lognormal_index], dtype=float)
+        self.lognormal_sigma = np.sqrt(np.array([priors[i].sigma for i in self.lognormal_index], dtype=float))
+
+        # the support of each parameter, e.g. for truncating perturbation kernels
+        self.lower_bound = np.full(self.nparameters, -np.inf)
+        self.upper_bound = np.full(self.nparameters, np.inf)
+        self.lower_bound[self.constant_index] = self.constant_value
+        self.upper_bound[self.constant_index] = self.constant_value
+        self.lower_bound[self.uniform_index] = self.uniform_lower
+        self.upper_bound[self.uniform_index] = self.uniform_upper
+        self.lower_bound[self.lognormal_index] = 0
+
+    def sample(self, n):
+        """Draw n particles from the prior.
+
+        Returns
+        -------
+        an array of shape (n, nparameters)
+        """
+        ret = np.empty((n, self.nparameters))
+        ret[:, self.constant_index] = self.constant_value
+        ret[:, self.normal_index] = rnd.normal(loc=self.normal_mean, scale=self.normal_scale,
+                                               size=(n, len(self.normal_index)))
+        ret[:, self.uniform_index] = rnd.uniform(low=self.uniform_lower, high=self.uniform_upper,
+                                                 size=(n, len(self.uniform_index)))
+        ret[:, self.lognormal_index] = rnd.lognormal(mean=self.lognormal_mu, sigma=self.lognormal_sigma,
+                                                     size=(n, len(self.lognormal_index)))
+        return ret
+
+    def in_support(self, parameters):
+        """Return whether each particle has non-zero prior density.
+
+        Parameters
+        ----------
+        parameters : array of particles, shape (n, nparameters)
+
+        Returns
+        -------
+        a boolean array of length n
+        """
+        parameters = np.asarray(parameters, dtype=float)
+        uniform = parameters[:, self.uniform_index]
+        ret = np.all((uniform >= self.uniform_lower) & (uniform <= self.uniform_upper), axis=1)
+        ret &= np.all(parameters[:, self.lognormal_index] > 0, axis=1)
+        return ret
+
+    def log_pdf(self, parameters):
+        """Evaluate the log prior density of a set of particles; constant parameters contribute nothing.
+
+        Parameters
+        ----------
+        parameters : array of particles, shape (n, nparameters)
+
+        Returns
+        -------
+        an array of length n
+        """
+        parameters = np.asarray(parameters, dtype=float)
+        ret = np.zeros(parameters.shape[0])
+        ret += np.sum(statistics.get_log_pdf_gauss(self.normal_mean, self.normal_scale,
+                                                   parameters[:, self.normal_index]), axis=1)
+        ret += np.sum(statistics.get_log_pdf_uniform(self.uniform_lower, self.uniform_upper,
+                                                     parameters[:, self.uniform_index]), axis=1)
+        ret += np.sum(statistics.get_log_pdf_lognormal(self.lognormal_mu, self.lognormal_sigma,
+                                                       parameters[:, self.lognormal_index]), axis=1)
+        return ret
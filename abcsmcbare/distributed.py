@@ -0,0 +1,384 @@
+from __future__ import print_function
+import argparse
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
+import pickle
+import socket
+import sys
+import threading
+from multiprocessing.connection import Client, Listener
+import numpy as np
+from .executors import SerialBackend, simulate_and_compare
+from .instrumentation import clock
+
+
+# A backend spreading the simulations over worker processes on any number of machines, connected over TCP.
+#
+# Abcsmc's process runs the coordinator: DistributedBackend listens on an address, and each worker connects to it,
+# receives the models and prepared data, and then repeatedly takes a task (a chunk of proposals of one model, with a
+# random seed), simulates and compares it, and sends back the result. Workers may join or leave at any time.
+#
+# Messages are pickled tuples over multiprocessing.connection, authenticated with authkey:
+#   worker -> coordinator: ('hello', name), ('heartbeat',), ('result', task id, result, last)
+#   coordinator -> worker: (models, data, debug, heartbeat interval), pickled once for all workers,
+#                          ('task', task id, model index, parameters, epsilon, do_comp, seed), ('stop',)
+# A worker sends heartbeats while it works on a task. If it disconnects, or is not heard from for heartbeat_timeout
+# seconds, it is dropped and its task is given to another worker; last in a result means the worker is leaving. On
+# shutdown, idle workers are sent ('stop',) and the connections of busy ones are closed, without waiting for their task.
+#
+# The models must be picklable, and the modules defining their functions importable by the workers.
+
+# how often, in seconds, the coordinator checks for a shutdown while it waits on a worker
+_POLL_INTERVAL = 0.1
+
+
+class WorkerLost(Exception):
+
+    """Raised by the coordinator when a worker stops responding, or does not follow the protocol."""
+
+
+class _Task(object):
+
+    __slots__ = ('id', 'model_index', 'parameters', 'epsilon', 'do_comp', 'seed', 'future', 'attempts')
+
+    def __init__(self, id, model_index, parameters, epsilon, do_comp, seed):
+        self.id = id
+        self.model_index = model_index
+        self.parameters = parameters
+        self.epsilon = epsilon
+        self.do_comp = do_comp
+        self.seed = seed
+        self.future = concurrent.futures.Future()
+        self.attempts = 0
+
+
+class DistributedBackend(SerialBackend):
+
+    """Run the simulations on worker processes that connect over TCP, possibly from other machines.
+
+    Start workers on other machines with
+
+        python -m abcsmcbare.distributed HOST PORT --authkey KEY --processes N
+
+    or, to try it out on one machine, let the backend start local_workers worker processes itself. Tasks wait until
+    a worker is available to take them, so a run with no workers waits for one to join.
+    """
+
+    def __init__(self, address=('localhost', 0), authkey=None, chunksize=1, local_workers=0,
+                 heartbeat_timeout=30.0, max_attempts=3):
+        """Init.
+
+        Input:
+            address: (host, port) to listen on; port 0 picks a free port, see self.address once started. Use
+                ('0.0.0.0', port) to accept workers from other machines.
+            authkey: bytes shared with the workers to authenticate connections; None generates a random printable
+                key, to pass to the workers with --authkey: see self.authkey, which is also printed with debug >= 1
+            chunksize: number of particles simulated per task
+            local_workers: number of worker processes to start on this machine
+            heartbeat_timeout: seconds without news from a worker busy with a task before it is dropped; workers
+                send a heartbeat every third of this
+            max_attempts: number of workers a task is given to before it fails, in case the task itself is what
+                brings them down
+        """
+        super(DistributedBackend, self).__init__(chunksize=chunksize)
+        self.requested_address = address
+        # hex digits, so that the key can be given on the command line of remote workers
+        self.authkey = authkey if authkey is not None else os.urandom(16).hex().encode('ascii')
+        self.local_workers = local_workers
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+
+        self.address = None
+        self.listener = None
+        self.setup = None
+        self.condition = threading.Condition()
+        self.pending = collections.deque()
+        self.task_ids = itertools.count()
+        # name -> the id of the task the worker is working on, or None
+        self.workers = {}
+        self.closing = False
+        self.threads = []
+        self.processes = []
+
+    def start(self, models, data, debug=0):
+        # pickle what every worker needs once, which also makes sure here that it can be
+        self.setup = pickle.dumps((models, data, debug, self.heartbeat_timeout / 3.0),
+                                  protocol=pickle.HIGHEST_PROTOCOL)
+        super(DistributedBackend, self).start(models, data, debug)
+        self.listener = Listener(self.requested_address, authkey=self.authkey)
+        self.address = self.listener.address
+        self.closing = False
+
+        # spawned rather than forked, so that they import the models as remote workers do, and do not inherit the
+        # listening socket, which would keep it open after shutdown
+        context = multiprocessing.get_context('spawn')
+        for i in range(self.local_workers):
+            process = context.Process(target=run_worker, args=(self.address, self.authkey))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+        self._start_thread(self._accept)
+        if self.debug >= 1:
+            print('### distributed backend listening on %s:%d, authkey %s'
+                  % (self.address + (self.authkey.decode('ascii', 'replace'),)))
+
+    def shutdown(self):
+        if self.listener is not None:
+            with self.condition:
+                self.closing = True
+                self.condition.notify_all()
+            # accept() is not interrupted by closing the listener, so wake it up with a connection of our own; from
+            # another thread, as a worker connecting at the same time may be accepted instead, leaving ours waiting
+            # until the listener is closed
+            waker = threading.Thread(target=self._wake)
+            waker.daemon = True
+            waker.start()
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+            self.listener.close()
+            self.listener = None
+            waker.join()
+
+            # the connections are closed, so idle local workers leave; one still busy with a simulation is stopped
+            for process in self.processes:
+                process.join(1.0)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+            self.processes = []
+
+            # nothing will run what is left, including the tasks workers were busy with
+            with self.condition:
+                while self.pending:
+                    future = self.pending.popleft().future
+                    if not future.cancel() and not future.done():
+                        future.set_exception(WorkerLost('the backend shut down'))
+        super(DistributedBackend, self).shutdown()
+
+    def submit(self, model_index, parameters, epsilon, do_comp=True):
+        """Queue a chunk of parameters for the next free worker, returning a future."""
+        seed = np.random.randint(0, 2 ** 31 - 1)
+        task = _Task(next(self.task_ids), model_index, parameters, epsilon, do_comp, seed)
+        with self.condition:
+            self.pending.append(task)
+            self.condition.notify()
+        return task.future
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def _wake(self):
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except Exception:
+            pass
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception as e:
+                # e.g. a client that failed to authenticate
+                if self.closing:
+                    return
+                print('### distributed backend: rejected a connection:', repr(e))
+                continue
+            if self.closing:
+                conn.close()
+                return
+            self._start_thread(self._serve, conn)
+
+    def _next_task(self):
+        """Wait for a task to hand out; None once the backend is shutting down."""
+        with self.condition:
+            while not self.closing:
+                while self.pending:
+                    task = self.pending.popleft()
+                    # a task being handed out for the first time may have been cancelled by Abcsmc in the meantime
+                    if task.attempts == 0 and not task.future.set_running_or_notify_cancel():
+                        continue
+                    task.attempts += 1
+                    return task
+                self.condition.wait()
+        return None
+
+    def _requeue(self, task):
+        """Give a task whose worker was lost to another one, at the front of the queue."""
+        with self.condition:
+            if task.future.done():
+                return
+            if task.attempts >= self.max_attempts and not self.closing:
+                task.future.set_exception(WorkerLost('task %d was lost by %d workers' % (task.id, task.attempts)))
+                return
+            self.pending.appendleft(task)
+            self.condition.notify()
+
+    def _serve(self, conn):
+        """Talk to one worker until it leaves, is lost, or the backend shuts down."""
+        name = None
+        task = None
+        try:
+            # a client that authenticated but does not introduce itself is dropped after heartbeat_timeout, rather than
+            # holding on to this thread
+            connected = clock()
+            while not conn.poll(_POLL_INTERVAL):
+                if self.closing:
+                    return
+                if clock() - connected > self.heartbeat_timeout:
+                    raise WorkerLost('no hello within %s s' % self.heartbeat_timeout)
+            message = conn.recv()
+            if not (isinstance(message, tuple) and len(message) == 2 and message[0] == 'hello'):
+                raise WorkerLost('expected a hello message, got %r' % (message,))
+            name = message[1]
+            conn.send_bytes(self.setup)
+            with self.condition:
+                self.workers[name] = None
+            if self.debug >= 1:
+                print('### distributed backend: worker %s joined' % name)
+
+            while True:
+                task = self._next_task()
+                if task is None:
+                    conn.send(('stop',))
+                    return
+                with self.condition:
+                    self.workers[name] = task.id
+                conn.send(('task', task.id, task.model_index, task.parameters, task.epsilon, task.do_comp,
+                           task.seed))
+
+                # wait for the result a little at a time, so that a shutdown does not wait for the task to finish
+                last_heard = clock()
+                while True:
+                    if self.closing:
+                        return
+                    if not conn.poll(min(_POLL_INTERVAL, self.heartbeat_timeout)):
+                        if clock() - last_heard > self.heartbeat_timeout:
+                            raise WorkerLost('no heartbeat for %s s' % self.heartbeat_timeout)
+                        continue
+                    message = conn.recv()
+                    last_heard = clock()
+                    if message[0] == 'result' and message[1] == task.id:
+                        break
+
+                finished, task = task, None
+                with self.condition:
+                    self.workers[name] = None
+                    if not finished.future.done():
+                        finished.future.set_result(message[2])
+                if message[3]:
+                    if self.debug >= 1:
+                        print('### distributed backend: worker %s left' % name)
+                    return
+
+        except (EOFError, IOError, OSError, WorkerLost) as e:
+            if not self.closing:
+                print('### distributed backend: lost worker %s:' % name, repr(e))
+        finally:
+            if task is not None:
+                self._requeue(task)
+            with self.condition:
+                self.workers.pop(name, None)
+            conn.close()
+
+
+def run_worker(address, authkey, name=None, max_tasks=None):
+    """Connect to a DistributedBackend and run its tasks until it shuts down.
+
+    Parameters
+    ----------
+    address : (host, port) of the backend
+    authkey : its authkey
+    name : name of the worker in messages; by default host:pid
+    max_tasks : leave after this many tasks; None to stay until the backend shuts down
+
+    Returns
+    -------
+    the number of tasks run
+    """
+    if name is None:
+        name = '%s:%d' % (socket.gethostname(), os.getpid())
+    # forked workers inherit the parent's random state; every task is seeded, but reseed anyway
+    np.random.seed()
+    conn = Client(tuple(address), authkey=authkey)
+    conn.send(('hello', name))
+    models, data, debug, heartbeat_interval = pickle.loads(conn.recv_bytes())
+
+    lock = threading.Lock()
+    busy = threading.Event()
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(heartbeat_interval):
+            if busy.is_set():
+                with lock:
+                    try:
+                        conn.send(('heartbeat',))
+                    except (IOError, OSError):
+                        return
+
+    thread = threading.Thread(target=heartbeat)
+    thread.daemon = True
+    thread.start()
+
+    ntasks = 0
+    try:
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+            if message[0] == 'stop':
+                break
+
+            _, task_id, model_index, parameters, epsilon, do_comp, seed = message
+            busy.set()
+            np.random.seed(seed)
+            result = simulate_and_compare(models[model_index], data[model_index], parameters, epsilon, do_comp, debug)
+            busy.clear()
+
+            ntasks += 1
+            last = max_tasks is not None and ntasks >= max_tasks
+            with lock:
+                try:
+                    conn.send(('result', task_id, result, last))
+                except (IOError, OSError):
+                    # the backend shut down while we were busy
+                    break
+            if last:
+                break
+    finally:
+        stop.set()
+        conn.close()
+    return ntasks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run worker processes for an Abcsmc DistributedBackend.')
+    parser.add_argument('host', help='host the backend listens on')
+    parser.add_argument('port', type=int, help='port the backend listens on')
+    parser.add_argument('--authkey', required=True, help='the authkey of the backend')
+    parser.add_argument('--processes', type=int, default=1, help='number of worker processes to run')
+    parser.add_argument('--path', action='append', default=[],
+                        help='folder to add to the python path, so that the modules defining the models can be '
+                             'imported; may be repeated')
+    args = parser.parse_args(argv)
+    sys.path[:0] = args.path
+
+    processes = [multiprocessing.Process(target=run_worker, args=((args.host, args.port), args.authkey.encode()))
+                 for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
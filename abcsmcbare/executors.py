@@ -0,0 +1,474 @@
+from __future__ import print_function
+import concurrent.futures
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+from .instrumentation import clock
+from .population import ParticlePopulation
+from .statistics import FactorizedGaussian
+from .proposals import ProposalSampler
+
+
+# An execution backend runs the simulations of a batch of particles for one model and compares each of them to the
+# data. Abcsmc starts it once with the models and the data prepared for each model (see AbcModel.prepare_data), then
+# hands it batches of parameters.
+#
+# Backends return one future per chunk of the batch; each future resolves to (accepted, distances, traj, stats) for
+# the parameters of that chunk, in order, where stats is (simulation time, distance time, number of simulations
+# aborted early), the times in seconds spent on the chunk wherever it ran.
+#
+# Backends whose proposes attribute is True draw the proposals themselves instead (see SharedMemoryBackend): Abcsmc
+# publishes the previous population to them once per population, and asks for a number of proposals at a time with
+# map_proposals or submit_proposals; their futures resolve to (models, parameters, accepted, distances, traj, stats).
+
+
+def check_below_threshold(distance, epsilon):
+    """Return true if each element of distance is less than the corresponding entry of epsilon (and non-negative).
+
+    Parameters
+    ----------
+    distance : list of distances
+    epsilon : list of maximum acceptable distances
+    """
+    return distance < epsilon
+
+
+def simulate_and_compare(model, data, parameters, epsilon, do_comp=True, debug=0):
+    """Simulate a batch of parameters for a single model and compare every simulation to the data.
+
+    Parameters
+    ----------
+    model : the AbcModel to simulate
+    data : the target data
+    parameters : a list, each element of which is a list of parameters for model
+    epsilon : value of epsilon; passed to the model's abortingSimulationFn, if it has one
+    do_comp : if False, do not actually calculate distance between simulation results and experimental data, and
+        instead assume this is 0.
+    debug : debug level
+
+    Returns
+    -------
+    accepted, distances, traj : lists of the same length as parameters. Simulations aborted early are rejected, with
+        their partial distance.
+    stats : the time spent in the simulator and in the distance function, in seconds, and the number of simulations
+        aborted early. The time of an abortingSimulationFn all counts as simulation time.
+    """
+    num_simulations = len(parameters)
+    accepted = [0] * num_simulations
+    traj = [[] for _ in range(num_simulations)]
+    distances = [0 for _ in range(num_simulations)]
+
+    batch_distances = None
+    aborted = None
+    start = clock()
+    try:
+        if model.abortingSimulationFn is not None:
+            sims, batch_distances, aborted = model.simulate_with_tolerance(parameters, data,
+                                                                           epsilon if do_comp else np.inf)
+        else:
+            sims = model.simulate(parameters)
+        doh_fail = False
+        if debug == 2:
+            print('\t\t\tsimulation dimensions:', sims.shape)
+
+    except:
+        print('SIMULATION FAILEDD!')
+        sims = None
+        doh_fail = True
+    simulate_time = clock() - start
+
+    start = clock()
+    # models with a batch distance compare the whole batch in one call; the others are called once per particle
+    if batch_distances is None and not doh_fail and do_comp and model.batchDistanceFn is not None:
+        batch_distances = model.batch_distance(sims, data, parameters)
+
+    for i in range(num_simulations):
+        if doh_fail:
+            dist = False
+            distance = np.inf
+        else:
+            sample_points = sims[i]
+            if do_comp:
+                if batch_distances is not None:
+                    distance = batch_distances[i]
+                else:
+                    distance = model.distance(sample_points, data, parameters[i], None)
+                # an aborted simulation is rejected whatever its partial distance
+                dist = check_below_threshold(distance, epsilon) and not (aborted is not None and aborted[i])
+            else:
+                distance = 0
+                dist = True
+            traj[i] = sample_points
+
+        if dist:
+            accepted[i] += 1
+
+        if debug == 2:
+            print('\t\t\tdistance/this_epsilon/b:', distance, epsilon, accepted[i])
+
+        distances[i] = distance
+
+    naborted = 0 if (aborted is None or doh_fail) else int(np.sum(aborted))
+    return accepted, distances, traj, (simulate_time, clock() - start, naborted)
+
+
+def simulate_and_compare_models(models, data, model_indexes, parameters, epsilon, do_comp=True, debug=0):
+    """Simulate and compare a batch of parameters of different models, with simulate_and_compare for each model.
+
+    Parameters
+    ----------
+    models : all the AbcModels
+    data : the target data prepared for each model
+    model_indexes : the model of each entry of parameters
+    see simulate_and_compare for the others
+
+    Returns
+    -------
+    accepted, distances, traj, stats : as simulate_and_compare, in the order of parameters
+    """
+    num_simulations = len(parameters)
+    accepted = [0] * num_simulations
+    traj = [[] for _ in range(num_simulations)]
+    distances = [0 for _ in range(num_simulations)]
+    stats = [0.0, 0.0, 0]
+    model_indexes = np.asarray(model_indexes)
+    for model_index in np.unique(model_indexes):
+        mapping = np.flatnonzero(model_indexes == model_index)
+        a, d, t, s = simulate_and_compare(models[model_index], data[model_index], [parameters[i] for i in mapping],
+                                          epsilon, do_comp, debug)
+        for i, simulation_number in enumerate(mapping):
+            accepted[simulation_number] = a[i]
+            distances[simulation_number] = d[i]
+            traj[simulation_number] = t[i]
+        stats = [x + y for x, y in zip(stats, s)]
+    return accepted, distances, traj, tuple(stats)
+
+
+def collect(futures):
+    """Wait for the futures returned by a backend's map, and concatenate their results in order.
+
+    Returns
+    -------
+    accepted, distances, traj
+    stats : the simulation and distance times and the number of aborted simulations, summed over the futures
+    """
+    return _concatenate([future.result() for future in futures])
+
+
+def collect_proposals(futures):
+    """Wait for the futures returned by map_proposals, and concatenate their results in order.
+
+    Returns
+    -------
+    models, parameters : the proposals drawn by the backend
+    accepted, distances, traj, stats : as collect
+    """
+    results = [future.result() for future in futures]
+    models = []
+    parameters = []
+    for result in results:
+        models.extend(result[0])
+        parameters.extend(result[1])
+    return (models, parameters) + _concatenate([result[2:] for result in results])
+
+
+def _concatenate(results):
+    accepted = []
+    distances = []
+    traj = []
+    simulate_time = 0.0
+    distance_time = 0.0
+    naborted = 0
+    for a, d, t, (s, c, n) in results:
+        accepted.extend(a)
+        distances.extend(d)
+        traj.extend(t)
+        simulate_time += s
+        distance_time += c
+        naborted += n
+    return accepted, distances, traj, (simulate_time, distance_time, naborted)
+
+
+class SerialBackend(object):
+
+    """Run every simulation in the calling process, one model batch at a time.
+
+    This is the default backend, and behaves exactly as Abcsmc always has: each model's simulator is called once
+    with the whole batch of parameters for that model.
+    """
+
+    # whether the backend draws the proposals itself
+    proposes = False
+
+    def __init__(self, chunksize=None):
+        """Init.
+
+        Input:
+            chunksize: number of particles passed to a single simulator call; None means the whole batch
+        """
+        self.chunksize = chunksize
+        self.models = None
+        self.data = None
+        self.debug = 0
+        self.started = False
+
+    def start(self, models, data, debug=0):
+        """Make the models, and the list of the target data as prepared for each of them, available to the backend."""
+        self.models = models
+        self.data = data
+        self.debug = debug
+        self.started = True
+
+    def shutdown(self):
+        """Release any resources held by the backend."""
+        self.started = False
+
+    def submit(self, model_index, parameters, epsilon, do_comp=True):
+        """Simulate and compare a single chunk of parameters, returning a future."""
+        future = concurrent.futures.Future()
+        future.set_result(simulate_and_compare(self.models[model_index], self.data[model_index], parameters, epsilon,
+                                               do_comp, self.debug))
+        return future
+
+    def map(self, model_index, parameters, epsilon, do_comp=True):
+        """Split parameters into chunks and submit each of them.
+
+        Returns
+        -------
+        a list of futures, one per chunk, in order
+        """
+        chunksize = self.chunksize or max(1, len(parameters))
+        return [self.submit(model_index, parameters[start:start + chunksize], epsilon, do_comp)
+                for start in range(0, len(parameters), chunksize)]
+
+
+# The models and prepared data are sent to each worker process once, when the pool starts, rather than with every task
+_worker_models = None
+_worker_data = None
+_worker_debug = 0
+
+
+def _init_worker(models, data, debug):
+    global _worker_models, _worker_data, _worker_debug
+    # forked workers inherit the parent's random state, so reseed or every worker simulates the same noise
+    np.random.seed()
+    _worker_models = models
+    _worker_data = data
+    _worker_debug = debug
+
+
+def _worker_simulate_and_compare(model_index, parameters, epsilon, do_comp):
+    return simulate_and_compare(_worker_models[model_index], _worker_data[model_index], parameters, epsilon,
+                                do_comp, _worker_debug)
+
+
+class ProcessPoolBackend(SerialBackend):
+
+    """Fan the simulations of a batch out to a concurrent.futures process pool.
+
+    The models (including their simulation and distance functions) and the data must be picklable, which in
+    practice means the functions must be defined at module level rather than in a notebook cell or a closure.
+    """
+
+    def __init__(self, max_workers=None, chunksize=1):
+        """Init.
+
+        Input:
+            max_workers: number of worker processes; None uses the number of CPUs
+            chunksize: number of particles simulated per task
+        """
+        super(ProcessPoolBackend, self).__init__(chunksize=chunksize)
+        self.max_workers = max_workers
+        self.executor = None
+        # the futures submitted and not done yet, for shutdown to cancel
+        self.futures = set()
+
+    def start(self, models, data, debug=0):
+        super(ProcessPoolBackend, self).start(models, data, debug)
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers,
+                                                               initializer=_init_worker,
+                                                               initargs=(models, data, debug))
+
+    def shutdown(self):
+        """Cancel the tasks that have not started and release the pool, without waiting for those still running.
+
+        A run stopped early (by a stopping rule, a callback or an error) returns straight away; the workers exit in
+        the background once their current simulation is done, and its result is discarded.
+        """
+        if self.executor is not None:
+            for future in list(self.futures):
+                future.cancel()
+            self.futures.clear()
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        super(ProcessPoolBackend, self).shutdown()
+
+    def _track(self, future):
+        self.futures.add(future)
+        future.add_done_callback(self.futures.discard)
+        return future
+
+    def submit(self, model_index, parameters, epsilon, do_comp=True):
+        return self._track(self.executor.submit(_worker_simulate_and_compare, model_index, parameters, epsilon,
+                                                do_comp))
+
+
+# The population a SharedMemoryBackend worker last attached to: (folder, generation, ProposalSampler)
+_worker_sampler = None
+
+# the arrays of a statistics.FactorizedGaussian, as shared by SharedMemoryBackend
+_FACTORS = ['covariance', 'chol', 'chol_inv', 'log_det']
+
+
+def _save_kernels(prefix, kernels):
+    """Write the covariances of the multivariate normal kernels, and their factors, as .npy files.
+
+    Returns
+    -------
+    the kernels with those arrays left out, for pickling, and the indexes of the models whose arrays were written
+    """
+    ret = []
+    shared = []
+    for model_index, kernel in enumerate(kernels):
+        factors = kernel[3]
+        if factors is None:
+            ret.append(list(kernel))
+            continue
+        for name in _FACTORS:
+            np.save('%s_kernel_%d_%s.npy' % (prefix, model_index, name), getattr(factors, name))
+        ret.append([kernel[0], kernel[1], None, None])
+        shared.append(model_index)
+    return ret, shared
+
+
+def _load_kernels(prefix, kernels, shared):
+    """Memory-map the arrays written by _save_kernels back into the kernels."""
+    for model_index in shared:
+        arrays = [np.load('%s_kernel_%d_%s.npy' % (prefix, model_index, name), mmap_mode='r') for name in _FACTORS]
+        kernels[model_index][2] = arrays[0]
+        kernels[model_index][3] = FactorizedGaussian.from_factors(*arrays)
+    return kernels
+
+
+def _attach_sampler(folder, generation):
+    """Return a ProposalSampler for a population published by SharedMemoryBackend, memory-mapping its arrays the
+    first time the population is used in this process."""
+    global _worker_sampler
+    if _worker_sampler is None or _worker_sampler[:2] != (folder, generation):
+        prefix = os.path.join(folder, 'population_%04d' % generation)
+        with open(prefix + '_state.pkl', 'rb') as in_file:
+            state = pickle.load(in_file)
+        state['kernels'] = _load_kernels(prefix, state['kernels'], state.pop('shared_kernels'))
+        population = None
+        if state.pop('nparameters') is not None:
+            def load(name):
+                return np.load('%s_%s.npy' % (prefix, name), mmap_mode='r')
+            population = ParticlePopulation.from_arrays(load('models'), load('weights'),
+                                                        [load('parameters_%d' % m) for m in range(len(_worker_models))],
+                                                        load('margins'))
+        _worker_sampler = (folder, generation, ProposalSampler(_worker_models, population=population, **state))
+    return _worker_sampler[2]
+
+
+def _worker_propose_and_simulate(folder, generation, n, prior, epsilon, do_comp, seed):
+    sampler = _attach_sampler(folder, generation)
+    np.random.seed(seed)
+    model_indexes, parameters = sampler.propose(n, prior)
+    return (model_indexes, parameters) + simulate_and_compare_models(_worker_models, _worker_data, model_indexes,
+                                                                     parameters, epsilon, do_comp, _worker_debug)
+
+
+class SharedMemoryBackend(ProcessPoolBackend):
+
+    """Let the worker processes draw the proposals themselves, from the previous population shared with them through
+    memory-mapped files, so that each task is only a number of proposals and a random seed.
+
+    Once per population Abcsmc calls publish: the arrays of the previous population, and the covariances of the
+    multivariate normal kernels with their Cholesky factors, are written as .npy files to a folder in shared memory
+    (/dev/shm, where there is one), and the rest of the kernels and the other settings proposals depend on to a small
+    pickle. Each worker memory-maps the arrays, rather than copying them, the first time it gets a task of
+    that population. A task draws its proposals with a proposals.ProposalSampler seeded from the main process, so a
+    run is reproducible from the main random seed, then simulates and compares them. The models and the prepared data
+    are sent to the workers once, when the pool starts.
+    """
+
+    proposes = True
+
+    def __init__(self, max_workers=None, chunksize=1, folder=None):
+        """Init.
+
+        Input:
+            max_workers: number of worker processes; None uses the number of CPUs
+            chunksize: number of proposals drawn and simulated per task
+            folder: where to create the folder of shared files; None uses /dev/shm if it exists, otherwise the
+                default temporary folder
+        """
+        super(SharedMemoryBackend, self).__init__(max_workers=max_workers, chunksize=chunksize)
+        self.folder = folder
+        self.shared_folder = None
+        self.generation = -1
+
+    def start(self, models, data, debug=0):
+        folder = self.folder
+        if folder is None and os.path.isdir('/dev/shm'):
+            folder = '/dev/shm'
+        self.shared_folder = tempfile.mkdtemp(prefix='abcsmc_', dir=folder)
+        self.generation = -1
+        super(SharedMemoryBackend, self).start(models, data, debug)
+
+    def shutdown(self):
+        super(SharedMemoryBackend, self).shutdown()
+        if self.shared_folder is not None:
+            shutil.rmtree(self.shared_folder, ignore_errors=True)
+            self.shared_folder = None
+
+    def publish(self, sampler, prior):
+        """Share what the proposals of the next population are drawn from with the workers.
+
+        Parameters
+        ----------
+        sampler : the ProposalSampler of the population, see Abcsmc.proposal_sampler
+        prior : if True the proposals are drawn from the prior, and the previous population is not shared
+        """
+        self.generation += 1
+        prefix = os.path.join(self.shared_folder, 'population_%04d' % self.generation)
+        population = None if prior else sampler.population
+        if population is not None:
+            arrays = [('models', population.models), ('weights', population.weights), ('margins', population.margins)]
+            arrays += [('parameters_%d' % m, p) for m, p in enumerate(population.parameters)]
+            for name, value in arrays:
+                np.save('%s_%s.npy' % (prefix, name), value)
+        # the kernels of the multivariate normal kernel types hold an (nparticles, d, d) stack of covariances, and
+        # their factors, for the nearest neighbour and OCM kernels; those are shared like the population
+        kernels, shared_kernels = _save_kernels(prefix, sampler.kernels)
+        state = {'nparameters': None if population is None else population.nparameters,
+                 'modelprior': sampler.modelprior, 'model_kernel': sampler.model_kernel,
+                 'kernel_type': sampler.kernel_type, 'special_cases': sampler.special_cases,
+                 'kernels': kernels, 'shared_kernels': shared_kernels, 'dead_models': sampler.dead_models,
+                 'perturbfn': sampler.perturbfn, 'batchperturbfn': sampler.batchperturbfn, 'debug': sampler.debug}
+        with open(prefix + '_state.pkl', 'wb') as out_file:
+            pickle.dump(state, out_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # stragglers of the last population may still be reading its files, but not those of the one before
+        for name in os.listdir(self.shared_folder):
+            if name.startswith('population_%04d_' % (self.generation - 2)):
+                os.remove(os.path.join(self.shared_folder, name))
+
+    def submit_proposals(self, n, epsilon, prior, do_comp=True):
+        """Draw, simulate and compare n proposals in one task, returning a future."""
+        seed = np.random.randint(0, 2 ** 31 - 1)
+        return self._track(self.executor.submit(_worker_propose_and_simulate, self.shared_folder, self.generation, n,
+                                                prior, epsilon, do_comp, seed))
+
+    def map_proposals(self, n, epsilon, prior, do_comp=True):
+        """Split n proposals into tasks of chunksize and submit each of them.
+
+        Returns
+        -------
+        a list of futures, one per task, in order
+        """
+        chunksize = self.chunksize or max(1, n)
+        return [self.submit_proposals(min(chunksize, n - start), epsilon, prior, do_comp)
+                for start in range(0, n, chunksize)]
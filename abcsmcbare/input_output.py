@@ -1,86 +1,173 @@
-from __future__ import print_function
-import os
-import pickle
-import datetime
-
-
-class InputOutput:
-
-    """Setup the output folders, save data for restart, etc.
-
-    blah blah
-    """
-
-    def __init__(self, folder, restart, addTime=True):
-        # if we are restarting then dont add the date as it probably already has it
-        if restart or not addTime:
-            self.folder = folder
-        else:
-            self.folder = '%s%s' % (folder, datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))
-
-        # Hold all data here for plotting purposes.
-        # May want to remove this as could get large
-        self.all_results = []
-
-        if restart:
-            self.folder += '_restart'
-
-        print('top folder name is %s\n(useful e.g. if you are restarting because in such cases this is the folder name you should pass in)' % self.folder)
-
-    # write rates, distances, trajectories
-    def create_output_folders(self, num_outputs, pickling):
-        try:
-            os.mkdir(self.folder)
-        except OSError:
-            print("\nThe folder " + self.folder + " already exists!\nContinuing anyway")
-
-        os.chdir(self.folder)
-
-        os.chdir('..')
-
-        if pickling:
-            try:
-                os.chdir(self.folder)
-                os.mkdir('copy')
-            except OSError:
-                print("\nThe folder \'copy\' already exists!\nContinuing anyway")
-            os.chdir('..')
-            out_file = open(self.folder + '/copy/algorithm_parameter.dat', "w")
-            pickle.dump(num_outputs, out_file)
-            out_file.close()
-
-    # read the stored data
-    def read_pickled(self, location):
-        # pickle numbers selected model of previous population
-        # pickle population of selected model of previous population pop_pickled[selected_model][n][vectpos]
-        # pickle weights of selected model of previous population weights_pickled[selected_model][n][vectpos]
-        in_file = open(location + '/copy/model_last.dat', "r")
-        model_pickled = pickle.load(in_file)
-        in_file.close()
-        in_file = open(location + '/copy/weights_last.dat', "r")
-        weights_pickled = pickle.load(in_file)
-        in_file.close()
-        in_file = open(location + '/copy/params_last.dat', "r")
-        parameters_pickled = pickle.load(in_file)
-        in_file.close()
-        in_file = open(location + '/copy/margins_last.dat', "r")
-        margins_pickled = pickle.load(in_file)
-        in_file.close()
-        in_file = open(location + '/copy/kernels_last.dat', "r")
-        kernel = pickle.load(in_file)
-        in_file.close()
-
-        return [model_pickled, weights_pickled, parameters_pickled, margins_pickled, kernel]
-
-    # write the stored data
-    def write_pickled(self, nmodel, model_prev, weights_prev, parameters_prev, margins_prev, kernel, allResults):
-
-        pickle.dump(model_prev[:], open(self.folder + '/copy/model_last.dat', "w"))
-        pickle.dump(weights_prev[:], open(self.folder + '/copy/weights_last.dat', "w"))
-        pickle.dump(parameters_prev, open(self.folder + '/copy/params_last.dat', "w"))
-        pickle.dump(margins_prev[:], open(self.folder + '/copy/margins_last.dat', "w"))
-        x = []
-        for mod in range(nmodel):
-            x.append(kernel[mod])
-        pickle.dump(x, open(self.folder + '/copy/kernels_last.dat', "w"))
-        pickle.dump(allResults, open(self.folder + '/allResults.dat', 'w'))
+from __future__ import print_function
+import os
+import copy
+import pickle
+import datetime
+import time
+from .checkpoint import BackgroundWriter, CheckpointStore, CheckpointWriteError, ResultsReader
+
+
+class InputOutput:
+
+    """Setup the output folders, save data for restart, etc.
+
+    blah blah
+    """
+
+    def __init__(self, folder, restart, addTime=True, background=False, max_pending=1):
+        """Init.
+
+        Input:
+            folder: prefix of the output folder
+            restart: True if this run restarts from a previous one
+            addTime: if True, the date and time are appended to the folder name (unless restarting)
+            background: if True, checkpoints are written by a background thread while the next population runs
+            max_pending: with background, the number of checkpoints that may wait to be written before
+                write_checkpoint blocks
+        """
+        # if we are restarting then dont add the date as it probably already has it
+        if restart or not addTime:
+            self.folder = folder
+        else:
+            self.folder = '%s%s' % (folder, datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))
+
+        # Hold all data here for plotting purposes.
+        # May want to remove this as could get large
+        self.all_results = []
+
+        if restart:
+            self.folder += '_restart'
+
+        # append-only store of the populations, created when the first one is written
+        self.checkpoint = None
+        self.checkpoint_next = 0
+        self.writer = BackgroundWriter(max_pending) if background else None
+        self.checkpoint_writes = 0
+        self.checkpoint_write_time = 0.0
+
+        print('top folder name is %s\n(useful e.g. if you are restarting because in such cases this is the folder name you should pass in)' % self.folder)
+
+    # write rates, distances, trajectories
+    def create_output_folders(self, num_outputs, pickling):
+        try:
+            os.mkdir(self.folder)
+        except OSError:
+            print("\nThe folder " + self.folder + " already exists!\nContinuing anyway")
+
+        os.chdir(self.folder)
+
+        os.chdir('..')
+
+        if pickling:
+            try:
+                os.chdir(self.folder)
+                os.mkdir('copy')
+            except OSError:
+                print("\nThe folder \'copy\' already exists!\nContinuing anyway")
+            os.chdir('..')
+            with open(self.folder + '/copy/algorithm_parameter.dat', "wb") as out_file:
+                pickle.dump(num_outputs, out_file)
+
+    # read the stored data
+    def read_pickled(self, location):
+        # pickle numbers selected model of previous population
+        # pickle population of selected model of previous population pop_pickled[selected_model][n][vectpos]
+        # pickle weights of selected model of previous population weights_pickled[selected_model][n][vectpos]
+        ret = []
+        for name in ['model_last', 'weights_last', 'params_last', 'margins_last', 'kernels_last']:
+            with open(location + '/copy/' + name + '.dat', "rb") as in_file:
+                ret.append(pickle.load(in_file))
+
+        # [model_pickled, weights_pickled, parameters_pickled, margins_pickled, kernel]
+        return ret
+
+    # write the stored data
+    def write_pickled(self, nmodel, model_prev, weights_prev, parameters_prev, margins_prev, kernel, allResults):
+        x = []
+        for mod in range(nmodel):
+            x.append(kernel[mod])
+        for name, value in [('copy/model_last', model_prev[:]), ('copy/weights_last', weights_prev[:]),
+                            ('copy/params_last', parameters_prev), ('copy/margins_last', margins_prev[:]),
+                            ('copy/kernels_last', x), ('allResults', allResults)]:
+            with open(self.folder + '/' + name + '.dat', "wb") as out_file:
+                pickle.dump(value, out_file)
+
+    # append a population to the checkpoint store
+    def write_checkpoint(self, results, population, kernel):
+        """Append one population to the checkpoint store in self.folder/checkpoint.
+
+        Unlike write_pickled, which re-writes every population so far, this only writes the new one; see
+        checkpoint.CheckpointStore. To restart from it, pass read_results(folder) to Abcsmc.restart_from_checkpoint.
+
+        Parameters
+        ----------
+        results : the AbcsmcResults of the population
+        population : the ParticlePopulation of the accepted particles
+        kernel : the kernels built from the population
+        """
+        if self.checkpoint is None:
+            self.checkpoint = CheckpointStore(self.folder + '/checkpoint')
+            self.checkpoint_next = len(self.checkpoint)
+        index = self.checkpoint_next
+        if self.writer is None:
+            start = time.time()
+            self._append(index, results, population, kernel)
+            self.checkpoint_write_time += time.time() - start
+            self.checkpoint_writes += 1
+        else:
+            # snapshot the population, as Abcsmc reuses its arrays, and the results, whose trajectories may be dropped
+            # by the retention policy before they are written; kernels are not modified in place. If an earlier
+            # population failed to be written this raises, and nothing more is written
+            self.writer.submit(self._append, index, copy.copy(results), population.copy(), [list(k) for k in kernel])
+        # where the population goes in the store, e.g. for retention.SpillToDisk to load its trajectories from; with
+        # the background writer it may not be there yet
+        results.checkpoint_location = (self.checkpoint.folder, index)
+        self.checkpoint_next += 1
+
+    def _append(self, index, results, population, kernel):
+        try:
+            self.checkpoint.append(results, population, kernel)
+        except Exception as e:
+            raise CheckpointWriteError('population %d was not written to the checkpoint store %s: %s: %s'
+                                       % (index, self.checkpoint.folder, type(e).__name__, e))
+
+    def flush(self):
+        """Wait for any checkpoints still being written in the background."""
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        """Flush and stop the background writer, if any."""
+        if self.writer is not None:
+            self.writer.close()
+
+    def checkpoint_timing(self):
+        """Return how long checkpointing took.
+
+        Returns
+        -------
+        a dictionary with the number of checkpoints written ('writes'), the time spent writing them ('write_time'),
+        and the time the run was held up by them ('blocked_time'): the same as write_time when writing in the
+        foreground, only the time spent waiting for a full queue or a flush in the background
+        """
+        if self.writer is None:
+            return {'writes': self.checkpoint_writes, 'write_time': self.checkpoint_write_time,
+                    'blocked_time': self.checkpoint_write_time}
+        return {'writes': self.writer.nwrites, 'write_time': self.writer.write_time,
+                'blocked_time': self.writer.blocked_time}
+
+    # read the last population of a checkpoint store
+    def read_checkpoint(self, location):
+        """Return the state to restart from the last population in the checkpoint store in location/checkpoint.
+
+        This is in the same form as read_pickled, for Abcsmc.fill_values.
+        """
+        return CheckpointStore(location + '/checkpoint').restart_data()
+
+    # open the checkpoint store for analysis or restart
+    def read_results(self, location, mmap_mode='r'):
+        """Return a checkpoint.ResultsReader over the populations in location/checkpoint.
+
+        Populations are loaded lazily, with their arrays memory-mapped, so this is cheap however long the run was.
+        """
+        return ResultsReader(location + '/checkpoint', mmap_mode)
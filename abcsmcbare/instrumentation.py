@@ -0,0 +1,145 @@
+from __future__ import print_function
+import collections
+import json
+import time
+
+
+# Counters and timers for the stages of a population. Abcsmc keeps one PopulationTimings per population, times each
+# stage of iterate_one_population into it, and attaches it to the AbcsmcResults as results.timings.
+#
+# Stages timed in the main process:
+#   sample_proposals          drawing models and parameters, from the prior or by perturbing the previous population
+#   publish                   sharing the previous population with a backend that draws the proposals itself
+#   backend                   waiting on the backend for simulations and distances (wall clock)
+#   compute_particle_weights
+#   get_kernel                building the perturbation kernels
+#   get_auxilliary_info       the kernel auxilliary information, e.g. the truncated normal masses
+#   checkpoint                write_checkpoint (only the time the run is held up, when writing in the background)
+#   retention                 the trajectory retention policy
+#   population                the whole population, from its first proposal to its results
+# and by the backend, summed over simulator calls wherever they ran, so with several workers they may add up to
+# more than backend:
+#   simulate                  the model's simulator
+#   distance                  the model's distance function
+#
+# Counters: simulations and accepted, the sampled and accepted particles of the population, and aborted, the
+# simulations an abortingSimulationFn stopped early (see AbcModel). Aborted simulations are rejected, and are counted
+# in simulations, except those of the last batch that ran after the population was full, which only count as aborted.
+
+# the highest resolution wall clock available, for timing short stages
+clock = time.perf_counter
+
+
+class _Stage(object):
+
+    """Context manager adding the time spent in its block to one stage of a PopulationTimings."""
+
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.name, clock() - self.start)
+        return False
+
+
+class PopulationTimings(object):
+
+    """The time spent in, and number of calls to, each stage of a population, and a few counters.
+
+    Use as:
+
+        with timings.stage('get_kernel'):
+            ...
+
+    or timings.add(name, seconds) for time measured elsewhere. Counters are incremented with count(name, n).
+    """
+
+    def __init__(self):
+        # stage name -> [calls, seconds], in the order the stages were first seen
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    def stage(self, name):
+        """Return a context manager timing its block as stage name."""
+        return _Stage(self, name)
+
+    def add(self, name, seconds, calls=1):
+        """Add seconds, over calls calls, to stage name."""
+        entry = self.stages.get(name)
+        if entry is None:
+            self.stages[name] = [calls, seconds]
+        else:
+            entry[0] += calls
+            entry[1] += seconds
+
+    def count(self, name, n=1):
+        """Add n to counter name."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def seconds(self, name):
+        """The time spent in stage name, 0 if it never ran."""
+        entry = self.stages.get(name)
+        return 0.0 if entry is None else entry[1]
+
+    def calls(self, name):
+        """The number of times stage name ran."""
+        entry = self.stages.get(name)
+        return 0 if entry is None else entry[0]
+
+    def throughput(self):
+        """Return the simulations and accepted particles per second of wall clock over the population.
+
+        Returns
+        -------
+        a dictionary with 'simulations_per_second' and 'accepted_per_second'; None if the population was not timed
+        """
+        elapsed = self.seconds('population')
+        if elapsed <= 0:
+            return {'simulations_per_second': None, 'accepted_per_second': None}
+        return {'simulations_per_second': self.counters.get('simulations', 0) / elapsed,
+                'accepted_per_second': self.counters.get('accepted', 0) / elapsed}
+
+    def as_dict(self):
+        """Return the timings as a dictionary of plain python types, as exported by to_json."""
+        ret = collections.OrderedDict()
+        ret['stages'] = collections.OrderedDict((name, {'calls': calls, 'seconds': seconds})
+                                                for name, (calls, seconds) in self.stages.items())
+        ret['counters'] = collections.OrderedDict(self.counters)
+        ret.update(self.throughput())
+        return ret
+
+    def to_json(self, **kwds):
+        """Return the timings as a JSON string; kwds are passed to json.dumps."""
+        return json.dumps(self.as_dict(), **kwds)
+
+    def summary(self):
+        """Return a short multi-line description of where the time went, for printing."""
+        total = self.seconds('population')
+        lines = []
+        for name, (calls, seconds) in self.stages.items():
+            if name == 'population':
+                continue
+            share = ' (%5.1f%%)' % (100.0 * seconds / total) if total > 0 else ''
+            lines.append('\t  %-26s %10.4f s%s in %d calls' % (name, seconds, share, calls))
+        throughput = self.throughput()
+        if throughput['simulations_per_second'] is not None:
+            lines.append('\t  %-26s %10.1f simulations/s, %.1f accepted/s'
+                         % ('throughput', throughput['simulations_per_second'], throughput['accepted_per_second']))
+        return '\n'.join(lines)
+
+
+def write_json(all_results, path):
+    """Write the timings of a list of AbcsmcResults to path as a JSON list, one entry per population.
+
+    Populations without timings (e.g. read back from a checkpoint) are written as null.
+    """
+    timings = [getattr(results, 'timings', None) for results in all_results]
+    with open(path, 'w') as out_file:
+        json.dump([None if t is None else t.as_dict() for t in timings], out_file, indent=1)
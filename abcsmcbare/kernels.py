@@ -1,23 +1,42 @@
 from __future__ import print_function
+import inspect
 import numpy
 from numpy import random as rnd
-from scipy.stats import norm
 from abcsmcbare import statistics
 from .KernelType import KernelType
 from .PriorType import PriorType
 import sys
 
-# kernel is a list of length 3 such that :
+# kernel is a list of length 4 such that :
 # kernel[0] contains the index of the non-constant paramameters
 # kernel[1] contains the informations required to build the kernels in function getKernels, given in input file
-# kernel[2] contains the kernel (list, matrix or dictionnary) once it has been built
+# kernel[2] contains the kernel (list or matrix) once it has been built
+# kernel[3] contains the statistics.FactorizedGaussian of the covariance(s) in kernel[2] for the multivariate normal
+# kernels, so that they are factorized once per population
+#
+# For the kernels with one covariance per particle (multivariate_normal_nn and multivariate_normal_ocm), particles are
+# identified by their index among the particles of the model in the previous population, in population order, i.e.
+# the position in ParticlePopulation.model_indexes(model).
+
+# the kernel types whose kernels cannot be evaluated or sampled without the position of the particle
+PER_PARTICLE_KERNEL_TYPES = (KernelType.multivariate_normal_nn, KernelType.multivariate_normal_ocm)
+
+
+def accepts_keyword(fn, name):
+    """Return True if fn takes the keyword argument name, e.g. a custom kernel density taking index0."""
+    try:
+        parameters = inspect.signature(fn).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    return any(p.kind == p.VAR_KEYWORD or (p.name == name and p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY))
+               for p in parameters)
 
 
 # populations, weights refers to particles and weights from previous population for one model
 def get_kernel(kernel_type, kernel, population, weights):
     """Calculate some details of the kernel for a single model, based on the previous population of particles.
 
-    Populate kernels[2] with the result.
+    Populate kernels[2] (and kernels[3]) with the result.
 
     Parameters
     ----------
@@ -38,14 +57,14 @@ def get_kernel(kernel_type, kernel, population, weights):
     # covariance matrix of the multivariate normal kernel of size len(kernel[0])*len(kernel[0])
 
     # (4) multi-variate normal kernel whose covariance is based on the K nearest neighbours of the particle:
-    #  kernel[2] is a dictionnary with pop_size keys. Each key is string(p) where p is a particle (length nparam)
-    # of the previous population. The element of the dictionnary for a given key is a covaraince matrix of size
-    # len(kernel[0])*len(kernel[0])
+    #  kernel[2] is an array of shape (pop_size, len(kernel[0]), len(kernel[0])); kernel[2][n] is the covariance
+    # matrix for particle n of population
 
     # multi-variate normal kernel whose covariance is the OCM
-    # kernel[2] is a dictionnary with pop_size keys. Each key is string(p) where p is a particle (with nparam dimension)
-    # of the previous population. The element of the dictionnary for a given key is a covaraince matrix of size
-    #  len(kernel[0])*len(kernel[0])
+    # kernel[2] is an array of shape (pop_size, len(kernel[0]), len(kernel[0])); kernel[2][n] is the covariance
+    # matrix for particle n of population
+
+    # for (3), (4) and (5) kernel[3] holds the statistics.FactorizedGaussian of kernel[2]
     pop_size = population.shape[0]
     npar = population.shape[1]
 
@@ -68,10 +87,8 @@ def get_kernel(kernel_type, kernel, population, weights):
         if pop_size == 1:
             tmp = [1 for _ in kernel[0]]
         else:
-            tmp = list()
-            for param in kernel[0]:
-                s2w = statistics.wtvar(population[:, param], weights, method="R")
-                tmp.append(2 * s2w)
+            s2w = statistics.wtvar(population[:, kernel[0]], weights, method="R")
+            tmp = list(2 * s2w)
         kernel[2] = tmp
 
     elif kernel_type == KernelType.multivariate_normal:
@@ -83,68 +100,41 @@ def get_kernel(kernel_type, kernel, population, weights):
                 pop.append(population[:, param])
             cov = statistics.compute_cov(pop, weights)
         kernel[2] = 2 * cov
+        kernel[3] = statistics.FactorizedGaussian(kernel[2])
 
     if kernel_type == KernelType.multivariate_normal_nn:
         k = int(kernel[1])
-        d = {}
-        pop = list()
         if pop_size == 1:
-            pop_cur = list()
-            for param in range(npar):
-                pop_cur.append(population[0, param])
-                d[str(pop_cur)] = 2 * numpy.eye(len(kernel[0]))
+            d = 2 * numpy.eye(len(kernel[0]))[numpy.newaxis, :, :]
         else:
             # to compute the neighbours, restrain the population to the non constant parameters
-            for param in kernel[0]:
-                pop.append(population[:, param])
-            for n in range(pop_size):
-
-                # compute the index of the neighbours
-                kset = statistics.k_nearest_neighbours(n, pop, k)
-
-                # save the coordinate of the particle (with all components)
-                pop_cur = list()
-                for param in range(npar):
-                    pop_cur.append(population[n, param])
-
-                # construct the list of the neighbours and weights given kset (restrained to non-constant components)
-                subpop = list()
-                subwei = list()
-                for param in range(len(pop)):
-                    subpop.append([])
-                    for j in range(len(kset)):
-                        subpop[param].append(pop[param][kset[j]])
-                for j in range(len(kset)):
-                    subwei.append(weights[kset[j]])
-
-                # compute the covariance and write it into the dictionnary
-                d[str(pop_cur)] = 2 * statistics.compute_cov(subpop, subwei)
+            pop = population[:, kernel[0]]
+
+            # compute the index of the neighbours of every particle at once, shape (pop_size, k)
+            kset = statistics.k_nearest_neighbours_all(pop, k)
+
+            # the covariance of each particle's neighbourhood, a block of particles at a time
+            d = 2 * statistics.compute_neighbourhood_covs(pop, kset, weights)
         kernel[2] = d
+        kernel[3] = statistics.FactorizedGaussian(d)
 
     if kernel_type == KernelType.multivariate_normal_ocm:
-        pop = list()
-        d = {}
         if pop_size == 1:
-            pop_cur = list()
-            for param in range(npar):
-                pop_cur.append(population[0, param])
-                d[str(pop_cur)] = 2 * numpy.eye(len(kernel[0]))
+            d = 2 * numpy.eye(len(kernel[0]))[numpy.newaxis, :, :]
+            chol = None
         else:
-            for param in kernel[0]:
-                pop.append(population[:, param])
-            for n in range(pop_size):
-                pop_cur = list()
-                for param in range(npar):
-                    pop_cur.append(population[n, param])
-                d[str(pop_cur)] = statistics.compute_optcovmat(pop, weights, pop_cur)
+            # the OCM of every particle at once, centred on its non-constant components
+            d, chol = statistics.compute_ocm(population[:, kernel[0]], weights)
         kernel[2] = d
+        kernel[3] = statistics.FactorizedGaussian(d, chol=chol)
 
     return kernel
 
 
-# Here params refers to one particle
+# Here params refers to one particle, and index to its index in the kernel (only needed for kernels with one covariance
+# per particle)
 # The function changes params in place and returns the probability (which may be zero)
-def perturb_particle(params, priors, kernel, kernel_type, special_cases):
+def perturb_particle(params, priors, kernel, kernel_type, special_cases, index=None):
     np = len(priors)
 
     if special_cases == 1:
@@ -202,7 +192,7 @@ def perturb_particle(params, priors, kernel, kernel_type, special_cases):
             mean = list()
             for n in kernel[0]:
                 mean.append(params[n])
-            tmp = statistics.mvnd_gen(mean, kernel[2])
+            tmp = kernel[3].sample(1, mean)[0]
             ind = 0
             for n in kernel[0]:
                 params[n] = tmp[ind]
@@ -212,8 +202,7 @@ def perturb_particle(params, priors, kernel, kernel_type, special_cases):
             mean = list()
             for n in kernel[0]:
                 mean.append(params[n])
-            d = kernel[2]
-            tmp = statistics.mvnd_gen(mean, d[str(params)])
+            tmp = kernel[3].sample(1, mean, index=[index])[0]
             ind = 0
             for n in kernel[0]:
                 params[n] = tmp[ind]
@@ -239,9 +228,78 @@ def perturb_particle(params, priors, kernel, kernel_type, special_cases):
         return prior_prob
 
 
-# Here params and params0 refer to one particle each.
+# Here params refers to a whole batch of particles of one model.
+# This is the batched version of perturb_particle; it does not evaluate the prior, see CompiledPrior.in_support
+def perturb_particles(params, priors, kernel, kernel_type, special_cases, index=None):
+    """Perturb a batch of particles of one model with the parameter perturbation kernel.
+
+    Parameters
+    ----------
+    params : ndarray of the particles to perturb, shape (n, nparam); this is not modified
+    priors : list of priors for the model
+    kernel : kernel list for the model
+    kernel_type : the KernelType
+    special_cases : 1 if the kernel is uniform and all priors are uniform, 0 otherwise
+    index : integer array of the index of each particle in the kernel; only needed for the kernels with one
+        covariance per particle
+
+    Returns
+    -------
+    ndarray of perturbed particles, shape (n, nparam)
+    """
+    ret = numpy.array(params, dtype=float)
+    n = ret.shape[0]
+    ind = kernel[0]
+    if n == 0 or len(ind) == 0:
+        return ret
+    x = ret[:, ind]
+
+    if special_cases == 1:
+        # this is the case where kernel is uniform and all priors are uniform: truncate the kernel to the prior, so
+        # that every perturbed particle is inside the prior
+        low = numpy.array([k[0] for k in kernel[2]], dtype=float)
+        high = numpy.array([k[1] for k in kernel[2]], dtype=float)
+        lower_bound = numpy.array([priors[i].lower_bound for i in ind], dtype=float)
+        upper_bound = numpy.array([priors[i].upper_bound for i in ind], dtype=float)
+
+        lflag = (x + low) < lower_bound
+        uflag = (x + high) > upper_bound
+        lower = numpy.where(lflag, -(x - lower_bound), low)
+        upper = numpy.where(uflag, upper_bound - x, high)
+
+        # where truncated, decide if the particle is to be perturbed positively or negatively, then
+        # theta = theta + U(0, min(prior,kernel)) or theta = theta + U(max(prior,kernel), 0)
+        positive = rnd.uniform(0, 1, size=x.shape) > numpy.abs(lower) / (numpy.abs(lower) + upper)
+        truncated_delta = numpy.where(positive, rnd.uniform(0, 1, size=x.shape) * upper,
+                                      rnd.uniform(0, 1, size=x.shape) * lower)
+        delta = numpy.where(lflag | uflag, truncated_delta, rnd.uniform(low=low, high=high, size=x.shape))
+        ret[:, ind] = x + delta
+
+    elif kernel_type == KernelType.component_wise_uniform:
+        low = numpy.array([k[0] for k in kernel[2]], dtype=float)
+        high = numpy.array([k[1] for k in kernel[2]], dtype=float)
+        ret[:, ind] = x + rnd.uniform(low=low, high=high, size=x.shape)
+
+    elif kernel_type == KernelType.component_wise_normal:
+        scale = numpy.sqrt(numpy.array(kernel[2], dtype=float))
+        ret[:, ind] = rnd.normal(x, scale)
+
+    elif kernel_type == KernelType.multivariate_normal:
+        ret[:, ind] = kernel[3].sample(n, x)
+
+    elif kernel_type == KernelType.multivariate_normal_nn or kernel_type == KernelType.multivariate_normal_ocm:
+        ret[:, ind] = kernel[3].sample(n, x, index=index)
+
+    else:
+        sys.exit("Invalid kernel encountered by perturb_particles: " + repr(kernel_type))
+
+    return ret
+
+
+# Here params and params0 refer to one particle each, and index0 to the index of params0 in the kernel (only needed for
+# kernels with one covariance per particle)
 # Auxilliary is a vector size of nparameters
-def get_parameter_kernel_pdf(params, params0, priors, kernel, auxilliary, kernel_type):
+def get_parameter_kernel_pdf(params, params0, priors, kernel, auxilliary, kernel_type, index0=None):
 
     if kernel_type == KernelType.component_wise_uniform:
         prob = 1
@@ -271,115 +329,135 @@ def get_parameter_kernel_pdf(params, params0, priors, kernel, auxilliary, kernel
         for param_index in kernel[0]:
             p0.append(params0[param_index])
             p.append(params[param_index])
-        kern = statistics.get_pdf_multinormal(p0, kernel[2], p)
+        kern = numpy.exp(kernel[3].logpdf([p], p0)[0])
         kern = kern / auxilliary
         return kern
 
     elif kernel_type == KernelType.multivariate_normal_nn or kernel_type == KernelType.multivariate_normal_ocm:
         p0 = list()
         p = list()
-        d = kernel[2]
         for param_index in kernel[0]:
             p0.append(params0[param_index])
             p.append(params[param_index])
-        kern = statistics.get_pdf_multinormal(p0, d[str(params0)], p)
+        kern = numpy.exp(kernel[3].logpdf([p], p0, index=[index0])[0])
         kern = kern / auxilliary
         return kern
     else:
         sys.exit("Invalid kernel encountered by get_parameter_kernel_pdf: " + repr(kernel_type))
 
 
-# Here models and parameters refer to the whole population
-def get_auxilliary_info(kernel_type, models, parameters, model_objs, kernel):
+# Here params and params0 refer to whole sets of particles of one model.
+# This is the batched, log-space version of get_parameter_kernel_pdf
+def get_parameter_kernel_log_pdf_matrix(params, params0, priors, kernel, auxilliary, kernel_type):
+    """Evaluate the log kernel density of every new particle given every previous particle of the same model.
+
+    Parameters
+    ----------
+    params : ndarray of new particles, shape (n, nparam)
+    params0 : ndarray of previous particles, shape (m, nparam)
+    priors : list of priors for the model
+    kernel : kernel list for the model
+    auxilliary : the auxilliary information of the previous particles, as returned by get_auxilliary_info: shape
+        (m, nparam) for the component-wise normal kernel, shape (m,) for the multivariate normal kernels
+    kernel_type : the KernelType
+
+    params0 must be all of the particles of the model in the previous population, in order, so that params0[j] is
+    particle j of the kernel.
+
+    Returns
+    -------
+    ndarray of shape (n, m) whose entry [k, j] is log K(params[k] | params0[j])
+    """
+    params = numpy.asarray(params, dtype=float)
+    params0 = numpy.asarray(params0, dtype=float)
+    log_prob = numpy.zeros((params.shape[0], params0.shape[0]))
+
+    if kernel_type == KernelType.component_wise_uniform:
+        # accumulate one parameter at a time so that memory stays at (n, m)
+        for kernel_index, param_index in enumerate(kernel[0]):
+            diff = params[:, param_index, numpy.newaxis] - params0[numpy.newaxis, :, param_index]
+            log_prob += statistics.get_log_pdf_uniform(kernel[2][kernel_index][0], kernel[2][kernel_index][1], diff)
+        return log_prob
+
+    elif kernel_type == KernelType.component_wise_normal:
+        log_aux = numpy.log(numpy.asarray(auxilliary, dtype=float))
+        for kernel_index, param_index in enumerate(kernel[0]):
+            scale = numpy.sqrt(kernel[2][kernel_index])
+            log_prob += statistics.get_log_pdf_gauss(params0[numpy.newaxis, :, param_index], scale,
+                                                     params[:, param_index, numpy.newaxis])
+            log_prob -= log_aux[numpy.newaxis, :, param_index]
+        return log_prob
+
+    elif kernel_type == KernelType.multivariate_normal:
+        log_prob = kernel[3].logpdf_matrix(params[:, kernel[0]], params0[:, kernel[0]])
+        return log_prob - numpy.log(numpy.asarray(auxilliary, dtype=float))[numpy.newaxis, :]
+
+    elif kernel_type == KernelType.multivariate_normal_nn or kernel_type == KernelType.multivariate_normal_ocm:
+        log_prob = kernel[3].logpdf_matrix(params[:, kernel[0]], params0[:, kernel[0]])
+        return log_prob - numpy.log(numpy.asarray(auxilliary, dtype=float))[numpy.newaxis, :]
+    else:
+        sys.exit("Invalid kernel encountered by get_parameter_kernel_log_pdf_matrix: " + repr(kernel_type))
+
+
+# Here population refers to the whole population
+def get_auxilliary_info(kernel_type, population, model_objs, kernel, **kwds):
     """
     Return the 'Auxilliary Information' for a kernel
 
+    This is the mass of each particle's perturbation kernel inside the support of the prior, by which the kernel
+    density is normalized. It is computed a model at a time: the component-wise normal kernel uses vectorized
+    univariate normal cdfs, and the multivariate normal kernels only integrate numerically where they must (see
+    statistics.normal_box_mass).
+
     Parameters
     ----------
     kernel_type
-    models
-    parameters
+    population : the ParticlePopulation
     model_objs
     kernel : kernel list
+    kwds : optional keyword parameters to influence the numerical integration, see statistics.mvnormcdf
 
     Returns
     -------
-
+    a list with one entry per particle
     """
-    nparticles = len(parameters)
-    ret = []
+    nparticles = population.nparticles
+    ret = [0] * nparticles
 
-    for k in range(nparticles):
+    if population.model_position is None:
+        population.build_sampling_index()
 
-        this_prior = model_objs[models[k]].prior
-        this_kernel = kernel[models[k]]
-        nparam = model_objs[models[k]].nparameters
+    for model_index, model in enumerate(model_objs):
+        slots = population.model_indexes(model_index)
+        if len(slots) == 0:
+            continue
+        this_kernel = kernel[model_index]
+        ind = this_kernel[0]
+        this_parameters = population.parameters[model_index][slots]
 
-        if kernel_type == KernelType.component_wise_normal:
-            ret.append([1.0] * nparam)
+        # the kernel is truncated to the support of the prior: uniform priors to their bounds, lognormal priors to
+        # positive values, normal priors not at all
+        lower = model.compiled_prior.lower_bound[ind]
+        upper = model.compiled_prior.upper_bound[ind]
 
-            # ind is an integer between 0 and len(kernel[0])-1 which enables to determine the kernel to use
-            kernel_index = 0
+        if kernel_type == KernelType.component_wise_normal:
+            aux = numpy.ones((len(slots), model.nparameters))
             if not (len(this_kernel[2]) == 1):
-                for param_index in this_kernel[0]:
-                    # if prior is uniform
-                    if this_prior[param_index].type == PriorType.uniform:
-                        mean = parameters[k][param_index]
-                        scale = numpy.sqrt(this_kernel[2][kernel_index])
-                        ret[k][param_index] = norm.cdf(this_prior[param_index].upper_bound, mean, scale) - \
-                            norm.cdf(this_prior[param_index].lower_bound, mean, scale)
-
-                    # if prior is normal, no truncation required
-                    if this_prior[param_index].type == PriorType.normal:
-                        ret[k][param_index] = 1
-
-                    # if prior is lognormal, trucation for the negative values
-                    if this_prior[param_index].type == PriorType.lognormal:
-                        mean = parameters[k][param_index]
-                        scale = numpy.sqrt(this_kernel[2][kernel_index])
-                        ret[k][param_index] = 1 - norm.cdf(0, mean, scale)
-
-                    kernel_index += 1
-        elif kernel_type == KernelType.multivariate_normal:
-            up = list()
-            low = list()
-            mean = list()
-            for param_index in this_kernel[0]:
-                if this_prior[param_index].type == PriorType.uniform:
-                    low.append(this_prior[param_index].lower_bound)
-                    up.append(this_prior[param_index].upper_bound)
-                if this_prior[param_index].type == PriorType.normal:
-                    low.append(-float('inf'))
-                    up.append(float('inf'))
-                if this_prior[param_index].type == PriorType.lognormal:
-                    low.append(0)
-                    up.append(float('inf'))
-                mean.append(parameters[k][param_index])
-            scale = this_kernel[2]
-            ret.append(statistics.mvnormcdf(low, up, mean, scale))
-
-        elif kernel_type == KernelType.multivariate_normal_nn or kernel_type == KernelType.multivariate_normal_ocm:
-            up = list()
-            low = list()
-            mean = list()
-            for param_index in this_kernel[0]:
-                if this_prior[param_index].type == PriorType.uniform:
-                    low.append(this_prior[param_index].lower_bound)
-                    up.append(this_prior[param_index].upper_bound)
-                if this_prior[param_index].type == PriorType.normal:
-                    low.append(-float('inf'))
-                    up.append(float('inf'))
-                if this_prior[param_index].type == PriorType.lognormal:
-                    low.append(0)
-                    up.append(float('inf'))
-                mean.append(parameters[k][param_index])
-            cur_part = list()
-            for param_index in range(nparam):
-                cur_part.append(parameters[k][param_index])
-            d = this_kernel[2]
-            scale = d[str(cur_part)]
-            ret.append(statistics.mvnormcdf(low, up, mean, scale))
-        else:
-            ret = [0] * nparticles
+                scale = numpy.sqrt(numpy.asarray(this_kernel[2], dtype=float))
+                aux[:, ind] = statistics.normal_interval_mass(lower, upper, this_parameters[:, ind], scale)
+            for slot, row in zip(slots, aux.tolist()):
+                ret[slot] = row
+
+        elif kernel_type in (KernelType.multivariate_normal, KernelType.multivariate_normal_nn,
+                             KernelType.multivariate_normal_ocm):
+            means = this_parameters[:, ind]
+            covariances = numpy.asarray(this_kernel[2], dtype=float)
+            if kernel_type == KernelType.multivariate_normal:
+                covariances = numpy.broadcast_to(covariances, (len(slots),) + covariances.shape)
+
+            # the particles of a model are in kernel order, so means[i] goes with covariances[i]
+            mass = statistics.normal_box_mass(lower, upper, means, covariances, **kwds)
+            for slot, value in zip(slots, mass):
+                ret[slot] = value
 
     return ret
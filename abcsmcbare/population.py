@@ -0,0 +1,193 @@
+import numpy as np
+from numpy import random as rnd
+
+
+class ParticlePopulation(object):
+
+    """A population of particles, stored as preallocated arrays rather than lists of lists.
+
+    Particle i belongs to model models[i], has weight weights[i] and acceptance indicator b[i]. Its parameters are
+    parameters[models[i]][i]: there is one parameter array per model, of shape (nparticles, nparameters of that
+    model), so that models may have different numbers of parameters. The rows of a model's array that belong to
+    particles of other models are unused.
+
+    """
+
+    def __init__(self, nparticles, nparameters):
+        """Init.
+
+        Input:
+            nparticles: number of particles in the population
+            nparameters: list of the number of parameters of each model
+        """
+        self.nparticles = nparticles
+        self.nmodel = len(nparameters)
+        self.nparameters = list(nparameters)
+
+        self.models = np.zeros(nparticles, dtype=int)
+        self.weights = np.zeros(nparticles)
+        self.b = np.zeros(nparticles)
+        self.margins = np.zeros(self.nmodel)
+        self.parameters = [np.zeros((nparticles, n)) for n in self.nparameters]
+
+        # per-model slots and cumulative weights, built by build_sampling_index once the weights are final
+        self.sampling_indexes = None
+        self.sampling_cdf = None
+        # position of each particle among the particles of its model, also built by build_sampling_index
+        self.model_position = None
+
+    @classmethod
+    def from_arrays(cls, models, weights, parameters, margins):
+        """Return a population built on the given arrays without copying them, e.g. on memory-mapped arrays shared
+        between processes; it is only for sampling from, and must not be modified or reset.
+
+        Parameters
+        ----------
+        models, weights, margins : as the attributes of the same name
+        parameters : list of the full parameter array of each model, shape (nparticles, nparameters of the model)
+        """
+        ret = cls.__new__(cls)
+        ret.nparticles = len(models)
+        ret.nmodel = len(parameters)
+        ret.nparameters = [p.shape[1] for p in parameters]
+        ret.models = models
+        ret.weights = weights
+        ret.b = np.ones(ret.nparticles)
+        ret.margins = margins
+        ret.parameters = list(parameters)
+        ret.sampling_indexes = None
+        ret.sampling_cdf = None
+        ret.model_position = None
+        ret.build_sampling_index()
+        return ret
+
+    def reset(self):
+        """Clear the population in place, ready to be refilled."""
+        self.models[:] = 0
+        self.weights[:] = 0
+        self.b[:] = 0
+        self.margins[:] = 0
+        self.sampling_indexes = None
+        self.sampling_cdf = None
+        self.model_position = None
+
+    def set(self, slot, model_index, params, b=1):
+        """Store a particle in the given slot."""
+        self.models[slot] = model_index
+        self.parameters[model_index][slot, :] = params
+        self.b[slot] = b
+
+    def get_parameters(self, slot):
+        """Return the parameters of the particle in the given slot (a view, not a copy)."""
+        return self.parameters[self.models[slot]][slot]
+
+    def model_indexes(self, model_index):
+        """Return the slots of the particles belonging to a model, in increasing order."""
+        return np.flatnonzero(self.models == model_index)
+
+    def model_parameters(self, model_index):
+        """Return the parameters of the particles belonging to a model, shape (n, nparameters of the model)."""
+        return self.parameters[model_index][self.model_indexes(model_index)]
+
+    def model_weights(self, model_index):
+        """Return the weights of the particles belonging to a model."""
+        return self.weights[self.model_indexes(model_index)]
+
+    def normalize_weights(self):
+        """Normalize weights by dividing each by the total."""
+        self.weights /= float(np.sum(self.weights))
+
+    def update_margins(self):
+        """Re-calculate the marginal probability of each model as the sum of the weights of its particles."""
+        self.margins[:] = np.bincount(self.models, weights=self.weights, minlength=self.nmodel)
+
+    def build_sampling_index(self):
+        """Build, for each model, the cumulative weights of its particles so that they can be sampled by bisection.
+
+        This must be called again whenever the models or weights change. It also fills model_position, which maps each
+        slot to the position of the particle in model_indexes(models[slot]); kernels with one entry per particle are
+        indexed by this position.
+        """
+        self.sampling_indexes = []
+        self.sampling_cdf = []
+        self.model_position = np.zeros(self.nparticles, dtype=int)
+        for model_index in range(self.nmodel):
+            index = self.model_indexes(model_index)
+            self.sampling_indexes.append(index)
+            self.sampling_cdf.append(np.cumsum(self.weights[index]))
+            self.model_position[index] = np.arange(len(index))
+
+    def sample_particles(self, model_index, n):
+        """Draw n particles of a model with probability proportional to their weights.
+
+        Parameters
+        ----------
+        model_index : index of the model whose particles are sampled
+        n : number of draws
+
+        Returns
+        -------
+        an integer array of n slots
+        """
+        if self.sampling_cdf is None:
+            self.build_sampling_index()
+        index = self.sampling_indexes[model_index]
+        cdf = self.sampling_cdf[model_index]
+        if len(index) == 0:
+            raise ValueError('Cannot sample from model %d, it has no particles' % model_index)
+        u = rnd.uniform(low=0, high=cdf[-1], size=n)
+        position = np.minimum(np.searchsorted(cdf, u, side='right'), len(index) - 1)
+        return index[position]
+
+    def parameters_array(self):
+        """Return the parameters of every particle, in slot order.
+
+        If all models have the same number of parameters this is a 2D array; otherwise it is a 1D object array whose
+        entries are the parameter arrays of each particle.
+        """
+        if len(set(self.nparameters)) == 1:
+            ret = np.empty((self.nparticles, self.nparameters[0]))
+            for model_index in range(self.nmodel):
+                index = self.model_indexes(model_index)
+                ret[index] = self.parameters[model_index][index]
+        else:
+            ret = np.empty(self.nparticles, dtype=object)
+            for slot in range(self.nparticles):
+                ret[slot] = self.get_parameters(slot).copy()
+        return ret
+
+    def parameters_list(self):
+        """Return the parameters of every particle as a list of lists, as used by the pickled restart files."""
+        return [list(self.get_parameters(slot)) for slot in range(self.nparticles)]
+
+    def copy(self):
+        """Return a deep copy of the population."""
+        ret = ParticlePopulation(self.nparticles, self.nparameters)
+        ret.models[:] = self.models
+        ret.weights[:] = self.weights
+        ret.b[:] = self.b
+        ret.margins[:] = self.margins
+        for model_index in range(self.nmodel):
+            ret.parameters[model_index][:] = self.parameters[model_index]
+        return ret
+
+    def fill_arrays(self, models, weights, parameters, margins):
+        """Fill the population from arrays, with parameters[m] holding the parameters of the particles of model m in
+        slot order, as written by checkpoint.CheckpointStore."""
+        self.reset()
+        self.models[:] = models
+        self.b[:] = 1
+        for model_index in range(self.nmodel):
+            self.parameters[model_index][self.model_indexes(model_index)] = parameters[model_index]
+        self.weights[:] = weights
+        self.margins[:] = margins
+        self.build_sampling_index()
+
+    def fill(self, models, weights, parameters, margins):
+        """Fill the population from per-particle lists, e.g. those read back from the pickled restart files."""
+        self.reset()
+        for slot in range(self.nparticles):
+            self.set(slot, int(models[slot]), parameters[slot])
+        self.weights[:] = weights
+        self.margins[:] = margins
+        self.build_sampling_index()
@@ -0,0 +1,226 @@
+from __future__ import print_function
+import numpy as np
+from numpy import random as rnd
+from abcsmcbare import statistics
+from abcsmcbare.kernels import accepts_keyword
+
+
+class ProposalSampler(object):
+
+    """Draws the models and parameters proposed for simulation, from the prior or from the previous population.
+
+    This holds just the state proposals depend on, so that they can be drawn outside Abcsmc, e.g. in the worker
+    processes of executors.SharedMemoryBackend; Abcsmc builds one with proposal_sampler().
+    """
+
+    def __init__(self, models, modelprior, model_kernel, kernel_type, special_cases, population, kernels,
+                 dead_models, perturbfn, batchperturbfn, debug=0):
+        """Init.
+
+        Input:
+            models: the AbcModel objects
+            modelprior: the prior probability of each model
+            model_kernel: the probability of keeping the model of a particle when perturbing it
+            kernel_type: the KernelType of the parameter kernels
+            special_cases: for each model, 1 if its kernel is uniform and all its priors are uniform
+            population: the previous ParticlePopulation, with its sampling index built; None when sampling from the
+                prior
+            kernels: the parameter kernel of each model
+            dead_models: the models with no particles left
+            perturbfn, batchperturbfn: see Abcsmc
+            debug: debug level
+        """
+        self.models = models
+        self.nmodel = len(models)
+        self.modelprior = modelprior
+        self.model_kernel = model_kernel
+        self.kernel_type = kernel_type
+        self.special_cases = special_cases
+        self.population = population
+        self.kernels = kernels
+        self.dead_models = dead_models
+        self.perturbfn = perturbfn
+        # perturbfn is passed the position of the particle in the kernel only if it takes it; custom ones written
+        # before it did keep working with the kernels that do not need it
+        self.perturbfn_takes_index = accepts_keyword(perturbfn, 'index')
+        self.batchperturbfn = batchperturbfn
+        self.debug = debug
+
+    def propose(self, n, prior):
+        """Draw n models and parameters, from the prior or by perturbing the previous population.
+
+        Returns
+        -------
+        sampled_models_indexes, sampled_params
+        """
+        if not prior:
+            sampled_models_indexes = self.sample_models(n)
+            sampled_params = self.sample_parameters(sampled_models_indexes)
+        else:
+            sampled_models_indexes = self.sample_models_from_prior(n)
+            sampled_params = self.sample_parameters_from_prior(sampled_models_indexes)
+        return sampled_models_indexes, sampled_params
+
+    def sample_models_from_prior(self, n):
+        """
+        Returns a list of n model numbers, drawn from a categorical distribution with probabilities self.modelprior
+
+        """
+        models = [0] * n
+        if self.nmodel > 1:
+            models = list(statistics.w_choice_batch(self.modelprior, n))
+
+        return models
+
+    def sample_models(self, n):
+        """
+        Returns a list of n model numbers, obtained by sampling from a categorical distribution with probabilities
+        given by the model marginals of the previous population, and then perturbing with a uniform model
+        perturbation kernel.
+        """
+
+        models = [0] * n
+
+        if self.nmodel > 1:
+            # Sample models from prior distribution
+            models = list(statistics.w_choice_batch(self.population.margins, n))
+
+            # perturb models
+            if len(self.dead_models) < self.nmodel - 1:
+
+                for i in range(n):
+                    u = rnd.uniform(low=0, high=1)
+
+                    if u > self.model_kernel:
+                        # sample randomly from other (non dead) models
+                        not_available = set(self.dead_models[:])
+                        not_available.add(models[i])
+
+                        available_indexes = np.array(list(set(range(self.nmodel)) - not_available))
+                        rnd.shuffle(available_indexes)
+                        perturbed_model = available_indexes[0]
+
+                        models[i] = perturbed_model
+
+        return models[:]
+
+    def sample_parameters_from_prior(self, sampled_models_indexes):
+        """
+        For each model whose index is in sampled_models, draw a sample of the corresponding parameters.
+
+        Parameters
+        ----------
+        sampled_models : a list of model indexes
+
+        Returns
+        -------
+        a list of the same length, each entry of which is a list of parameter samples (whose length is
+                model.nparameters for the corresponding model)
+
+        """
+        samples = [None] * len(sampled_models_indexes)
+        model_indexes = np.array(sampled_models_indexes)
+
+        for model_num in range(self.nmodel):
+            mapping = np.flatnonzero(model_indexes == model_num)
+            if len(mapping) == 0:
+                continue
+
+            sample = self.models[model_num].compiled_prior.sample(len(mapping)).tolist()
+            for i, simulation_number in enumerate(mapping):
+                samples[simulation_number] = sample[i]
+
+        return samples
+
+    def sample_parameters(self, sampled_models_indexes):
+        """
+        For each model index in sampled_models_indexes, sample a set of parameters by sampling a particle from
+        the corresponding model (with probability biased by the particle weights), and then perturbing using the
+        parameter perturbation kernel; if this gives parameters with probability <=0 the process is repeated.
+
+        Parameters
+        ----------
+        sampled_models_indexes : a list of model indexes
+
+
+        Returns
+        -------
+        a list of the same length, each entry of which is a list of parameter samples (whose length is
+            model.nparameters for the corresponding model)
+
+        """
+        if self.debug == 2:
+            print("\t\t\t***sampleTheParameter")
+        samples = [None] * len(sampled_models_indexes)
+        model_indexes = np.array(sampled_models_indexes)
+        population = self.population
+
+        for model_num in range(self.nmodel):
+            mapping = np.flatnonzero(model_indexes == model_num)
+            if len(mapping) == 0:
+                continue
+            model = self.models[model_num]
+
+            # sample putative particles from previous population, all at once
+            ancestors = population.sample_particles(model_num, len(mapping))
+
+            if self.batchperturbfn is None:
+                for i, particle in zip(mapping, ancestors):
+                    samples[i] = self.perturb_one_particle(model_num, particle)
+                continue
+
+            # perturb the whole batch, then start again from freshly sampled particles for just the rows that fell
+            # outside the prior, until every row is valid
+            sample = np.empty((len(mapping), model.nparameters))
+            redo = np.arange(len(mapping))
+            while len(redo) > 0:
+                this_params = population.parameters[model_num][ancestors[redo]]
+                sample[redo] = self.batchperturbfn(this_params, model.prior, self.kernels[model_num],
+                                                   self.kernel_type, self.special_cases[model_num],
+                                                   index=population.model_position[ancestors[redo]])
+                redo = redo[~model.compiled_prior.in_support(sample[redo])]
+                if self.debug == 2:
+                    print("\t\t\tmodel / rows outside the prior:", model_num, len(redo))
+                ancestors[redo] = population.sample_particles(model_num, len(redo))
+
+            sample = sample.tolist()
+            for i, simulation_number in enumerate(mapping):
+                samples[simulation_number] = sample[i]
+
+        return samples
+
+    def perturb_one_particle(self, model_num, particle):
+        """Perturb a single particle with self.perturbfn, resampling it until the prior probability is positive.
+
+        Parameters
+        ----------
+        model_num : index of the model
+        particle : slot of the particle in the previous population
+
+        Returns
+        -------
+        a list of parameters
+        """
+        model = self.models[model_num]
+        population = self.population
+        prior_prob = -1
+        while prior_prob <= 0:
+
+            # Copy this particle's params into a new array, then perturb this in place using the parameter
+            #  perturbation kernel ALI
+            sample = list(population.get_parameters(particle))
+
+            kwds = {'index': population.model_position[particle]} if self.perturbfn_takes_index else {}
+            prior_prob = self.perturbfn(sample, model.prior, self.kernels[model_num],
+                                        self.kernel_type, self.special_cases[model_num], **kwds)
+
+            if self.debug == 2:
+                print("\t\t\tsampled p prob:", prior_prob)
+                print("\t\t\tnew:", sample)
+                print("\t\t\told:", population.get_parameters(particle))
+
+            if prior_prob <= 0:
+                # start again from a freshly sampled particle
+                particle = population.sample_particles(model_num, 1)[0]
+
+        return sample
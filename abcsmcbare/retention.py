@@ -0,0 +1,154 @@
+from __future__ import print_function
+import collections
+import os
+import time
+import numpy as np
+from .checkpoint import CheckpointStore, load_trajectories, save_trajectories
+
+
+# A retention policy decides which simulated trajectories stay in memory once a population is finished. Abcsmc calls
+# retain(results) on each AbcsmcResults as soon as it is complete (and checkpointed); the policy may replace its
+# trajectories with a subsample, a lazy loader or None, and may drop those of earlier results.
+#
+# AbcsmcResults.trajectories is None when the trajectories of a population were not kept, and
+# AbcsmcResults.trajectory_indexes gives the particles the kept trajectories belong to (None meaning all of them).
+
+
+class KeepAll(object):
+
+    """Keep every trajectory of every population in memory. This is the default."""
+
+    # whether Abcsmc needs to hold on to the trajectories of accepted particles at all
+    collect = True
+
+    def retain(self, results):
+        pass
+
+
+class KeepNone(object):
+
+    """Do not keep any trajectories; they are not even collected while a population is sampled."""
+
+    collect = False
+
+    def retain(self, results):
+        results.trajectories = None
+
+
+class KeepLast(object):
+
+    """Keep the trajectories of the last k populations only."""
+
+    collect = True
+
+    def __init__(self, k=1):
+        """Init.
+
+        Input:
+            k: number of populations whose trajectories are kept
+        """
+        self.k = k
+        self.kept = collections.deque()
+
+    def retain(self, results):
+        self.kept.append(results)
+        while len(self.kept) > self.k:
+            self.kept.popleft().trajectories = None
+
+
+class KeepThinned(object):
+
+    """Keep the trajectories of every step-th particle of each population."""
+
+    collect = True
+
+    def __init__(self, step=10):
+        """Init.
+
+        Input:
+            step: one particle in step has its trajectory kept
+        """
+        self.step = step
+
+    def retain(self, results):
+        indexes = np.arange(0, len(results.trajectories), self.step)
+        results.trajectories = [results.trajectories[i] for i in indexes]
+        results.trajectory_indexes = indexes
+
+
+class SpillToDisk(object):
+
+    """Keep the trajectories of each population on disk only, and load them back on demand.
+
+    Populations written to a checkpoint store (see InputOutput.write_checkpoint) already have their trajectories
+    there, so they are loaded back from the store rather than saved again. Those of other populations are written to
+    a file in folder.
+
+    Regular numeric trajectories are saved as .npy files and memory-mapped when accessed, so that only the parts in use
+    are read; trajectories of different shapes are pickled, and unpickled on every access.
+
+    """
+
+    collect = True
+
+    def __init__(self, folder=None, mmap_mode='r'):
+        """Init.
+
+        Input:
+            folder: folder for the trajectory files of populations that are not in a checkpoint store; it is created
+                if need be. May be None if every population is checkpointed.
+            mmap_mode: passed to numpy.load; None reads the whole population into memory on access
+        """
+        self.folder = folder
+        self.mmap_mode = mmap_mode
+        self.npopulations = 0
+        if folder is not None and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def retain(self, results):
+        self.npopulations += 1
+        if results.checkpoint_location is not None:
+            folder, index = results.checkpoint_location
+            results.trajectories = CheckpointTrajectoryLoader(folder, index, self.mmap_mode)
+            return
+        if self.folder is None:
+            raise ValueError('SpillToDisk needs a folder for populations that are not written to a checkpoint store')
+        name = save_trajectories(self.folder, results.trajectories, 'trajectories_%04d' % (self.npopulations - 1))
+        results.trajectories = TrajectoryLoader(os.path.join(self.folder, name), self.mmap_mode)
+
+
+class TrajectoryLoader(object):
+
+    """Picklable callable loading trajectories saved by checkpoint.save_trajectories; see AbcsmcResults.trajectories."""
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self.mmap_mode = mmap_mode
+
+    def __call__(self):
+        return load_trajectories(self.path, self.mmap_mode)
+
+
+class CheckpointTrajectoryLoader(object):
+
+    """Picklable callable loading the trajectories of a population of a checkpoint store.
+
+    With a background writer the population may not be in the store yet when its trajectories are first wanted; this
+    then waits for it, up to timeout seconds.
+    """
+
+    def __init__(self, folder, index, mmap_mode='r', timeout=60.0):
+        self.folder = folder
+        self.index = index
+        self.mmap_mode = mmap_mode
+        self.timeout = timeout
+
+    def __call__(self):
+        store = CheckpointStore(self.folder)
+        start = time.time()
+        while len(store) <= self.index:
+            if time.time() - start > self.timeout:
+                raise IOError('population %d was not written to the checkpoint store in %s' % (self.index, self.folder))
+            time.sleep(0.01)
+            store.manifest = store.read_manifest()
+        return store.load_trajectories(self.index, self.mmap_mode)
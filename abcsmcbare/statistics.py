@@ -5,6 +5,8 @@ from numpy import random as rnd
 from numpy import linalg as la
 import scipy
 import scipy.stats.mvn
+from scipy.stats import norm
+from scipy.spatial import cKDTree
 
 
 def w_choice(weight):
@@ -26,6 +28,25 @@ def w_choice(weight):
     return len(weight) - 1
 
 
+def w_choice_batch(weight, n):
+    """Draw n samples from the categorical distribution with probabilities given by weight.
+
+    This is the vectorized equivalent of calling w_choice n times.
+
+    Parameters
+    ----------
+    weight : list of probability for each category
+    n : number of samples
+
+    Returns
+    -------
+    an integer array of length n
+    """
+    cdf = np.cumsum(weight)
+    u = rnd.random_sample(n)
+    return np.minimum(np.searchsorted(cdf, u, side='right'), len(weight) - 1)
+
+
 def get_pdf_uniform(min_val, max_val, x):
     """Evaluate the P(x) for x ~ U(min_val, max_val).
 
@@ -66,9 +87,252 @@ def get_pdf_lognormal(m, sigma, x):
     sigma : standard deviation of the associated normal
     m : mean of the associated normal
     """
-    x = np.exp(-0.5 * (np.log(x) - m) * (np.log(x) - m) / (sigma * sigma))
-    x = x / (x * sigma * np.sqrt(2 * np.pi))
-    return x
+    p = np.exp(-0.5 * (np.log(x) - m) * (np.log(x) - m) / (sigma * sigma))
+    p = p / (x * sigma * np.sqrt(2 * np.pi))
+    return p
+
+
+def get_log_pdf_uniform(min_val, max_val, x):
+    """Evaluate log P(x) for x ~ U(min_val, max_val), element-wise.
+
+    Parameters
+    ----------
+    x : array of values at which to evaluate the log p.d.f
+    max_val : max value(s) of uniform distribution, broadcast against x
+    min_val : min value(s) of uniform distribution, broadcast against x
+    """
+    x = np.asarray(x, dtype=float)
+    inside = (x >= min_val) & (x <= max_val)
+    return np.where(inside, -np.log(np.subtract(max_val, min_val, dtype=float)), -np.inf)
+
+
+def get_log_pdf_gauss(m, scale, x):
+    """Evaluate log P(x) for Gaussian distribution, x ~ N(m, scale^2), element-wise.
+
+    Parameters
+    ----------
+    x : array of values at which to evaluate the log p.d.f
+    scale : standard deviation(s) of the Gaussian, broadcast against x
+    m : mean(s) of the Gaussian, broadcast against x
+    """
+    z = (np.asarray(x, dtype=float) - m) / scale
+    return -0.5 * z * z - np.log(scale) - 0.5 * np.log(2 * np.pi)
+
+
+def get_log_pdf_lognormal(m, sigma, x):
+    """Evaluate log P(x) for lognormal distribution, x ~ ln N(m, sigma^2), element-wise.
+
+    Parameters
+    ----------
+    x : array of values at which to evaluate the log p.d.f; non-positive values have log p.d.f -inf
+    sigma : standard deviation of the associated normal
+    m : mean of the associated normal
+    """
+    x = np.asarray(x, dtype=float)
+    positive = x > 0
+    log_x = np.log(np.where(positive, x, 1.0))
+    z = (log_x - m) / sigma
+    ret = -0.5 * z * z - log_x - np.log(sigma) - 0.5 * np.log(2 * np.pi)
+    return np.where(positive, ret, -np.inf)
+
+
+def cholesky(covariances):
+    """Compute the lower Cholesky factor of a covariance matrix, or of a stack of them.
+
+    Matrices that are not numerically positive definite (e.g. the covariance of fewer particles than dimensions) get a
+    small multiple of their mean variance added to the diagonal until they are.
+
+    Parameters
+    ----------
+    covariances : array of shape (..., d, d)
+
+    Returns
+    -------
+    an array of the same shape
+    """
+    covariances = np.array(covariances, dtype=float)
+    try:
+        return la.cholesky(covariances)
+    except la.LinAlgError:
+        pass
+
+    d = covariances.shape[-1]
+    flat = covariances.reshape((-1, d, d))
+    ret = np.empty_like(flat)
+    for i in range(flat.shape[0]):
+        jitter = 1e-10 * max(np.trace(flat[i]) / max(d, 1), 1e-300)
+        while True:
+            try:
+                ret[i] = la.cholesky(flat[i] + jitter * np.eye(d))
+                break
+            except la.LinAlgError:
+                jitter *= 10
+    return ret.reshape(covariances.shape)
+
+
+class FactorizedGaussian(object):
+
+    """A multivariate normal distribution whose covariance is factorized once, for repeated sampling and evaluation.
+
+    The covariance may be a single (d, d) matrix, or a stack of them of shape (m, d, d), e.g. one per particle; in
+    the latter case sample and logpdf take the index of the covariance to use for each row. The Cholesky factor, its
+    inverse and the log-determinant are computed on construction, so that every later call is a matrix product.
+
+    """
+
+    def __init__(self, covariance, chol=None):
+        """Init.
+
+        Input:
+            covariance: covariance matrix, shape (d, d), or stack of covariance matrices, shape (m, d, d)
+            chol: the Cholesky factor(s) of covariance, if already known
+        """
+        self.covariance = np.array(covariance, dtype=float)
+        self.stacked = self.covariance.ndim == 3
+        self.dimension = self.covariance.shape[-1]
+        self.chol = cholesky(self.covariance) if chol is None else np.array(chol, dtype=float)
+        self.chol_inv = la.inv(self.chol)
+        self.log_det = 2 * np.sum(np.log(np.diagonal(self.chol, axis1=-2, axis2=-1)), axis=-1)
+
+    @classmethod
+    def from_factors(cls, covariance, chol, chol_inv, log_det):
+        """Rebuild a FactorizedGaussian from its arrays, as stored elsewhere (e.g. memory-mapped), without copying or
+        factorizing them again."""
+        ret = cls.__new__(cls)
+        ret.covariance = covariance
+        ret.stacked = covariance.ndim == 3
+        ret.dimension = covariance.shape[-1]
+        ret.chol = chol
+        ret.chol_inv = chol_inv
+        ret.log_det = log_det
+        return ret
+
+    def _select(self, n, index):
+        """Return the Cholesky inverse(s) and log-determinant(s) for n rows; for a stack, index chooses one per row."""
+        if not self.stacked:
+            return self.chol, self.chol_inv, self.log_det
+        if index is None:
+            index = np.arange(n)
+        index = np.asarray(index, dtype=int)
+        return self.chol[index], self.chol_inv[index], self.log_det[index]
+
+    def sample(self, n, mean=0, index=None):
+        """Draw n samples.
+
+        Parameters
+        ----------
+        n : number of samples
+        mean : mean vector, shape (d,), or one per sample, shape (n, d)
+        index : for a stack of covariances, the index of the covariance of each sample; defaults to range(n)
+
+        Returns
+        -------
+        an array of shape (n, d)
+        """
+        chol, _, _ = self._select(n, index)
+        z = rnd.normal(0, 1, (n, self.dimension))
+        if self.stacked:
+            return mean + np.einsum('kab,kb->ka', chol, z)
+        return mean + np.dot(z, chol.T)
+
+    def logpdf(self, x, mean=0, index=None):
+        """Evaluate the log p.d.f. at each row of x.
+
+        Parameters
+        ----------
+        x : values at which to evaluate the log p.d.f, shape (n, d)
+        mean : mean vector, shape (d,), or one per row, shape (n, d)
+        index : for a stack of covariances, the index of the covariance of each row; defaults to range(n)
+
+        Returns
+        -------
+        an array of length n
+        """
+        diff = np.asarray(x, dtype=float) - mean
+        _, chol_inv, log_det = self._select(diff.shape[0], index)
+        if self.stacked:
+            z = np.einsum('kab,kb->ka', chol_inv, diff)
+        else:
+            z = np.dot(diff, chol_inv.T)
+        return -0.5 * (np.sum(z * z, axis=1) + log_det + self.dimension * np.log(2 * np.pi))
+
+    def logpdf_matrix(self, x, means, block_size=2 ** 22):
+        """Evaluate log N(x_k | means_j) for every pair of points x_k and means_j.
+
+        For a stack of covariances, means_j uses covariance j.
+
+        Parameters
+        ----------
+        x : values at which to evaluate the log p.d.f, shape (n, d)
+        means : mean vectors, shape (m, d)
+        block_size : maximum number of floats in the (rows, m, d) intermediate; rows of x are processed in blocks so
+            that memory stays bounded for large populations
+
+        Returns
+        -------
+        an array of shape (n, m)
+        """
+        x = np.asarray(x, dtype=float)
+        means = np.asarray(means, dtype=float)
+        n, d = x.shape
+        m = means.shape[0]
+
+        ret = np.empty((n, m))
+        rows = max(1, block_size // max(1, m * d))
+        for start in range(0, n, rows):
+            diff = x[start:start + rows, np.newaxis, :] - means[np.newaxis, :, :]
+            if self.stacked:
+                z = np.einsum('jab,kjb->kja', self.chol_inv, diff)
+            else:
+                z = np.einsum('ab,kjb->kja', self.chol_inv, diff)
+            ret[start:start + rows] = -0.5 * np.sum(z * z, axis=2)
+        return ret - 0.5 * (self.log_det + d * np.log(2 * np.pi))
+
+
+def cholesky_rank_one_update(chol, v):
+    """Compute the Cholesky factors of C + v_n v_n^T for each of a set of vectors v_n, given the factor of C.
+
+    This costs O(d^2) per vector rather than the O(d^3) of factorizing each matrix again.
+
+    Parameters
+    ----------
+    chol : lower Cholesky factor of C, shape (d, d), or one per vector, shape (n, d, d)
+    v : the vectors, shape (n, d)
+
+    Returns
+    -------
+    an array of shape (n, d, d)
+    """
+    v = np.array(v, dtype=float)
+    n, d = v.shape
+    ret = np.array(np.broadcast_to(chol, (n, d, d)), dtype=float)
+    for k in range(d):
+        diagonal = ret[:, k, k]
+        r = np.sqrt(diagonal * diagonal + v[:, k] * v[:, k])
+        c = (r / diagonal)[:, np.newaxis]
+        s = (v[:, k] / diagonal)[:, np.newaxis]
+        ret[:, k, k] = r
+        ret[:, k + 1:, k] = (ret[:, k + 1:, k] + s * v[:, k + 1:]) / c
+        v[:, k + 1:] = c * v[:, k + 1:] - s * ret[:, k + 1:, k]
+    return ret
+
+
+def get_log_pdf_multinormal_matrix(x, means, covariances, block_size=2 ** 22):
+    """Evaluate log N(x_k | means_j, covariances) for every pair of points x_k and means_j.
+
+    Parameters
+    ----------
+    x : values at which to evaluate the log p.d.f, shape (n, d)
+    means : mean vectors, shape (m, d)
+    covariances : either a single covariance matrix of shape (d, d) shared by all means, or one covariance
+        matrix per mean, shape (m, d, d)
+    block_size : maximum number of floats in the (rows, m, d) intermediate
+
+    Returns
+    -------
+    an array of shape (n, m)
+    """
+    return FactorizedGaussian(covariances).logpdf_matrix(x, means, block_size)
 
 
 # compute the pdf of a multinormal distribution
@@ -85,14 +349,7 @@ def get_pdf_multinormal(x, covariances, m):
     -------
 
     """
-    a = 0
-    k = len(x)
-    inv = la.inv(covariances)
-    for i in range(k):
-        for j in range(k):
-            a += inv[i, j] * (x[i] - m[i]) * (x[j] - m[j])
-    det = la.det(covariances)
-    return np.exp(-1.0 * a / 2.0) / (np.sqrt((2 * np.pi) ** k * det))
+    return np.exp(FactorizedGaussian(covariances).logpdf([x], m)[0])
 
 
 def wtvar(x, weights, method="R"):
@@ -102,7 +359,7 @@ def wtvar(x, weights, method="R"):
 
     Parameters
     ----------
-    x : measurements
+    x : measurements, shape (num_samples,), or (num_samples, num_dimensions) for the variance of each column
     weights : weigths for each measurement
     method : 'R' (Default) or 'nist'
 
@@ -110,17 +367,18 @@ def wtvar(x, weights, method="R"):
     -------
     the weighted variance of the measurements
     """
-    sum_w = sum(weights)
+    x = np.asarray(x, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    sum_w = np.sum(weights)
+    x_bar_wt = np.tensordot(weights, x, axes=1) / sum_w
+    sum_sq = np.dot(weights, (x - x_bar_wt) ** 2)
     if method == "nist":
-        x_bar_wt = sum([weights0 * x0 for weights0, x0 in zip(weights, x)]) / sum_w  # fixed.2009.03.07, divisor added.
-        np = sum([1 if (weights0 != 0) else 0 for weights0 in weights])
-        d = sum_w * (np - 1.0) / np
-        return sum([weights0 * (x0 - x_bar_wt) ** 2 for weights0, x0 in zip(weights, x)]) / d
+        n = np.count_nonzero(weights)
+        d = sum_w * (n - 1.0) / n
+        return sum_sq / d
     else:
-        sum_w2 = sum([weights0 ** 2 for weights0 in weights])
-        x_bar_wt = sum([(weights0 * x0) for (weights0, x0) in zip(weights, x)]) / sum_w
-        return sum([(weights0 * (x0 - x_bar_wt) ** 2) for (weights0, x0) in zip(weights, x)]) * sum_w / (
-            sum_w ** 2 - sum_w2)
+        sum_w2 = np.dot(weights, weights)
+        return sum_sq * sum_w / (sum_w ** 2 - sum_w2)
 
 
 def mvnd_gen(m, c):
@@ -135,14 +393,7 @@ def mvnd_gen(m, c):
     -------
     a sample from the distribution
     """
-    a = list(rnd.normal(0, 1, len(m)))
-    lambdas, vect = la.eig(c)
-    print(lambdas)
-    tmp = np.mat(vect) * np.mat(np.diag(np.sqrt(lambdas))) * np.transpose(np.mat(a))
-    res = list()
-    for i in range(len(m)):
-        res.append(m[i] + tmp[i, 0])
-    return res
+    return list(FactorizedGaussian(c).sample(1, np.asarray(m, dtype=float))[0])
 
 
 def mvstdnormcdf(lower, upper, corr_coef, **kwds):
@@ -214,7 +465,7 @@ def mvstdnormcdf(lower, upper, corr_coef, **kwds):
     upper = np.array(upper)
     corr_coef = np.array(corr_coef)
 
-    correl = np.zeros(n * (n - 1) / 2.0)  # dtype necessary?
+    correl = np.zeros(n * (n - 1) // 2)  # dtype necessary?
 
     if (lower.ndim != 1) or (upper.ndim != 1):
         raise ValueError('can handle only 1D bounds')
@@ -224,12 +475,13 @@ def mvstdnormcdf(lower, upper, corr_coef, **kwds):
 
     if n == 2 and corr_coef.size == 1:
         correl = corr_coef
-    elif corr_coef.ndim == 1 and len(corr_coef) == n * (n - 1) / 2.0:
+    elif corr_coef.ndim == 1 and len(corr_coef) == n * (n - 1) // 2:
         correl = corr_coef
     elif corr_coef.shape == (n, n):
+        # the strictly lower triangle, stacked by rows
         for ii in range(n):
             for jj in range(ii):
-                correl[jj + ((ii - 2) * (ii - 1)) / 2] = corr_coef[ii, jj]
+                correl[jj + (ii * (ii - 1)) // 2] = corr_coef[ii, jj]
     else:
         raise ValueError('corrcoef has incorrect dimension')
 
@@ -304,6 +556,87 @@ def mvnormcdf(lower, upper, mu, c, **kwds):
     return mvstdnormcdf(lower, upper, corr, **kwds)
 
 
+def normal_interval_mass(lower, upper, mean, scale):
+    """Compute the probability mass of N(mean, scale**2) inside [lower, upper], element-wise.
+
+    Infinite bounds are handled without evaluating the cdf at them, and upper tails use the survival function so that
+    small masses are not lost to cancellation.
+
+    Parameters
+    ----------
+    lower, upper : integration limits, may contain -np.inf or np.inf
+    mean : mean(s)
+    scale : standard deviation(s)
+
+    Returns
+    -------
+    an array of the broadcast shape of the inputs
+    """
+    lower, upper, mean, scale = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in (lower, upper, mean, scale)])
+    ret = np.ones(lower.shape)
+    lower_finite = ~np.isneginf(lower)
+    upper_finite = ~np.isposinf(upper)
+
+    only_lower = lower_finite & ~upper_finite
+    ret[only_lower] = norm.sf((lower[only_lower] - mean[only_lower]) / scale[only_lower])
+
+    only_upper = upper_finite & ~lower_finite
+    ret[only_upper] = norm.cdf((upper[only_upper] - mean[only_upper]) / scale[only_upper])
+
+    both = lower_finite & upper_finite
+    ret[both] = norm.cdf((upper[both] - mean[both]) / scale[both]) - norm.cdf((lower[both] - mean[both]) / scale[both])
+    return ret
+
+
+def normal_box_mass(lower, upper, means, covariances, **kwds):
+    """Compute the probability mass of each of a set of multivariate normal distributions inside the same box.
+
+    Dimensions with both bounds infinite are marginalised out; if a single dimension remains, or the remaining
+    dimensions are uncorrelated, the mass is a product of vectorized univariate masses. Only the remaining rows are
+    integrated numerically, one mvstdnormcdf call each.
+
+    Parameters
+    ----------
+    lower, upper : integration limits, shape (d,); may contain -np.inf or np.inf
+    means : mean vectors, shape (m, d)
+    covariances : a covariance matrix shared by all means, shape (d, d), or one per mean, shape (m, d, d)
+    optional keyword parameters to influence the numerical integration, passed to mvstdnormcdf
+        * maxpts : int, maximum number of function values allowed.
+        * abseps : float absolute error tolerance.
+        * releps : float relative error tolerance.
+
+    Returns
+    -------
+    an array of length m
+    """
+    lower = np.asarray(lower, dtype=float)
+    upper = np.asarray(upper, dtype=float)
+    means = np.asarray(means, dtype=float)
+    covariances = np.asarray(covariances, dtype=float)
+    m = means.shape[0]
+
+    bounded = ~(np.isneginf(lower) & np.isposinf(upper))
+    if m == 0 or not np.any(bounded):
+        return np.ones(m)
+
+    lower = lower[bounded]
+    upper = upper[bounded]
+    means = means[:, bounded]
+    covariances = np.broadcast_to(covariances, (m,) + covariances.shape[-2:])[:, bounded][:, :, bounded]
+    stdev = np.sqrt(np.diagonal(covariances, axis1=1, axis2=2))
+
+    ret = np.prod(normal_interval_mass(lower, upper, means, stdev), axis=1)
+    if len(lower) == 1:
+        return ret
+
+    corr = covariances / stdev[:, :, np.newaxis] / stdev[:, np.newaxis, :]
+    off_diagonal = ~np.eye(len(lower), dtype=bool)
+    correlated = np.flatnonzero(np.any(corr[:, off_diagonal] != 0, axis=1))
+    for i in correlated:
+        ret[i] = mvstdnormcdf((lower - means[i]) / stdev[i], (upper - means[i]) / stdev[i], corr[i], **dict(kwds))
+    return ret
+
+
 def k_nearest_neighbours(ind, s, k):
     """Compute the k nearest neighbors of a point inside a set S of points using the Euclidian distance.
 
@@ -334,30 +667,156 @@ def k_nearest_neighbours(ind, s, k):
     return k_min
 
 
-def compute_cov(x, weights):
-    """Compute the weighted covariance matrix for a set of measurements, by first calculating the weighted mean.
+def k_nearest_neighbours_all(points, k):
+    """Compute the k nearest neighbours of every point of a set, using the Euclidian distance.
+
+    All of the queries are answered by a single KD-tree, rather than by a linear scan per point.
 
     Parameters
     ----------
-    x : measurements
-    weights : weights
+    points : positions of points, shape (n, d)
+    k : the number of nearest-neighbours to identify; each point is its own nearest neighbour
 
     Returns
     -------
+    an integer array of shape (n, min(k, n)), the indexes of the neighbours of each point, nearest first
+    """
+    points = np.asarray(points, dtype=float)
+    k = max(1, min(k, points.shape[0]))
+    _, index = cKDTree(points).query(points, k=k)
+    return np.asarray(index, dtype=int).reshape((points.shape[0], k))
+
 
+def weighted_mean(x, weights):
+    """Compute the weighted mean of each of a stack of sets of measurements.
+
+    Parameters
+    ----------
+    x : measurements, shape (..., num_samples, num_dimensions)
+    weights : weights, shape (..., num_samples)
+
+    Returns
+    -------
+    an array of shape (..., num_dimensions)
+    """
+    weights = np.asarray(weights, dtype=float)
+    return np.einsum('...n,...nd->...d', weights, np.asarray(x, dtype=float)) / np.sum(weights, axis=-1)[..., np.newaxis]
+
+
+def compute_cov_stack(x, weights):
+    """Compute the weighted covariance matrix of each of a stack of sets of measurements.
+
+    Parameters
+    ----------
+    x : measurements, shape (..., num_samples, num_dimensions)
+    weights : weights, shape (..., num_samples)
+
+    Returns
+    -------
+    an array of shape (..., num_dimensions, num_dimensions)
     """
-    num_dimensions = len(x)
-    num_samples = len(x[0])
+    x = np.asarray(x, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    weights = weights / np.sum(weights, axis=-1)[..., np.newaxis]
+    diff = x - weighted_mean(x, weights)[..., np.newaxis, :]
+    # sum_n w_n diff_n diff_n^T as a (batched) matrix product of the centred measurements
+    return np.matmul(np.swapaxes(diff * weights[..., np.newaxis], -1, -2), diff)
 
-    # Calculate weighted mean of the samples
-    m = list()
-    for d in range(num_dimensions):
-        m.append(0)
-        for sample in range(num_samples):
-            m[d] += weights[sample] * x[d][sample]
-        m[d] = m[d] / sum(weights)
 
-    return compute_optcovmat(x, weights, m)
+def compute_neighbourhood_covs(points, neighbours, weights, block_size=2 ** 22):
+    """Compute the weighted covariance matrix of the neighbourhood of each of a set of points.
+
+    The neighbourhoods are gathered and reduced a block of points at a time, so that memory stays bounded by
+    block_size rather than growing as num_points * k * num_dimensions.
+
+    Parameters
+    ----------
+    points : positions of the points, shape (num_points, num_dimensions)
+    neighbours : the indexes of the neighbours of each point, shape (num_points, k), e.g. from
+        k_nearest_neighbours_all
+    weights : weights of the points, shape (num_points,)
+    block_size : maximum number of floats in the (block, k, num_dimensions) neighbourhoods
+
+    Returns
+    -------
+    an array of shape (num_points, num_dimensions, num_dimensions)
+    """
+    points = np.asarray(points, dtype=float)
+    neighbours = np.asarray(neighbours, dtype=int)
+    weights = np.asarray(weights, dtype=float)
+    npoints, k = neighbours.shape
+    ndim = points.shape[1]
+    ret = np.empty((npoints, ndim, ndim))
+    rows = max(1, block_size // max(1, k * ndim))
+    for start in range(0, npoints, rows):
+        index = neighbours[start:start + rows]
+        ret[start:start + rows] = compute_cov_stack(points[index], weights[index])
+    return ret
+
+
+def compute_optcovmat_stack(x, weights, means):
+    """Compute the weighted second moment matrix of a set of measurements about each of a set of means.
+
+    This is compute_optcovmat for every mean at once. The second moment about m is the covariance plus
+    (mu - m)(mu - m)^T, where mu is the weighted mean, so only one pass over the measurements is needed.
+
+    Parameters
+    ----------
+    x : measurements, shape (num_samples, num_dimensions)
+    weights : weights, shape (num_samples,)
+    means : the means, shape (num_means, num_dimensions)
+
+    Returns
+    -------
+    an array of shape (num_means, num_dimensions, num_dimensions)
+    """
+    x = np.asarray(x, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    offset = weighted_mean(x, weights) - np.asarray(means, dtype=float)
+    return compute_cov_stack(x, weights) + offset[:, :, np.newaxis] * offset[:, np.newaxis, :]
+
+
+def compute_ocm(x, weights):
+    """Compute the optimal local covariance matrix (OCM) of each measurement in a set, with its Cholesky factor.
+
+    The OCM of x_n is the weighted second moment of the whole set about x_n, i.e. compute_optcovmat_stack with the
+    measurements themselves as the means. As this is the covariance C plus the rank one term (mu - x_n)(mu - x_n)^T,
+    all of the factors are rank one updates of the single factor of C.
+
+    Parameters
+    ----------
+    x : measurements, shape (num_samples, num_dimensions)
+    weights : weights, shape (num_samples,)
+
+    Returns
+    -------
+    covariances, chol : arrays of shape (num_samples, num_dimensions, num_dimensions)
+    """
+    x = np.asarray(x, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    cov = compute_cov_stack(x, weights)
+    chol = cholesky(cov)
+    # cholesky adds jitter to the diagonal of a singular C (e.g. fewer particles than dimensions); build the
+    # covariances from the matrix that was factorized, so that they agree with their factors
+    cov = np.dot(chol, chol.T)
+    offset = weighted_mean(x, weights) - x
+    covariances = cov + offset[:, :, np.newaxis] * offset[:, np.newaxis, :]
+    return covariances, cholesky_rank_one_update(chol, offset)
+
+
+def compute_cov(x, weights):
+    """Compute the weighted covariance matrix for a set of measurements, by first calculating the weighted mean.
+
+    Parameters
+    ----------
+    x : measurements, x[dimension][sample]
+    weights : weights
+
+    Returns
+    -------
+    the covariance matrix, shape (num_dimensions, num_dimensions)
+    """
+    return compute_cov_stack(np.asarray(x, dtype=float).T, weights)
 
 
 def compute_optcovmat(x, weights, m):
@@ -365,34 +824,14 @@ def compute_optcovmat(x, weights, m):
 
     Parameters
     ----------
-    x : measurements
+    x : measurements, x[dimension][sample]
     weights : weights
     m : mean
 
     Returns
     -------
-
+    the covariance matrix, shape (num_dimensions, num_dimensions)
     """
-    num_dimensions = len(x)
-    num_samples = len(x[0])
-    c = np.zeros([num_dimensions, num_dimensions], float)
-
-    # Fill in upper-half of c
-    for sample in range(num_samples):
-        for d1 in range(num_dimensions):
-            for d2 in range(d1):
-                c[d1, d2] += weights[sample] * (x[d1][sample] - m[d1]) * (x[d2][sample] - m[d2])
-
-    # Fill in lower-half by symmetry
-    c = c + np.transpose(c)
-
-    # Fill in diagonal
-    for sample in range(num_samples):
-        for d1 in range(num_dimensions):
-            c[d1, d1] += weights[sample] * (x[d1][sample] - m[d1]) * (x[d1][sample] - m[d1])
-
-    # Divide every element by the total weight
-    for d1 in range(num_dimensions):
-        for d2 in range(num_dimensions):
-            c[d1, d2] = c[d2, d2] / sum(weights)
-    return c
+    weights = np.asarray(weights, dtype=float)
+    diff = np.asarray(x, dtype=float).T - np.asarray(m, dtype=float)
+    return np.einsum('n,na,nb->ab', weights, diff, diff) / np.sum(weights)
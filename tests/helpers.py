@@ -0,0 +1,58 @@
+from __future__ import print_function
+import numpy as np
+from abcsmcbare import abcsmc, abcModel
+from abcsmcbare.KernelType import KernelType
+from abcsmcbare.Prior import Prior
+from abcsmcbare.PriorType import PriorType
+
+
+# Small models shared by the tests: the simulators return the first two parameters of each particle, with a little
+# noise, and DATA is the point they are fitted to.
+
+DATA = np.array([1.0, 2.0])
+
+
+def simulate(params, pool=None):
+    params = np.array([np.asarray(p, dtype=float) for p in params])
+    return params[:, :2] + 0.1 * np.random.randn(len(params), 2)
+
+
+def distance(simulation, data, params, model):
+    return float(np.sqrt(np.sum((simulation - data) ** 2)))
+
+
+def batch_distance(simulations, data, params, model):
+    return np.sqrt(np.sum((np.asarray(simulations) - data) ** 2, axis=1))
+
+
+class NullIO(object):
+
+    """Stands in for input_output.InputOutput when nothing needs to be written."""
+
+    def write_checkpoint(self, *args):
+        pass
+
+
+def make_models(**kwds):
+    """Two models: one with two uniform parameters, one with a normal, a lognormal and a constant parameter.
+
+    kwds are passed on to both AbcModels.
+    """
+    uniform = Prior(type=PriorType.uniform, lower_bound=0.0, upper_bound=5.0)
+    normal = Prior(type=PriorType.normal, mean=2.0, variance=1.0)
+    lognormal = Prior(type=PriorType.lognormal, mu=0.5, sigma=0.25)
+    constant = Prior(type=PriorType.constant, value=1.0)
+    kwds.setdefault('distanceFn', distance)
+    return [abcModel.AbcModel('M1', simulate, prior=[uniform, uniform], nparameters=2, **kwds),
+            abcModel.AbcModel('M2', simulate, prior=[normal, lognormal, constant], nparameters=3, **kwds)]
+
+
+def make_abcsmc(kernel_type=KernelType.component_wise_normal, nparticles=40, nbatch=20, models=None, io=None,
+                **kwds):
+    """An Abcsmc fitting make_models() to DATA; kwds are passed on to Abcsmc."""
+    if models is None:
+        models = make_models()
+    if io is None:
+        io = NullIO()
+    return abcsmc.Abcsmc(models, nparticles, [1.0 / len(models)] * len(models), DATA, nbatch, 0.7, 0, False, io,
+                         kernel_type=kernel_type, **kwds)
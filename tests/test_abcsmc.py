@@ -0,0 +1,197 @@
+import concurrent.futures
+import numpy as np
+import pytest
+from abcsmcbare import executors
+from abcsmcbare.KernelType import KernelType
+import helpers
+
+
+class StragglerBackend(executors.SerialBackend):
+
+    """Runs every simulation at once, except the first one submitted, which never finishes."""
+
+    def __init__(self):
+        super(StragglerBackend, self).__init__()
+        self.futures = []
+
+    def submit(self, model_index, parameters, epsilon, do_comp=True):
+        if len(self.futures) == 0:
+            future = concurrent.futures.Future()
+        else:
+            future = super(StragglerBackend, self).submit(model_index, parameters, epsilon, do_comp)
+        self.futures.append((future, parameters[0]))
+        return future
+
+
+def test_async_scheduler_does_not_wait_for_stragglers():
+    np.random.seed(5)
+    backend = StragglerBackend()
+    a = helpers.make_abcsmc(backend=backend, scheduler='async', ninflight=4)
+    results = a.run_schedule([3.0])[-1]
+
+    straggler, straggler_params = backend.futures[0]
+    assert straggler.cancelled()
+    assert not any(list(p) == list(straggler_params) for p in a.population_prev.parameters_list())
+    # every simulation that finished was examined, in order, until the population was full
+    assert results.sampled <= len(backend.futures) - 1
+    assert results.naccepted == a.nparticles
+    assert results.rate == pytest.approx(float(a.nparticles) / results.sampled)
+
+
+@pytest.mark.parametrize('backend', [None, executors.ProcessPoolBackend(max_workers=2)])
+def test_async_scheduler_fills_each_population(backend):
+    np.random.seed(5)
+    a = helpers.make_abcsmc(backend=backend, scheduler='async', ninflight=4)
+    all_results = a.run_schedule([3.0, 2.0, 1.5])
+    for results, epsilon in zip(all_results, [3.0, 2.0, 1.5]):
+        assert results.naccepted == a.nparticles
+        assert all(d < epsilon for d in results.distances)
+        np.testing.assert_allclose(np.sum(results.weights), 1.0)
+
+
+def test_unknown_scheduler():
+    with pytest.raises(ValueError):
+        helpers.make_abcsmc(scheduler='eager')
+
+
+class CountingBackend(executors.SerialBackend):
+
+    def __init__(self):
+        super(CountingBackend, self).__init__()
+        self.shutdowns = 0
+
+    def shutdown(self):
+        self.shutdowns += 1
+        super(CountingBackend, self).shutdown()
+
+
+class FlushingIO(helpers.NullIO):
+
+    """Counts flushes, and fails them when told to."""
+
+    def __init__(self, fail=False):
+        self.flushes = 0
+        self.fail = fail
+
+    def flush(self):
+        self.flushes += 1
+        if self.fail:
+            raise IOError('disk full')
+
+
+def test_iterate_schedule_takes_the_next_epsilon():
+    np.random.seed(6)
+    backend = CountingBackend()
+    a = helpers.make_abcsmc(backend=backend)
+    populations = a.iterate_schedule([3.0, 2.5, 2.0, 1.5])
+    first = next(populations)
+    assert first.epsilon == 3.0
+    second = populations.send(1.2)
+    assert second.epsilon == 1.2
+    assert all(d < 1.2 for d in second.distances)
+    assert next(populations).epsilon == 2.0
+
+    # stopping early shuts the backend down
+    populations.close()
+    assert backend.shutdowns == 1
+    assert len(a.sampled) == 3
+
+
+def test_closing_the_generator_flushes_the_checkpoints():
+    np.random.seed(6)
+    io = FlushingIO()
+    populations = helpers.make_abcsmc(io=io).iterate_schedule([3.0, 2.0])
+    next(populations)
+    populations.close()
+    assert io.flushes == 1
+
+    # closing is not a failure of the run, so an error writing the checkpoints reaches the caller
+    populations = helpers.make_abcsmc(io=FlushingIO(fail=True)).iterate_schedule([3.0, 2.0])
+    next(populations)
+    with pytest.raises(IOError):
+        populations.close()
+
+
+def test_epsilon_schedule_may_be_a_generator():
+    def schedule():
+        epsilon = 3.0
+        while epsilon > 1.5:
+            yield epsilon
+            epsilon -= 0.5
+
+    np.random.seed(7)
+    a = helpers.make_abcsmc()
+    assert [results.epsilon for results in a.iterate_schedule(schedule())] == [3.0, 2.5, 2.0]
+
+
+def test_callback_stops_the_run():
+    np.random.seed(8)
+    backend = CountingBackend()
+    a = helpers.make_abcsmc(backend=backend)
+    results = a.run_schedule([3.0, 2.0, 1.5], callback=lambda abc, results: results.epsilon == 2.0)
+    assert [r.epsilon for r in results] == [3.0, 2.0]
+    assert backend.shutdowns == 1
+
+
+def test_set_kernel_type_between_populations():
+    np.random.seed(9)
+    a = helpers.make_abcsmc(KernelType.component_wise_uniform)
+    populations = a.iterate_schedule([3.0, 2.0])
+    next(populations)
+    a.set_kernel_type(KernelType.multivariate_normal)
+    # the kernels are rebuilt from the previous population straight away
+    for model_num in range(a.nmodel):
+        assert np.shape(a.kernels[model_num][2]) == (2, 2)
+    results = next(populations)
+    assert results.naccepted == a.nparticles
+    assert a.kernel_type == KernelType.multivariate_normal
+
+
+def test_adaptive_epsilon_is_used():
+    np.random.seed(10)
+    a = helpers.make_abcsmc()
+    all_results = a.run_schedule([3.0, 0.5], adaptiveEpsilon=True, adaptiveEpsilonQuantile=50)
+    # the second tolerance is the median distance of the first population, not the next entry of the schedule
+    assert all_results[1].epsilon == pytest.approx(np.median(all_results[0].distances))
+
+
+@pytest.mark.parametrize('rule, value', [('max_simulations', 150), ('max_simulations_per_population', 100),
+                                         ('min_acceptance_rate', 0.9), ('max_time', 0.0)])
+def test_stopping_rules(rule, value):
+    np.random.seed(11)
+    a = helpers.make_abcsmc(**{rule: value})
+    results = a.run_schedule([3.0, 1.0, 0.5, 0.2])
+    assert a.stop_reason == rule
+    assert rule in a.stop_message
+    # the run ends with the last complete population, which is the state to carry on from
+    assert len(results) < 4
+    assert len(a.sampled) == len(results)
+    assert all(r.naccepted == a.nparticles for r in results)
+    assert a.distances == [] and a.trajectories == []
+    if len(results) > 0:
+        np.testing.assert_array_equal(a.population_prev.models, results[-1].models)
+        np.testing.assert_array_equal(a.population_prev.weights, results[-1].weights)
+
+
+def test_simulation_budgets_are_checked_between_batches():
+    np.random.seed(12)
+    simulated = []
+
+    class CountingSimulations(executors.SerialBackend):
+
+        def submit(self, model_index, parameters, epsilon, do_comp=True):
+            simulated.append(len(parameters))
+            return super(CountingSimulations, self).submit(model_index, parameters, epsilon, do_comp)
+
+    a = helpers.make_abcsmc(nbatch=10, max_simulations=75, backend=CountingSimulations())
+    a.run_schedule([3.0, 0.5, 0.2])
+    assert a.stop_reason == 'max_simulations'
+    # the rule is checked after each batch, so the run made at most one batch more than the budget allowed
+    assert 75 <= sum(simulated) < 75 + a.nbatch
+
+
+def test_no_stopping_rule():
+    np.random.seed(13)
+    a = helpers.make_abcsmc()
+    assert len(a.run_schedule([3.0, 2.0])) == 2
+    assert a.stop_reason is None and a.stop_message is None
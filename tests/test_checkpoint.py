@@ -0,0 +1,318 @@
+import gc
+import json
+import os
+import pickle
+import threading
+import weakref
+import numpy as np
+import pytest
+from abcsmcbare import checkpoint, input_output
+from abcsmcbare.checkpoint import CheckpointStore
+from abcsmcbare.KernelType import KernelType
+import helpers
+
+
+def run(folder, schedule, kernel_type=KernelType.component_wise_normal, **kwds):
+    io = input_output.InputOutput(folder, False, addTime=False, **kwds)
+    a = helpers.make_abcsmc(kernel_type, io=io)
+    return a, io, a.run_schedule(schedule)
+
+
+def test_every_population_is_appended(tmp_path):
+    folder = str(tmp_path / 'run')
+    np.random.seed(0)
+    a, io, all_results = run(folder, [3.0, 2.0, 1.5])
+
+    store = CheckpointStore(os.path.join(folder, 'checkpoint'))
+    assert len(store) == 3
+    assert sorted(os.listdir(store.folder)) == ['manifest.json', 'population_0000', 'population_0001',
+                                                'population_0002']
+    for index, results in enumerate(all_results):
+        assert store.entry(index)['epsilon'] == results.epsilon
+        assert store.entry(index)['sampled'] == results.sampled
+        np.testing.assert_array_equal(store.load_array(index, 'models'), results.models)
+        np.testing.assert_array_equal(store.load_array(index, 'weights'), results.weights)
+        np.testing.assert_array_equal(store.load_array(index, 'distances'), results.distances)
+        np.testing.assert_array_equal(store.load_trajectories(index), results.trajectories)
+    # the parameters are stored one array per model
+    for model_num in range(a.nmodel):
+        np.testing.assert_array_equal(store.load_array(2, 'parameters_%d' % model_num),
+                                      a.population_prev.model_parameters(model_num))
+
+
+def test_unfinished_segments_are_not_listed(tmp_path):
+    folder = str(tmp_path / 'run')
+    np.random.seed(1)
+    run(folder, [3.0])
+
+    # a crash half way through writing the second population leaves a segment that the manifest does not list
+    store_folder = os.path.join(folder, 'checkpoint')
+    os.mkdir(os.path.join(store_folder, 'population_0001.tmp'))
+    os.mkdir(os.path.join(store_folder, 'population_0001'))
+    store = CheckpointStore(store_folder)
+    assert len(store) == 1
+    with open(os.path.join(store_folder, 'manifest.json')) as f:
+        assert [p['folder'] for p in json.load(f)['populations']] == ['population_0000']
+
+    # and it is replaced by the next population written
+    np.random.seed(1)
+    a = helpers.make_abcsmc(io=input_output.InputOutput(folder, False, addTime=False))
+    a.run_schedule([3.0])
+    assert len(CheckpointStore(store_folder)) == 2
+    assert not os.path.exists(os.path.join(store_folder, 'population_0001.tmp'))
+
+
+def test_ragged_trajectories_are_pickled(tmp_path):
+    np.random.seed(2)
+    a = helpers.make_abcsmc()
+    results = a.run_schedule([3.0])[-1]
+    results.trajectories = [np.zeros(i + 1) for i in range(a.nparticles)]
+
+    store = CheckpointStore(str(tmp_path / 'store'))
+    store.append(results, a.population_prev, a.kernels)
+    assert store.entry(0)['trajectories'] == 'trajectories.pkl'
+    assert [len(t) for t in store.load_trajectories(0)] == list(range(1, a.nparticles + 1))
+
+
+@pytest.mark.parametrize('kernel_type', [KernelType.component_wise_uniform, KernelType.multivariate_normal,
+                                         KernelType.multivariate_normal_nn, KernelType.multivariate_normal_ocm])
+def test_kernel_covariances_are_stored_as_arrays(tmp_path, kernel_type):
+    np.random.seed(5)
+    a = helpers.make_abcsmc(kernel_type)
+    results = a.run_schedule([3.0, 2.0])[-1]
+    store = CheckpointStore(str(tmp_path / 'store'))
+    store.append(results, a.population_prev, a.kernels)
+
+    multivariate = kernel_type != KernelType.component_wise_uniform
+    files = os.listdir(os.path.join(store.folder, 'population_0000'))
+    assert ('kernel_0.npy' in files) == multivariate
+    # the factors are not written, only the covariances
+    with open(store.population_path(0, 'kernels.pkl'), 'rb') as f:
+        assert all(kernel[3] is None for kernel in pickle.load(f))
+
+    for model_num, loaded in enumerate(store.load_kernels(0)):
+        kernel = a.kernels[model_num]
+        assert loaded[:2] == kernel[:2]
+        np.testing.assert_array_equal(loaded[2], kernel[2])
+        if multivariate:
+            # and they are factorized again when the kernels are loaded
+            x = a.population_prev.model_parameters(model_num)[:, kernel[0]]
+            np.testing.assert_allclose(loaded[3].chol, kernel[3].chol)
+            np.testing.assert_allclose(loaded[3].logpdf_matrix(x, x), kernel[3].logpdf_matrix(x, x))
+
+
+def assert_same_population(reader_results, results):
+    np.testing.assert_array_equal(reader_results.models, results.models)
+    np.testing.assert_array_equal(reader_results.weights, results.weights)
+    np.testing.assert_array_equal(reader_results.margins, results.margins)
+    np.testing.assert_array_equal(reader_results.distances, results.distances)
+    for read, params in zip(reader_results.parameters, results.parameters):
+        np.testing.assert_array_equal(read, params)
+    assert reader_results.epsilon == results.epsilon
+    assert reader_results.sampled == results.sampled
+
+
+def test_reader_is_lazy_and_memory_mapped(tmp_path):
+    folder = str(tmp_path / 'run')
+    np.random.seed(6)
+    a, io, all_results = run(folder, [3.0, 2.0, 1.5])
+
+    reader = io.read_results(folder)
+    assert len(reader) == 3
+    last = reader[-1]
+    assert last.index == 2 and last._arrays == {}
+    assert isinstance(last.weights, np.memmap)
+    assert list(last._arrays) == ['weights']
+    for read, results in zip(reader, all_results):
+        assert_same_population(read, results)
+    np.testing.assert_array_equal(last.model_parameters(1), a.population_prev.model_parameters(1))
+
+    assert [results.index for results in reader[1:]] == [1, 2]
+    assert not isinstance(io.read_results(folder, mmap_mode=None)[0].weights, np.memmap)
+    with pytest.raises(IOError):
+        io.read_results(str(tmp_path / 'missing'))
+
+
+def test_restart_arrays(tmp_path):
+    folder = str(tmp_path / 'run')
+    np.random.seed(7)
+    a, io, all_results = run(folder, [3.0, 2.0])
+
+    store = io.read_results(folder).store
+    models, weights, parameters, margins, kernels = store.restart_arrays(mmap_mode='r')
+    data = store.restart_data()
+    np.testing.assert_array_equal(models, data[0])
+    np.testing.assert_array_equal(weights, data[1])
+    np.testing.assert_array_equal(margins, data[3])
+    for model_index in range(a.nmodel):
+        np.testing.assert_array_equal(parameters[model_index], a.population_prev.model_parameters(model_index))
+        assert [data[2][slot] for slot in np.flatnonzero(models == model_index)] == \
+            parameters[model_index].tolist()
+    assert len(kernels) == a.nmodel
+
+
+@pytest.mark.parametrize('restart', [
+    lambda a, io, folder: a.restart_from_checkpoint(io.read_results(folder)),
+    lambda a, io, folder: a.fill_values(io.read_checkpoint(folder)),
+], ids=['restart_from_checkpoint', 'fill_values'])
+def test_restart_from_checkpoint(tmp_path, restart):
+    folder = str(tmp_path / 'run')
+    np.random.seed(3)
+    a, io, all_results = run(folder, [3.0, 2.0])
+
+    restarted = helpers.make_abcsmc(io=input_output.InputOutput(folder, True, addTime=False))
+    restart(restarted, io, folder)
+    np.testing.assert_array_equal(restarted.population_prev.models, a.population_prev.models)
+    np.testing.assert_array_equal(restarted.population_prev.weights, a.population_prev.weights)
+    for model_num in range(a.nmodel):
+        np.testing.assert_array_equal(restarted.population_prev.model_parameters(model_num),
+                                      a.population_prev.model_parameters(model_num))
+    assert not restarted.sample_from_prior
+
+    # carry on from where the first run stopped, into a new store
+    results = restarted.run_schedule([1.5])
+    assert len(results) == 1
+    assert results[0].naccepted == restarted.nparticles
+    assert len(io.read_results(folder + '_restart')) == 1
+
+def old_format_kernel(kernel_type, kernel, population):
+    """The kernel as pickled before kernels held their factorized covariances: three entries, with a dictionary keyed by
+    particle for the per-particle kernels."""
+    if kernel_type in (KernelType.multivariate_normal_nn, KernelType.multivariate_normal_ocm):
+        return [kernel[0], kernel[1], {str(list(p)): np.eye(len(kernel[0])) for p in population}]
+    return [kernel[0], kernel[1], kernel[2]]
+
+
+@pytest.mark.parametrize('kernel_type', [KernelType.component_wise_normal, KernelType.multivariate_normal_nn,
+                                         KernelType.multivariate_normal_ocm])
+def test_restart_from_old_pickled_data(tmp_path, kernel_type):
+    folder = str(tmp_path / 'run')
+    os.makedirs(os.path.join(folder, 'copy'))
+    np.random.seed(4)
+    a = helpers.make_abcsmc(kernel_type)
+    all_results = a.run_schedule([3.0, 2.0])
+    population = a.population_prev
+    io = input_output.InputOutput(folder, False, addTime=False)
+    io.write_pickled(a.nmodel, list(population.models), list(population.weights), population.parameters_list(),
+                     list(population.margins),
+                     [old_format_kernel(kernel_type, a.kernels[m], population.model_parameters(m))
+                      for m in range(a.nmodel)], all_results)
+
+    restarted = helpers.make_abcsmc(kernel_type)
+    restarted.fill_values(io.read_pickled(folder))
+    # the kernels are rebuilt from the population, as the last run would have built them
+    for model_num in range(a.nmodel):
+        assert len(restarted.kernels[model_num]) == 4
+        np.testing.assert_allclose(restarted.kernels[model_num][2], a.kernels[model_num][2])
+    for restarted_aux, aux in zip(restarted.kernel_aux, a.kernel_aux):
+        np.testing.assert_allclose(restarted_aux, aux)
+
+    results = restarted.run_schedule([1.5])
+    assert results[0].naccepted == restarted.nparticles
+    assert all(d < 1.5 for d in results[0].distances)
+
+
+def test_background_writer_writes_every_population(tmp_path):
+    folder = str(tmp_path / 'run')
+    np.random.seed(4)
+    a, io, all_results = run(folder, [3.0, 2.0, 1.5], background=True)
+
+    # run_schedule flushed the writer, and each population was snapshot before Abcsmc reused its arrays
+    assert io.checkpoint_timing()['writes'] == 3
+    store = CheckpointStore(os.path.join(folder, 'checkpoint'))
+    for index, results in enumerate(all_results):
+        np.testing.assert_array_equal(store.load_array(index, 'models'), results.models)
+        np.testing.assert_array_equal(store.load_array(index, 'weights'), results.weights)
+    io.close()
+    assert not io.writer.thread.is_alive()
+
+
+def test_background_writer_bounds_the_queue():
+    writer = checkpoint.BackgroundWriter(max_pending=1)
+    release = threading.Event()
+    writer.submit(release.wait)
+    writer.submit(len, [])
+
+    # the first job is running and the second fills the queue, so a third has to wait
+    blocked = threading.Thread(target=writer.submit, args=(len, []))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+    release.set()
+    blocked.join()
+    writer.close()
+    assert writer.nwrites == 3
+
+
+def test_background_writer_fails_after_an_error():
+    writer = checkpoint.BackgroundWriter()
+    writer.submit(os.remove, '/nonexistent/checkpoint')
+    with pytest.raises(OSError):
+        writer.flush()
+    # nothing more is written, and every later call raises the same error
+    with pytest.raises(OSError):
+        writer.submit(len, [])
+    with pytest.raises(OSError):
+        writer.close()
+    assert writer.nwrites == 0
+    assert not writer.thread.is_alive()
+
+
+def test_failed_background_write_stops_the_run(tmp_path, monkeypatch):
+    append = CheckpointStore.append
+
+    def fail_second_population(store, results, population, kernels):
+        if len(store) == 1:
+            raise IOError('disk full')
+        return append(store, results, population, kernels)
+
+    monkeypatch.setattr(CheckpointStore, 'append', fail_second_population)
+    folder = str(tmp_path / 'run')
+    io = input_output.InputOutput(folder, False, addTime=False, background=True)
+    a = helpers.make_abcsmc(io=io)
+    np.random.seed(9)
+    with pytest.raises(checkpoint.CheckpointWriteError, match='population 1 was not written.*disk full'):
+        a.run_schedule([3.0, 2.5, 2.0, 1.5])
+
+    # the run stopped at the first population written after the failure, which was not given a place in the store
+    assert len(CheckpointStore(os.path.join(folder, 'checkpoint'))) == 1
+    assert io.checkpoint_next == 2
+    assert len(a.sampled) <= 3
+    with pytest.raises(checkpoint.CheckpointWriteError):
+        io.flush()
+
+
+def test_closed_writer_is_not_kept_for_exit():
+    writer = checkpoint.BackgroundWriter()
+    writer.submit(len, [])
+    writer.close()
+    ref = weakref.ref(writer)
+    del writer
+    gc.collect()
+    assert ref() is None
+
+
+class FailingFlush(helpers.NullIO):
+
+    def flush(self):
+        raise IOError('disk full')
+
+
+def failing_distance(simulation, data, params, model):
+    raise RuntimeError('distance failed')
+
+
+def test_writer_error_does_not_hide_the_run_error():
+    np.random.seed(5)
+    a = helpers.make_abcsmc()
+    a.run_schedule([3.0])
+    a.io = FailingFlush()
+    for model in a.models:
+        model.distanceFn = failing_distance
+    with pytest.raises(RuntimeError):
+        a.run_schedule([2.0])
+
+    # without an error in the run, the writer error is raised
+    b = helpers.make_abcsmc(io=FailingFlush())
+    with pytest.raises(IOError):
+        b.run_schedule([3.0])
@@ -0,0 +1,117 @@
+import threading
+import time
+from multiprocessing.connection import Client
+import numpy as np
+import pytest
+from abcsmcbare import distributed
+from abcsmcbare.KernelType import KernelType
+import helpers
+
+AUTHKEY = b'test'
+
+
+def start_backend(**kwds):
+    backend = distributed.DistributedBackend(authkey=AUTHKEY, **kwds)
+    models = helpers.make_models()
+    backend.start(models, [model.prepare_data(helpers.DATA) for model in models])
+    return backend
+
+
+def take_task(address):
+    """Connect as a worker and take a task, without ever answering it; returns the connection and the task."""
+    conn = Client(address, authkey=AUTHKEY)
+    conn.send(('hello', 'silent'))
+    conn.recv_bytes()
+    return conn, conn.recv()
+
+
+def wait_for(condition, timeout=10.0):
+    start = time.time()
+    while not condition():
+        assert time.time() - start < timeout
+        time.sleep(0.01)
+
+
+def test_generated_authkey_is_printable():
+    authkey = distributed.DistributedBackend().authkey
+    assert len(authkey) == 32
+    int(authkey.decode('ascii'), 16)
+
+
+def test_task_of_a_lost_worker_is_requeued():
+    backend = start_backend(heartbeat_timeout=5.0)
+    try:
+        future = backend.submit(0, [[1.0, 2.0], [1.5, 2.5]], 3.0)
+        conn, task = take_task(backend.address)
+        assert task[0] == 'task'
+
+        # the worker disconnects before answering; its task goes back to the queue, for the next worker
+        conn.close()
+        wait_for(lambda: len(backend.pending) == 1)
+        assert backend.pending[0].attempts == 1
+        worker = threading.Thread(target=distributed.run_worker, args=(backend.address, AUTHKEY),
+                                  kwargs={'max_tasks': 1})
+        worker.start()
+        accepted, distances, traj, stats = future.result(timeout=10)
+        worker.join()
+        assert len(distances) == 2
+    finally:
+        backend.shutdown()
+
+
+def test_silent_worker_is_dropped_after_heartbeat_timeout():
+    backend = start_backend(heartbeat_timeout=0.3, max_attempts=1)
+    try:
+        future = backend.submit(0, [[1.0, 2.0]], 3.0)
+        conn, task = take_task(backend.address)
+        with pytest.raises(distributed.WorkerLost):
+            future.result(timeout=10)
+        conn.close()
+    finally:
+        backend.shutdown()
+
+
+@pytest.mark.parametrize('hello', [None, ('task', 'wrong')])
+def test_client_without_a_hello_is_dropped(hello):
+    backend = start_backend(heartbeat_timeout=0.3)
+    try:
+        conn = Client(backend.address, authkey=AUTHKEY)
+        if hello is not None:
+            conn.send(hello)
+        # the coordinator closes the connection instead of waiting for a hello forever
+        assert conn.poll(10)
+        with pytest.raises(EOFError):
+            conn.recv_bytes()
+        conn.close()
+        assert backend.workers == {}
+
+        # and carries on serving workers
+        future = backend.submit(0, [[1.0, 2.0]], 3.0)
+        worker = threading.Thread(target=distributed.run_worker, args=(backend.address, AUTHKEY),
+                                  kwargs={'max_tasks': 1})
+        worker.start()
+        assert len(future.result(timeout=10)[1]) == 1
+        worker.join()
+    finally:
+        backend.shutdown()
+
+
+def test_shutdown_does_not_wait_for_busy_workers():
+    backend = start_backend(heartbeat_timeout=60.0)
+    future = backend.submit(0, [[1.0, 2.0]], 3.0)
+    conn, task = take_task(backend.address)
+
+    start = time.time()
+    backend.shutdown()
+    assert time.time() - start < 5.0
+    assert future.done()
+    conn.close()
+
+
+def test_run_with_local_workers():
+    np.random.seed(3)
+    backend = distributed.DistributedBackend(local_workers=2, chunksize=5)
+    a = helpers.make_abcsmc(KernelType.multivariate_normal, backend=backend)
+    results = a.run_schedule([3.0, 2.0])
+    assert results[-1].naccepted == a.nparticles
+    assert backend.listener is None and backend.processes == []
@@ -0,0 +1,102 @@
+import pickle
+import time
+import numpy as np
+import pytest
+from abcsmcbare import abcModel, executors
+import helpers
+
+
+def simulate_exact(params, pool=None):
+    """The first two parameters of each particle, without noise, so that every backend agrees."""
+    params = np.array([np.asarray(p, dtype=float) for p in params])
+    return params[:, :2]
+
+
+def exact_models():
+    models = helpers.make_models()
+    return [abcModel.AbcModel(model.name, simulate_exact, prior=model.prior, nparameters=model.nparameters,
+                              distanceFn=helpers.distance) for model in models]
+
+
+def simulate_slowly(params, pool=None):
+    time.sleep(1.0)
+    return simulate_exact(params)
+
+
+def failing_distance(simulation, data, params, model):
+    raise RuntimeError('distance failed')
+
+
+PARAMETERS = [[1.0, 2.0], [1.5, 2.0], [4.0, 4.0], [0.5, 1.0], [1.0, 2.5]]
+
+
+@pytest.mark.parametrize('backend', [executors.SerialBackend(), executors.SerialBackend(chunksize=2),
+                                     executors.ProcessPoolBackend(max_workers=2, chunksize=2)])
+def test_backends_agree_with_simulate_and_compare(backend):
+    models = exact_models()
+    data = [model.prepare_data(helpers.DATA) for model in models]
+    expected = executors.simulate_and_compare(models[0], data[0], PARAMETERS, 0.6)
+
+    backend.start(models, data)
+    try:
+        futures = backend.map(0, PARAMETERS, 0.6)
+        chunksize = backend.chunksize or len(PARAMETERS)
+        assert len(futures) == -(-len(PARAMETERS) // chunksize)
+        accepted, distances, traj, stats = executors.collect(futures)
+    finally:
+        backend.shutdown()
+    assert accepted == expected[0] == [1, 1, 0, 0, 1]
+    np.testing.assert_allclose(distances, expected[1])
+    np.testing.assert_array_equal(traj, expected[2])
+    # the simulator and distance time of every chunk, summed, and the number of simulations aborted early
+    assert len(stats) == 3 and stats[0] >= 0 and stats[1] >= 0
+    assert stats[2] == 0
+
+
+def test_simulate_and_compare_without_comparison():
+    accepted, distances, traj, stats = executors.simulate_and_compare(exact_models()[0], helpers.DATA, PARAMETERS,
+                                                                      0.6, do_comp=False)
+    assert accepted == [1] * len(PARAMETERS)
+    assert distances == [0] * len(PARAMETERS)
+    np.testing.assert_array_equal(traj, PARAMETERS)
+
+
+def test_models_do_not_pickle_their_pool():
+    model = abcModel.AbcModel('M', simulate_exact, prior=[], nparameters=2, distanceFn=helpers.distance,
+                              pool=object())
+    assert pickle.loads(pickle.dumps(model)).pool is None
+    assert model.pool is not None
+
+
+def test_run_with_a_process_pool():
+    np.random.seed(4)
+    backend = executors.ProcessPoolBackend(max_workers=2, chunksize=5)
+    a = helpers.make_abcsmc(backend=backend)
+    results = a.run_schedule([3.0, 2.0])
+    assert results[-1].naccepted == a.nparticles
+    assert all(d < 2.0 for d in results[-1].distances)
+    assert backend.executor is None
+
+
+def test_run_shuts_the_backend_down_on_failure():
+    backend = executors.SerialBackend()
+    a = helpers.make_abcsmc(backend=backend, models=helpers.make_models(distanceFn=failing_distance))
+    with pytest.raises(RuntimeError):
+        a.run_schedule([3.0])
+    assert not backend.started
+
+
+def test_shutdown_does_not_wait_for_running_simulations():
+    models = [abcModel.AbcModel('M', simulate_slowly, prior=[], nparameters=2, distanceFn=helpers.distance)]
+    backend = executors.ProcessPoolBackend(max_workers=1)
+    backend.start(models, [helpers.DATA])
+    futures = backend.map(0, PARAMETERS, 0.6)
+    while not futures[0].running():
+        time.sleep(0.01)
+
+    start = time.time()
+    backend.shutdown()
+    # waiting for the simulations would take a second each
+    assert time.time() - start < 0.5
+    assert futures[-1].cancelled()
+    assert backend.executor is None and not backend.futures
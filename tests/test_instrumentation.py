@@ -0,0 +1,44 @@
+import json
+import numpy as np
+from abcsmcbare import instrumentation
+import helpers
+
+
+def test_population_timings():
+    timings = instrumentation.PopulationTimings()
+    with timings.stage('get_kernel'):
+        pass
+    timings.add('simulate', 0.5, calls=4)
+    timings.add('simulate', 0.25)
+    timings.add('population', 2.0)
+    timings.count('simulations', 10)
+    timings.count('accepted', 4)
+
+    assert timings.calls('get_kernel') == 1 and timings.seconds('get_kernel') >= 0.0
+    assert timings.calls('simulate') == 5 and timings.seconds('simulate') == 0.75
+    assert timings.calls('missing') == 0 and timings.seconds('missing') == 0.0
+    assert timings.throughput() == {'simulations_per_second': 5.0, 'accepted_per_second': 2.0}
+    assert list(json.loads(timings.to_json())['stages']) == ['get_kernel', 'simulate', 'population']
+    assert 'throughput' in timings.summary()
+    assert instrumentation.PopulationTimings().throughput()['simulations_per_second'] is None
+
+
+def test_results_carry_their_timings(tmp_path):
+    np.random.seed(11)
+    a = helpers.make_abcsmc()
+    all_results = a.run_schedule([3.0, 2.0])
+    for results in all_results:
+        timings = results.timings
+        assert timings.counters['simulations'] == results.sampled
+        assert timings.counters['accepted'] == results.naccepted
+        for stage in ['sample_proposals', 'backend', 'simulate', 'distance', 'compute_particle_weights', 'checkpoint',
+                      'population']:
+            assert timings.calls(stage) > 0, stage
+        assert timings.seconds('population') >= timings.seconds('backend')
+
+    path = str(tmp_path / 'timings.json')
+    instrumentation.write_json(all_results + [object()], path)
+    with open(path) as f:
+        written = json.load(f)
+    assert written[0]['counters']['simulations'] == all_results[0].sampled
+    assert written[2] is None
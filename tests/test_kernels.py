@@ -0,0 +1,119 @@
+import numpy as np
+from scipy import stats
+from abcsmcbare import kernels, statistics
+from abcsmcbare.KernelType import KernelType
+import helpers
+
+
+def weighted_cov(x, weights):
+    """Reference weighted covariance of the rows of x."""
+    weights = np.asarray(weights, dtype=float) / np.sum(weights)
+    diff = x - np.dot(weights, x)
+    return np.dot(diff.T * weights, diff)
+
+
+def test_k_nearest_neighbours_all_matches_the_linear_scan():
+    rng = np.random.RandomState(0)
+    points = rng.randn(40, 3)
+    neighbours = statistics.k_nearest_neighbours_all(points, 6)
+    assert neighbours.shape == (40, 6)
+    for i in range(len(points)):
+        assert neighbours[i][0] == i
+        assert sorted(neighbours[i]) == sorted(statistics.k_nearest_neighbours(i, points.T, 6))
+    # asking for more neighbours than there are points returns all of them
+    assert statistics.k_nearest_neighbours_all(points[:4], 6).shape == (4, 4)
+
+
+def test_neighbourhood_covs_match_per_point_covariances():
+    rng = np.random.RandomState(0)
+    points = rng.randn(50, 3)
+    weights = rng.uniform(0.1, 1.0, 50)
+    neighbours = statistics.k_nearest_neighbours_all(points, 7)
+
+    expected = np.array([weighted_cov(points[n], weights[n]) for n in neighbours])
+    # blocks of a few points each, including a last partial block
+    np.testing.assert_allclose(statistics.compute_neighbourhood_covs(points, neighbours, weights, block_size=60),
+                               expected)
+    np.testing.assert_allclose(statistics.compute_neighbourhood_covs(points, neighbours, weights), expected)
+
+
+def test_nearest_neighbour_kernel():
+    rng = np.random.RandomState(1)
+    population = rng.randn(30, 3)
+    population[:, 1] = 2.0
+    weights = rng.uniform(0.1, 1.0, 30)
+    kernel = kernels.get_kernel(KernelType.multivariate_normal_nn, [[0, 2], 5, [], None], population, weights)
+
+    pop = population[:, [0, 2]]
+    for i in range(len(pop)):
+        neighbours = statistics.k_nearest_neighbours(i, pop.T, 5)
+        np.testing.assert_allclose(kernel[2][i], 2 * weighted_cov(pop[neighbours], weights[neighbours]))
+    np.testing.assert_allclose(kernel[3].covariance, kernel[2])
+
+
+def test_normal_interval_mass():
+    lower = np.array([-np.inf, 0.0, 1.0, -np.inf, 40.0])
+    upper = np.array([np.inf, np.inf, 2.0, 0.5, np.inf])
+    mass = statistics.normal_interval_mass(lower, upper, 0.3, 2.0)
+    expected = stats.norm.cdf(upper, 0.3, 2.0) - stats.norm.cdf(lower, 0.3, 2.0)
+    np.testing.assert_allclose(mass[:4], expected[:4])
+    # far in the upper tail the mass is not lost to cancellation
+    np.testing.assert_allclose(mass[4], stats.norm.sf(40.0, 0.3, 2.0))
+    assert mass[4] > 0
+
+
+def rectangle_mass(lower, upper, mean, covariance):
+    """Reference mass of a bivariate normal inside a rectangle, by inclusion-exclusion of its cdf."""
+    def cdf(x, y):
+        return stats.multivariate_normal.cdf([x, y], mean, covariance)
+    return cdf(upper[0], upper[1]) - cdf(lower[0], upper[1]) - cdf(upper[0], lower[1]) + cdf(lower[0], lower[1])
+
+
+def test_normal_box_mass():
+    rng = np.random.RandomState(2)
+    lower = np.array([0.0, -np.inf, 0.0])
+    upper = np.array([5.0, np.inf, 50.0])
+    means = rng.uniform(0.0, 2.0, (4, 3))
+    covariances = np.array([[[1.0, 0.3, 0.5], [0.3, 2.0, 0.2], [0.5, 0.2, 1.5]]] * 3 + [np.diag([1.0, 2.0, 1.5])])
+
+    mass = statistics.normal_box_mass(lower, upper, means, covariances, abseps=1e-8)
+    # the unbounded second dimension is marginalised out
+    for m, c, value in zip(means, covariances, mass):
+        expected = rectangle_mass(lower[[0, 2]], upper[[0, 2]], m[[0, 2]], c[[0, 2]][:, [0, 2]])
+        np.testing.assert_allclose(value, expected, atol=1e-5)
+    assert np.all(statistics.normal_box_mass([-np.inf] * 3, [np.inf] * 3, means, covariances) == 1.0)
+
+
+def test_auxilliary_info_is_integrated_with_the_options(monkeypatch):
+    np.random.seed(8)
+    a = helpers.make_abcsmc(KernelType.multivariate_normal_ocm, mvnormcdf_options={'maxpts': 2000})
+    a.run_schedule([3.0, 2.0])
+
+    integrated = []
+    normal_box_mass = statistics.normal_box_mass
+
+    def recording_normal_box_mass(lower, upper, means, covariances, **kwds):
+        integrated.append((len(means), kwds))
+        return normal_box_mass(lower, upper, means, covariances, **kwds)
+
+    monkeypatch.setattr(statistics, 'normal_box_mass', recording_normal_box_mass)
+    a.update_kernels()
+    # one integral per model, over all of its particles, with the options given to Abcsmc
+    assert sum(n for n, kwds in integrated) == a.nparticles
+    assert all(kwds == {'maxpts': 2000} for n, kwds in integrated)
+
+
+def test_optimal_covariance_kernel():
+    rng = np.random.RandomState(2)
+    population = rng.randn(25, 3)
+    population[:, 1] = 2.0
+    weights = rng.uniform(0.1, 1.0, 25)
+    kernel = kernels.get_kernel(KernelType.multivariate_normal_ocm, [[0, 2], 0, [], None], population, weights)
+
+    pop = population[:, [0, 2]]
+    expected = np.array([statistics.compute_optcovmat(pop.T, weights, particle) for particle in pop])
+    np.testing.assert_allclose(kernel[2], expected)
+    # the factors are rank one updates of the covariance's, rather than factorized again
+    chol = kernel[3].chol
+    np.testing.assert_allclose(np.matmul(chol, np.swapaxes(chol, -1, -2)), expected)
+    np.testing.assert_allclose(kernel[3].log_det, np.linalg.slogdet(expected)[1])
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+from abcsmcbare import executors
+import helpers
+
+PARAMETERS = [[1.0, 2.0], [1.5, 2.0], [4.0, 4.0], [0.5, 1.0]]
+
+
+def test_batch_distance_matches_the_distance():
+    np.random.seed(12)
+    model = helpers.make_models(distanceFn=None, batchDistanceFn=helpers.batch_distance)[0]
+    simulations = model.simulate(PARAMETERS)
+    np.testing.assert_allclose(model.batch_distance(simulations, helpers.DATA, PARAMETERS),
+                               [helpers.distance(s, helpers.DATA, p, model) for s, p in zip(simulations, PARAMETERS)])
+
+    calls = []
+
+    def batch_distance(simulations, data, params, model):
+        calls.append(len(params))
+        return helpers.batch_distance(simulations, data, params, model)
+
+    model.batchDistanceFn = batch_distance
+    accepted, distances, traj, stats = executors.simulate_and_compare(model, helpers.DATA, PARAMETERS, 1.0)
+    # the whole batch is compared in one call
+    assert calls == [len(PARAMETERS)]
+    assert accepted[2] == 0 and distances[2] > 1.0
+
+
+def test_batch_distance_of_the_wrong_length():
+    model = helpers.make_models(distanceFn=None, batchDistanceFn=lambda s, d, p, m: [0.0])[0]
+    with pytest.raises(ValueError):
+        executors.simulate_and_compare(model, helpers.DATA, PARAMETERS, 1.0)
+
+
+def test_run_with_a_batch_distance():
+    np.random.seed(13)
+    a = helpers.make_abcsmc(models=helpers.make_models(distanceFn=None, batchDistanceFn=helpers.batch_distance))
+    results = a.run_schedule([3.0, 2.0])
+    assert results[-1].naccepted == a.nparticles
+    assert all(d < 2.0 for d in results[-1].distances)
+
+
+def test_data_is_prepared_once_per_model():
+    prepared = []
+
+    def prepare(data, model):
+        prepared.append(model.name)
+        return {'mean': np.mean(data)}
+
+    def mean_distance(simulation, data, params, model):
+        assert isinstance(data, dict)
+        return abs(np.mean(simulation) - data['mean'])
+
+    np.random.seed(14)
+    models = helpers.make_models(distanceFn=mean_distance, prepareDataFn=prepare)
+    a = helpers.make_abcsmc(models=models)
+    assert prepared == ['M1', 'M2']
+    assert a.model_data == [{'mean': 1.5}, {'mean': 1.5}]
+    results = a.run_schedule([1.0, 0.5])
+    assert prepared == ['M1', 'M2']
+    assert all(d < 0.5 for d in results[-1].distances)
+
+    assert helpers.make_models()[0].prepare_data(helpers.DATA) is helpers.DATA
+
+
+def aborting_simulation(params, data, epsilon, model):
+    """Simulate without noise, giving up on particles whose first parameter alone is epsilon or more away."""
+    simulations = np.array([np.asarray(p[:2], dtype=float) for p in params])
+    partial = np.abs(simulations[:, 0] - data[0])
+    aborted = partial >= epsilon
+    distances = np.where(aborted, partial, np.sqrt(np.sum((simulations - data) ** 2, axis=1)))
+    return simulations, distances, aborted
+
+
+def test_aborting_simulation():
+    model = helpers.make_models(abortingSimulationFn=aborting_simulation)[0]
+    epsilons = []
+
+    def recording_simulation(params, data, epsilon, model):
+        epsilons.append(epsilon)
+        return aborting_simulation(params, data, epsilon, model)
+
+    model.abortingSimulationFn = recording_simulation
+    accepted, distances, traj, stats = executors.simulate_and_compare(model, helpers.DATA, PARAMETERS, 1.0)
+    assert accepted == [1, 1, 0, 0]
+    np.testing.assert_allclose(distances, [0.0, 0.5, 3.0, np.sqrt(1.25)])
+    assert stats[2] == 1
+
+    # without comparing, nothing is aborted
+    accepted, distances, traj, stats = executors.simulate_and_compare(model, helpers.DATA, PARAMETERS, 1.0,
+                                                                      do_comp=False)
+    assert epsilons == [1.0, np.inf]
+    assert accepted == [1, 1, 1, 1] and stats[2] == 0
+
+
+def test_run_with_an_aborting_simulation():
+    np.random.seed(15)
+    a = helpers.make_abcsmc(models=helpers.make_models(abortingSimulationFn=aborting_simulation))
+    results = a.run_schedule([3.0, 1.0])
+    assert results[-1].naccepted == a.nparticles
+    assert all(d < 1.0 for d in results[-1].distances)
+    assert results[-1].timings.counters['aborted'] > 0
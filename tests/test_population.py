@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+from abcsmcbare import abcsmc, statistics
+from abcsmcbare.population import ParticlePopulation
+import helpers
+
+
+def make_population():
+    population = ParticlePopulation(4, [2, 3])
+    population.set(0, 0, [1.0, 2.0])
+    population.set(1, 1, [3.0, 4.0, 5.0])
+    population.set(2, 0, [6.0, 7.0])
+    population.set(3, 1, [8.0, 9.0, 10.0])
+    population.weights[:] = [1.0, 2.0, 3.0, 4.0]
+    population.normalize_weights()
+    population.update_margins()
+    return population
+
+
+def test_population_arrays():
+    population = make_population()
+    np.testing.assert_array_equal(population.models, [0, 1, 0, 1])
+    np.testing.assert_array_equal(population.model_indexes(1), [1, 3])
+    np.testing.assert_array_equal(population.model_parameters(0), [[1.0, 2.0], [6.0, 7.0]])
+    np.testing.assert_allclose(population.model_weights(1), [0.2, 0.4])
+    np.testing.assert_allclose(population.margins, [0.4, 0.6])
+    assert population.parameters_list() == [[1.0, 2.0], [3.0, 4.0, 5.0], [6.0, 7.0], [8.0, 9.0, 10.0]]
+
+
+def test_parameters_array():
+    ragged = make_population().parameters_array()
+    assert ragged.dtype == object
+    np.testing.assert_array_equal(ragged[1], [3.0, 4.0, 5.0])
+
+    population = ParticlePopulation(3, [2, 2])
+    population.set(0, 1, [1.0, 2.0])
+    population.set(1, 0, [3.0, 4.0])
+    population.set(2, 1, [5.0, 6.0])
+    np.testing.assert_array_equal(population.parameters_array(), [[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]])
+
+
+def test_fill_round_trips_the_restart_lists():
+    population = make_population()
+    filled = ParticlePopulation(4, [2, 3])
+    filled.fill(list(population.models), list(population.weights), population.parameters_list(),
+                list(population.margins))
+    np.testing.assert_array_equal(filled.models, population.models)
+    np.testing.assert_allclose(filled.weights, population.weights)
+    np.testing.assert_allclose(filled.margins, population.margins)
+    assert filled.parameters_list() == population.parameters_list()
+
+
+def test_copy_is_independent():
+    population = make_population()
+    copied = population.copy()
+    population.reset()
+    population.set(0, 1, [0.0, 0.0, 0.0])
+    np.testing.assert_array_equal(copied.models, [0, 1, 0, 1])
+    np.testing.assert_allclose(copied.margins, [0.4, 0.6])
+    np.testing.assert_array_equal(copied.get_parameters(0), [1.0, 2.0])
+
+
+def test_results_keep_the_positional_signature():
+    results = abcsmc.AbcsmcResults(4, 10, 0.4, None, [0.1, 0.2, 0.3, 0.4], [0.4, 0.6], [0, 1, 0, 1],
+                                   [0.1, 0.2, 0.3, 0.4], [[1.0, 2.0], [3.0, 4.0, 5.0], [6.0, 7.0], [8.0, 9.0, 10.0]],
+                                   2.0)
+    np.testing.assert_array_equal(results.models, [0, 1, 0, 1])
+    np.testing.assert_array_equal(results.margins, [0.4, 0.6])
+    # the parameters of models with different numbers of parameters are laid out like parameters_array
+    assert results.parameters.shape == (4,) and results.parameters.dtype == object
+    np.testing.assert_array_equal(results.parameters[1], [3.0, 4.0, 5.0])
+    np.testing.assert_array_equal(results.parameters[results.models == 0][1], [6.0, 7.0])
+    assert results.epsilon == 2.0
+
+    results = abcsmc.AbcsmcResults(2, 10, 0.2, None, [0.1, 0.2], [1.0], [0, 0], [0.5, 0.5], [[1.0, 2.0], [3.0, 4.0]],
+                                   2.0)
+    np.testing.assert_array_equal(results.parameters, [[1.0, 2.0], [3.0, 4.0]])
+
+
+def test_results_from_population_are_copies():
+    population = make_population()
+    results = abcsmc.AbcsmcResults.from_population(4, 10, 0.4, None, [0.1, 0.2, 0.3, 0.4], population, 2.0)
+    np.testing.assert_array_equal(results.models, population.models)
+    np.testing.assert_array_equal(results.parameters[3], [8.0, 9.0, 10.0])
+
+    # Abcsmc reuses the population for the next one
+    population.reset()
+    np.testing.assert_array_equal(results.models, [0, 1, 0, 1])
+    np.testing.assert_allclose(results.weights, [0.1, 0.2, 0.3, 0.4])
+    np.testing.assert_array_equal(results.parameters[0], [1.0, 2.0])
+
+
+def test_populations_are_swapped_not_copied():
+    np.random.seed(2)
+    a = helpers.make_abcsmc()
+    arrays = {id(a.population_prev.models), id(a.population_curr.models)}
+    all_results = a.run_schedule([3.0, 2.0, 1.5])
+    assert {id(a.population_prev.models), id(a.population_curr.models)} == arrays
+    np.testing.assert_array_equal(a.population_prev.models, all_results[-1].models)
+    assert a.population_prev.parameters_list() == [list(p) for p in all_results[-1].parameters]
+
+
+def test_sample_particles():
+    population = make_population()
+    population.build_sampling_index()
+    # the position of each particle among those of its model, which is what per-particle kernels are indexed by
+    np.testing.assert_array_equal(population.model_position, [0, 0, 1, 1])
+
+    np.random.seed(0)
+    slots = population.sample_particles(0, 4000)
+    assert set(slots) == {0, 2}
+    # particles are drawn in proportion to their weight within the model
+    assert abs(np.mean(slots == 2) - 0.75) < 0.03
+
+    population.reset()
+    population.set(0, 0, [1.0, 2.0])
+    with pytest.raises(ValueError):
+        population.sample_particles(1, 1)
+
+
+def test_w_choice_batch():
+    np.random.seed(3)
+    draws = statistics.w_choice_batch([0.2, 0.0, 0.8], 5000)
+    np.testing.assert_allclose(np.bincount(draws, minlength=3) / 5000.0, [0.2, 0.0, 0.8], atol=0.02)
+
+
+def test_sample_particle_from_model():
+    population = make_population()
+    np.random.seed(1)
+    slots = [abcsmc.sample_particle_from_model(4, 1, list(population.margins), list(population.models),
+                                               list(population.weights)) for _ in range(2000)]
+    assert set(slots) == {1, 3}
+    assert abs(np.mean(np.array(slots) == 3) - 2.0 / 3.0) < 0.04
+
+    a = helpers.make_abcsmc()
+    a.run_schedule([3.0])
+    for _ in range(20):
+        assert a.population_prev.models[a.sample_particle_from_model(1)] == 1
@@ -0,0 +1,61 @@
+import numpy as np
+from scipy import stats
+from abcsmcbare.compiled_prior import CompiledPrior
+from abcsmcbare.Prior import Prior
+from abcsmcbare.PriorType import PriorType
+import helpers
+
+PRIORS = [Prior(type=PriorType.uniform, lower_bound=0.0, upper_bound=5.0),
+          Prior(type=PriorType.normal, mean=2.0, variance=4.0),
+          Prior(type=PriorType.constant, value=1.0),
+          Prior(type=PriorType.lognormal, mu=0.5, sigma=0.25)]
+
+
+def reference_log_pdf(parameters):
+    return (stats.uniform.logpdf(parameters[:, 0], 0.0, 5.0) + stats.norm.logpdf(parameters[:, 1], 2.0, 2.0) +
+            stats.lognorm.logpdf(parameters[:, 3], 0.5, scale=np.exp(0.5)))
+
+
+def test_samples_follow_the_priors():
+    np.random.seed(0)
+    samples = CompiledPrior(PRIORS).sample(5000)
+    assert samples.shape == (5000, 4)
+    assert np.all((samples[:, 0] >= 0.0) & (samples[:, 0] <= 5.0))
+    assert np.all(samples[:, 2] == 1.0)
+    assert np.all(samples[:, 3] > 0.0)
+    # the variance of the normal prior and the sigma of the lognormal one are both variances
+    assert abs(np.std(samples[:, 1]) - 2.0) < 0.1
+    assert abs(np.std(np.log(samples[:, 3])) - 0.5) < 0.02
+
+
+def test_log_pdf():
+    np.random.seed(1)
+    prior = CompiledPrior(PRIORS)
+    samples = prior.sample(100)
+    np.testing.assert_allclose(prior.log_pdf(samples), reference_log_pdf(samples))
+
+
+def test_log_pdf_outside_the_support():
+    parameters = np.array([[6.0, 2.0, 1.0, 1.0], [1.0, 2.0, 1.0, -1.0]])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        log_pdf = CompiledPrior(PRIORS).log_pdf(parameters)
+    assert np.all(np.isneginf(log_pdf))
+
+
+def test_models_sample_their_prior():
+    np.random.seed(2)
+    a = helpers.make_abcsmc(nbatch=200)
+    models = [0] * 100 + [1] * 100
+    samples = a.sample_parameters_from_prior(models)
+    assert all(len(s) == a.models[m].nparameters for s, m in zip(samples, models))
+    model_two = np.array(samples[100:])
+    assert np.all(model_two[:, 2] == 1.0)
+    assert np.all(model_two[:, 1] > 0.0)
+
+
+def test_in_support():
+    prior = CompiledPrior(PRIORS)
+    parameters = np.array([[6.0, 2.0, 1.0, 1.0], [1.0, 2.0, 1.0, -1.0], [1.0, -50.0, 1.0, 1.0], [0.0, 0.0, 1.0, 1.0]])
+    np.testing.assert_array_equal(prior.in_support(parameters), [False, False, True, True])
+    np.testing.assert_array_equal(prior.lower_bound, [0.0, -np.inf, 1.0, 0.0])
+    np.testing.assert_array_equal(prior.upper_bound, [5.0, np.inf, 1.0, np.inf])
@@ -0,0 +1,156 @@
+import numpy as np
+import pytest
+from abcsmcbare import kernels, statistics
+from abcsmcbare.KernelType import KernelType
+from abcsmcbare.Prior import Prior
+from abcsmcbare.PriorType import PriorType
+import helpers
+
+
+class CountingPerturbation(object):
+
+    """A custom perturbfn: the built-in one, counting its calls."""
+
+    def __init__(self):
+        self.calls = 0
+        self.indexes = []
+
+    def __call__(self, params, priors, kernel, kernel_type, special_cases, index=None):
+        self.calls += 1
+        self.indexes.append(index)
+        return kernels.perturb_particle(params, priors, kernel, kernel_type, special_cases, index=index)
+
+
+def test_custom_perturbfn_is_used():
+    np.random.seed(2)
+    perturbfn = CountingPerturbation()
+    a = helpers.make_abcsmc(perturbfn=perturbfn)
+    a.run_schedule([3.0, 2.0])
+
+    assert a.batchperturbfn is None
+    # at least one call for every proposal of the second population
+    assert perturbfn.calls >= a.sampled[-1]
+
+
+def test_builtin_batchperturbfn_needs_builtin_perturbfn():
+    with pytest.raises(ValueError):
+        helpers.make_abcsmc(perturbfn=CountingPerturbation(), batchperturbfn=kernels.perturb_particles)
+    assert helpers.make_abcsmc().batchperturbfn is kernels.perturb_particles
+
+
+COV = np.array([[1.0, 0.6], [0.6, 2.0]])
+COV_STACK = np.array([np.eye(2), COV])
+
+
+@pytest.mark.parametrize('kernel_type, kernel', [
+    (KernelType.component_wise_normal, [[0, 1], None, [1.0, 2.0]]),
+    (KernelType.multivariate_normal, [[0, 1], None, COV, statistics.FactorizedGaussian(COV)]),
+    (KernelType.multivariate_normal_nn, [[0, 1], None, COV_STACK, statistics.FactorizedGaussian(COV_STACK)]),
+])
+def test_perturbations_have_the_kernel_covariance(kernel_type, kernel):
+    np.random.seed(3)
+    params = np.zeros((20000, 3))
+    params[:, 2] = 3.0
+    # the per-particle kernels are looked up by the index of the particle, not by its value
+    index = np.ones(len(params), dtype=int)
+    perturbed = kernels.perturb_particles(params, [], kernel, kernel_type, 0, index=index)
+
+    assert np.all(params == [0.0, 0.0, 3.0])
+    # parameters outside the kernel are left alone
+    assert np.all(perturbed[:, 2] == 3.0)
+    expected = COV if kernel_type != KernelType.component_wise_normal else np.diag([1.0, 2.0])
+    np.testing.assert_allclose(np.cov(perturbed[:, :2].T), expected, atol=0.06)
+    np.testing.assert_allclose(np.mean(perturbed[:, :2], axis=0), [0.0, 0.0], atol=0.03)
+
+
+def test_truncated_uniform_perturbations_stay_in_the_prior():
+    np.random.seed(4)
+    uniform = Prior(type=PriorType.uniform, lower_bound=0.0, upper_bound=1.0)
+    params = np.repeat([[0.05, 0.5], [0.5, 0.95]], 5000, axis=0)
+    kernel = [[0, 1], None, [[-0.2, 0.2], [-0.2, 0.2]]]
+    perturbed = kernels.perturb_particles(params, [uniform, uniform], kernel, KernelType.component_wise_uniform, 1)
+
+    assert np.all((perturbed >= 0.0) & (perturbed <= 1.0))
+    assert np.all(np.abs(perturbed - params) <= 0.2)
+
+
+@pytest.mark.parametrize('kernel_type', list(KernelType))
+def test_batched_proposals_are_in_the_prior_support(kernel_type):
+    np.random.seed(4)
+    a = helpers.make_abcsmc(kernel_type, nbatch=400)
+    a.run_schedule([3.0])
+
+    models = [0] * 200 + [1] * 200
+    params = a.sample_parameters(models)
+    for model_num, model in enumerate(a.models):
+        these = np.array(params[200 * model_num:200 * (model_num + 1)], dtype=float)
+        assert np.all(model.compiled_prior.in_support(these))
+
+
+def old_style_perturb_particle(params, priors, kernel, kernel_type, special_cases):
+    """A perturbfn written before the built-in one took the position of the particle in the kernel."""
+    return kernels.perturb_particle(params, priors, kernel, kernel_type, special_cases)
+
+
+def old_style_kernel_pdf(params, params0, priors, kernel, auxilliary, kernel_type):
+    """A kernelpdffn written before the built-in one took the position of the particle in the kernel."""
+    return kernels.get_parameter_kernel_pdf(params, params0, priors, kernel, auxilliary, kernel_type)
+
+
+def test_old_style_hooks_are_not_passed_the_kernel_position():
+    np.random.seed(6)
+    a = helpers.make_abcsmc(perturbfn=old_style_perturb_particle, kernelpdffn=old_style_kernel_pdf)
+    custom = a.run_schedule([3.0, 2.0])[-1]
+
+    assert custom.naccepted == a.nparticles
+    assert np.all(np.isfinite(custom.weights))
+    np.testing.assert_allclose(np.sum(custom.margins), 1.0)
+
+
+def batched_perturbation(params, priors, kernel, kernel_type, special_cases, index=None):
+    return kernels.perturb_particles(params, priors, kernel, kernel_type, special_cases, index=index)
+
+
+class IndexedKernelPdf(object):
+
+    """A custom kernelpdffn taking the position of the previous particle in the kernel: the built-in one, counting its
+    calls."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, params, params0, priors, kernel, auxilliary, kernel_type, index0=None):
+        self.calls += 1
+        return kernels.get_parameter_kernel_pdf(params, params0, priors, kernel, auxilliary, kernel_type, index0=index0)
+
+
+def test_custom_hooks_taking_the_kernel_position_work_with_per_particle_kernels():
+    np.random.seed(7)
+    perturbfn = CountingPerturbation()
+    kernelpdffn = IndexedKernelPdf()
+    a = helpers.make_abcsmc(KernelType.multivariate_normal_nn, perturbfn=perturbfn, kernelpdffn=kernelpdffn)
+    results = a.run_schedule([3.0, 2.0])[-1]
+
+    assert results.naccepted == a.nparticles
+    assert np.all(np.isfinite(results.weights))
+    assert perturbfn.calls > 0 and kernelpdffn.calls > 0
+    # every perturbation was passed the position of its particle among those of its model
+    assert all(0 <= i < a.nparticles for i in perturbfn.indexes)
+    assert max(perturbfn.indexes) > 0
+
+
+@pytest.mark.parametrize('kernel_type', [KernelType.multivariate_normal_nn, KernelType.multivariate_normal_ocm])
+def test_old_style_hooks_are_rejected_with_per_particle_kernels(kernel_type):
+    with pytest.raises(ValueError, match='perturbfn'):
+        helpers.make_abcsmc(kernel_type, perturbfn=old_style_perturb_particle)
+    with pytest.raises(ValueError, match='kernelpdffn'):
+        helpers.make_abcsmc(kernel_type, kernelpdffn=old_style_kernel_pdf)
+    # unless a batched version is given, which is always passed the positions
+    helpers.make_abcsmc(kernel_type, perturbfn=old_style_perturb_particle, batchperturbfn=batched_perturbation)
+
+    np.random.seed(8)
+    a = helpers.make_abcsmc(perturbfn=old_style_perturb_particle)
+    a.run_schedule([3.0])
+    with pytest.raises(ValueError):
+        a.set_kernel_type(kernel_type)
+    assert a.kernel_type == KernelType.component_wise_normal
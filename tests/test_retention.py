@@ -0,0 +1,66 @@
+import os
+import numpy as np
+import pytest
+from abcsmcbare import input_output, retention
+import helpers
+
+
+def run(retention_policy, schedule=(3.0, 2.0, 1.5), folder=None, **kwds):
+    io = None if folder is None else input_output.InputOutput(folder, False, addTime=False, **kwds)
+    np.random.seed(7)
+    a = helpers.make_abcsmc(io=io, retention=retention_policy)
+    return a, io, a.run_schedule(list(schedule))
+
+
+def test_keep_all():
+    a, io, all_results = run(retention.KeepAll())
+    for results in all_results:
+        assert len(results.trajectories) == a.nparticles
+        assert results.trajectory_indexes is None
+
+
+def test_keep_none_is_not_checkpointed(tmp_path):
+    folder = str(tmp_path / 'run')
+    a, io, all_results = run(retention.KeepNone(), folder=folder)
+    assert all(results.trajectories is None for results in all_results)
+    assert all(results.trajectories is None for results in io.read_results(folder))
+    segment = os.path.join(folder, 'checkpoint', 'population_0000')
+    assert not any(name.startswith('trajectories') for name in os.listdir(segment))
+
+
+def test_keep_last():
+    a, io, all_results = run(retention.KeepLast(2))
+    assert all_results[0].trajectories is None
+    assert all(len(results.trajectories) == a.nparticles for results in all_results[1:])
+
+
+def test_keep_thinned():
+    a, io, all_results = run(retention.KeepThinned(4))
+    for results in all_results:
+        np.testing.assert_array_equal(results.trajectory_indexes, np.arange(0, a.nparticles, 4))
+        assert len(results.trajectories) == len(results.trajectory_indexes)
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_spill_to_disk_loads_from_the_checkpoint(tmp_path, background):
+    folder = str(tmp_path / 'run')
+    a, io, all_results = run(retention.SpillToDisk(), folder=folder, background=background)
+    reader = io.read_results(folder)
+    for index, results in enumerate(all_results):
+        assert isinstance(results._trajectories, retention.CheckpointTrajectoryLoader)
+        assert results.checkpoint_location == (os.path.join(folder, 'checkpoint'), index)
+        trajectories = results.trajectories
+        assert len(trajectories) == a.nparticles
+        np.testing.assert_array_equal(trajectories, reader[index].trajectories)
+    io.close()
+
+
+def test_spill_to_disk_without_a_checkpoint(tmp_path):
+    folder = str(tmp_path / 'trajectories')
+    a, io, all_results = run(retention.SpillToDisk(folder))
+    assert sorted(os.listdir(folder)) == ['trajectories_0000.npy', 'trajectories_0001.npy', 'trajectories_0002.npy']
+    for results in all_results:
+        assert len(results.trajectories) == a.nparticles
+
+    with pytest.raises(ValueError):
+        run(retention.SpillToDisk())
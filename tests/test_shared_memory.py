@@ -0,0 +1,45 @@
+import os
+import numpy as np
+import pytest
+from abcsmcbare import executors, kernels
+from abcsmcbare.KernelType import KernelType
+import helpers
+
+
+def test_kernels_are_shared_as_arrays(tmp_path):
+    rng = np.random.RandomState(0)
+    population = rng.randn(40, 3)
+    weights = np.ones(40)
+    nn = kernels.get_kernel(KernelType.multivariate_normal_nn, [[0, 1, 2], 10, [], None], population, weights)
+    uniform = kernels.get_kernel(KernelType.component_wise_uniform, [[0, 1, 2], 0, [], None], population, weights)
+    prefix = str(tmp_path / 'population_0000')
+
+    pickled, shared = executors._save_kernels(prefix, [nn, uniform])
+    assert shared == [0]
+    assert pickled[0][2] is None and pickled[0][3] is None
+    assert pickled[1] == uniform
+
+    loaded = executors._load_kernels(prefix, pickled, shared)
+    assert isinstance(loaded[0][2], np.memmap)
+    np.testing.assert_array_equal(loaded[0][2], nn[2])
+    x = rng.randn(40, 3)
+    np.testing.assert_allclose(loaded[0][3].logpdf(x, population, index=np.arange(40)),
+                               nn[3].logpdf(x, population, index=np.arange(40)))
+    np.testing.assert_allclose(loaded[0][3].logpdf_matrix(x, population), nn[3].logpdf_matrix(x, population))
+
+
+@pytest.mark.parametrize('kernel_type', [KernelType.component_wise_uniform, KernelType.multivariate_normal_nn,
+                                         KernelType.multivariate_normal_ocm])
+def test_shared_memory_runs_are_reproducible(tmp_path, kernel_type):
+    weights = []
+    for _ in range(2):
+        np.random.seed(11)
+        backend = executors.SharedMemoryBackend(max_workers=2, chunksize=5, folder=str(tmp_path))
+        a = helpers.make_abcsmc(kernel_type, backend=backend)
+        results = a.run_schedule([3.0, 2.0, 1.5])
+        weights.append(results[-1].weights)
+        assert results[-1].timings.calls('publish') == 1
+        # the shared folder is removed on shutdown
+        assert backend.shared_folder is None
+    np.testing.assert_array_equal(weights[0], weights[1])
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+from scipy import stats
+from abcsmcbare import statistics
+
+
+def test_cholesky_of_singular_matrices():
+    # fewer particles than dimensions: positive semi-definite only
+    v = np.array([[1.0, 2.0, 3.0]])
+    chol = statistics.cholesky(v.T * v)
+    np.testing.assert_allclose(np.dot(chol, chol.T), v.T * v, atol=1e-6)
+    assert np.all(np.diag(chol) > 0)
+
+    # a stack, of which only one matrix needs the jitter
+    stack = np.array([np.eye(3), v.T * v])
+    chol = statistics.cholesky(stack)
+    np.testing.assert_allclose(chol[0], np.eye(3), atol=1e-6)
+    np.testing.assert_allclose(np.matmul(chol, np.swapaxes(chol, -1, -2)), stack, atol=1e-6)
+
+
+def random_covariances(rng, n, d):
+    a = rng.randn(n, d, d)
+    return np.matmul(a, np.swapaxes(a, -1, -2)) + 0.1 * np.eye(d)
+
+
+def test_factorized_gaussian_logpdf():
+    rng = np.random.RandomState(0)
+    covariance = random_covariances(rng, 1, 3)[0]
+    mean = rng.randn(3)
+    x = rng.randn(20, 3)
+    gaussian = statistics.FactorizedGaussian(covariance)
+    np.testing.assert_allclose(gaussian.logpdf(x, mean), stats.multivariate_normal.logpdf(x, mean, covariance))
+    np.testing.assert_allclose(statistics.get_pdf_multinormal(mean, covariance, x[0]),
+                               stats.multivariate_normal.pdf(x[0], mean, covariance))
+
+
+def test_stacked_factorized_gaussian():
+    rng = np.random.RandomState(1)
+    covariances = random_covariances(rng, 6, 3)
+    means = rng.randn(6, 3)
+    x = rng.randn(4, 3)
+    gaussian = statistics.FactorizedGaussian(covariances)
+
+    expected = np.array([[stats.multivariate_normal.logpdf(xk, means[j], covariances[j]) for j in range(6)]
+                         for xk in x])
+    np.testing.assert_allclose(gaussian.logpdf_matrix(x, means), expected)
+    index = [5, 0, 2, 2]
+    np.testing.assert_allclose(gaussian.logpdf(x, means[index], index=index), expected[np.arange(4), index])
+
+
+def test_factorized_gaussian_samples():
+    np.random.seed(2)
+    covariance = np.array([[2.0, 0.5], [0.5, 1.0]])
+    samples = statistics.FactorizedGaussian(covariance).sample(20000, mean=[1.0, -1.0])
+    np.testing.assert_allclose(np.mean(samples, axis=0), [1.0, -1.0], atol=0.05)
+    np.testing.assert_allclose(np.cov(samples.T), covariance, atol=0.05)
+
+
+def test_weighted_moments():
+    rng = np.random.RandomState(3)
+    x = rng.randn(30, 3)
+    weights = rng.uniform(0.1, 1.0, 30)
+
+    np.testing.assert_allclose(statistics.weighted_mean(x, weights), np.average(x, axis=0, weights=weights))
+    np.testing.assert_allclose(statistics.compute_cov(x.T, weights), np.cov(x.T, aweights=weights, bias=True))
+    np.testing.assert_allclose(statistics.compute_cov_stack(np.array([x, 2 * x]), np.array([weights, weights])),
+                               [np.cov(x.T, aweights=weights, bias=True), 4 * np.cov(x.T, aweights=weights, bias=True)])
+    # the 'R' variance is unbiased for frequency-like weights
+    np.testing.assert_allclose(statistics.wtvar(x, weights), np.diag(np.cov(x.T, aweights=weights)))
+    np.testing.assert_allclose(statistics.wtvar(x[:, 0], weights), np.cov(x[:, 0], aweights=weights))
+
+
+def test_optcovmat():
+    rng = np.random.RandomState(4)
+    x = rng.randn(30, 2)
+    weights = rng.uniform(0.1, 1.0, 30)
+    means = rng.randn(5, 2)
+
+    # the weighted second moment about each mean, which is symmetric
+    expected = [np.dot((x - m).T * weights, x - m) / np.sum(weights) for m in means]
+    np.testing.assert_allclose([statistics.compute_optcovmat(x.T, weights, m) for m in means], expected)
+    np.testing.assert_allclose(statistics.compute_optcovmat_stack(x, weights, means), expected)
+
+
+def test_mvnormcdf_with_correlations():
+    # every pair of dimensions is correlated differently, so a misplaced coefficient changes the mass
+    covariance = np.array([[1.0, 0.5, -0.3], [0.5, 2.0, 0.4], [-0.3, 0.4, 1.5]])
+    mean = np.array([0.2, -0.1, 0.4])
+    upper = np.array([1.0, 0.5, 2.0])
+    expected = stats.multivariate_normal.cdf(upper, mean, covariance)
+    np.testing.assert_allclose(statistics.mvnormcdf([-np.inf] * 3, upper, mean, covariance, abseps=1e-8), expected,
+                               atol=1e-5)
+
+
+def test_cholesky_rank_one_update():
+    rng = np.random.RandomState(5)
+    covariance = random_covariances(rng, 1, 4)[0]
+    v = rng.randn(6, 4)
+    original = v.copy()
+    chol = statistics.cholesky_rank_one_update(np.linalg.cholesky(covariance), v)
+    expected = covariance + v[:, :, np.newaxis] * v[:, np.newaxis, :]
+    np.testing.assert_allclose(chol, np.linalg.cholesky(expected))
+    np.testing.assert_array_equal(v, original)
+
+
+def test_ocm_covariances_agree_with_their_factors():
+    # the particles lie on a line, so their covariance C is singular and is factorized with jitter
+    x = np.array([[0.0, 0.0], [1.0, 2.0], [2.0, 4.0], [3.0, 6.0]])
+    weights = np.array([1.0, 2.0, 3.0, 4.0])
+    with pytest.raises(np.linalg.LinAlgError):
+        np.linalg.cholesky(statistics.compute_cov_stack(x, weights))
+
+    covariances, chol = statistics.compute_ocm(x, weights)
+    np.testing.assert_allclose(np.matmul(chol, np.swapaxes(chol, -1, -2)), covariances, rtol=1e-12, atol=1e-14)
+    assert np.all(np.linalg.eigvalsh(covariances) > 0)
+    # and stay the OCMs, up to the jitter
+    expected = np.array([statistics.compute_optcovmat(x.T, weights, particle) for particle in x])
+    np.testing.assert_allclose(covariances, expected, atol=1e-8)
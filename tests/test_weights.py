@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+from scipy import stats
+from abcsmcbare import abcsmc, kernels, statistics
+from abcsmcbare.KernelType import KernelType
+import helpers
+
+
+def flat_kernel_pdf(params, params0, priors, kernel, auxilliary, kernel_type):
+    """A kernel density that does not depend on the particles, which leaves only the prior in the weights."""
+    return 1.0
+
+
+def tiny_kernel_log_pdf(params, params0, priors, kernel, auxilliary, kernel_type):
+    """The log of a flat kernel density too small to be represented outside log space."""
+    return np.full((len(params), len(params0)), -2000.0)
+
+
+def after_first_population(kernel_type, seed):
+    np.random.seed(seed)
+    a = helpers.make_abcsmc(kernel_type)
+    a.run_schedule([3.0])
+    return a
+
+
+@pytest.mark.parametrize('kernel_type', list(KernelType))
+def test_log_pdf_matrix_matches_kernel_pdf(kernel_type):
+    a = after_first_population(kernel_type, 1)
+    for model_num, model in enumerate(a.models):
+        prev_index = a.population_prev.model_indexes(model_num)
+        params0 = a.population_prev.model_parameters(model_num)
+        params = np.array(a.sample_parameters([model_num] * a.nbatch))
+        aux = [a.kernel_aux[j] for j in prev_index]
+
+        expected = np.array([[kernels.get_parameter_kernel_pdf(list(p), list(p0), model.prior, a.kernels[model_num],
+                                                               aux[j], kernel_type, index0=j)
+                              for j, p0 in enumerate(params0)] for p in params])
+        with np.errstate(divide='ignore'):
+            expected = np.log(expected)
+        log_pdf = kernels.get_parameter_kernel_log_pdf_matrix(params, params0, model.prior, a.kernels[model_num], aux,
+                                                              kernel_type)
+        np.testing.assert_allclose(log_pdf, expected, rtol=1e-8)
+
+
+@pytest.mark.parametrize('kernel_type', list(KernelType))
+def test_vectorized_weights_match_pairwise(kernel_type):
+    np.random.seed(3)
+    a = helpers.make_abcsmc(kernel_type)
+    compared = []
+
+    def both():
+        a.compute_particle_weights_pairwise()
+        pairwise = a.population_curr.weights / np.sum(a.population_curr.weights)
+        abcsmc.Abcsmc.compute_particle_weights(a)
+        vectorized = a.population_curr.weights / np.sum(a.population_curr.weights)
+        compared.append((pairwise, vectorized))
+
+    a.compute_particle_weights = both
+    a.run_schedule([3.0, 2.0, 1.5])
+
+    assert len(compared) == 2
+    for pairwise, vectorized in compared:
+        np.testing.assert_allclose(vectorized, pairwise, rtol=1e-8, atol=1e-12)
+
+
+def expected_prior_weights(a, results):
+    """With a flat kernel, the weight of a particle of a model is proportional to its prior density."""
+    for model_num, model in enumerate(a.models):
+        index = np.flatnonzero(results.models == model_num)
+        params = np.array([results.parameters[i] for i in index], dtype=float)
+        expected = np.exp(model.compiled_prior.log_pdf(params))
+        np.testing.assert_allclose(results.weights[index] / np.sum(results.weights[index]), expected / np.sum(expected))
+
+
+def test_custom_kernelpdffn_is_used():
+    np.random.seed(5)
+    stock = helpers.make_abcsmc().run_schedule([3.0, 2.0])[-1]
+    np.random.seed(5)
+    a = helpers.make_abcsmc(kernelpdffn=flat_kernel_pdf)
+    custom = a.run_schedule([3.0, 2.0])[-1]
+
+    assert a.kernellogpdffn is None
+    # the proposals do not depend on kernelpdffn, so both runs drew the same particles, and only the weights differ
+    np.testing.assert_array_equal(custom.models, stock.models)
+    for custom_params, stock_params in zip(custom.parameters, stock.parameters):
+        np.testing.assert_array_equal(custom_params, stock_params)
+    assert not np.allclose(custom.weights, stock.weights)
+    expected_prior_weights(a, custom)
+
+
+def test_weights_do_not_underflow():
+    np.random.seed(6)
+    a = helpers.make_abcsmc(kernelpdffn=flat_kernel_pdf, kernellogpdffn=tiny_kernel_log_pdf)
+    results = a.run_schedule([3.0, 2.0])[-1]
+    assert np.all(np.isfinite(results.weights))
+    np.testing.assert_allclose(np.sum(results.weights), 1.0)
+    expected_prior_weights(a, results)
+
+
+def test_builtin_kernellogpdffn_needs_builtin_kernelpdffn():
+    with pytest.raises(ValueError):
+        helpers.make_abcsmc(kernelpdffn=flat_kernel_pdf, kernellogpdffn=kernels.get_parameter_kernel_log_pdf_matrix)
+    assert helpers.make_abcsmc().kernellogpdffn is kernels.get_parameter_kernel_log_pdf_matrix
+
+
+def test_log_densities():
+    x = np.array([0.1, 1.0, 2.5, 7.0])
+    np.testing.assert_allclose(statistics.get_pdf_lognormal(0.5, 0.5, x), stats.lognorm.pdf(x, 0.5, scale=np.exp(0.5)))
+    np.testing.assert_allclose(statistics.get_log_pdf_lognormal(0.5, 0.5, x),
+                               stats.lognorm.logpdf(x, 0.5, scale=np.exp(0.5)))
+    np.testing.assert_allclose(statistics.get_log_pdf_gauss(1.0, 2.0, x), stats.norm.logpdf(x, 1.0, 2.0))
+    np.testing.assert_array_equal(statistics.get_log_pdf_uniform(0.0, 5.0, x), [-np.log(5.0)] * 3 + [-np.inf])